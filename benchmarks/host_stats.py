@@ -0,0 +1,110 @@
+"""
+Compares the per-request cost of counting requests and bytes with
+HostCounters and the slotted StatsSocket, against the original stats
+dict updates and StatsSocket.
+
+Run with: python benchmarks/host_stats.py
+"""
+
+import itertools
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mantrid.loadbalancer import Balancer
+from mantrid.stats import HostCounters
+from mantrid.stats_socket import StatsSocket
+
+
+class LegacyStatsSocket(object):
+    "StatsSocket as it was before it had slots"
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.sock, attr)
+
+    def sendall(self, data):
+        self.bytes_sent += len(data)
+        self.sock.sendall(data)
+
+    def recv(self, length):
+        recvd = self.sock.recv(length)
+        self.bytes_received += len(recvd)
+        return recvd
+
+
+class NullSocket(object):
+    "A socket that does nothing, so only the accounting is timed"
+
+    def recv(self, length):
+        return "x" * 512
+
+    def send(self, data):
+        return len(data)
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def main():
+    balancer = Balancer(None, None, None, None)
+    balancer.stats = {}
+    hosts = ["host%i.example.com" % i for i in range(1000)]
+    next_host = itertools.cycle(hosts).next
+    head = "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n"
+    number = 100000
+
+    def legacy():
+        # What handle_request did for every request
+        sock = LegacyStatsSocket(NullSocket())
+        stats_dict = balancer.stats.setdefault(next_host(), {})
+        stats_dict['open_requests'] = stats_dict.get('open_requests', 0) + 1
+        sock.recv(4096)
+        sock.sendall(head)
+        sock.sendall("ok")
+        stats_dict['open_requests'] -= 1
+        stats_dict['completed_requests'] = stats_dict.get('completed_requests', 0) + 1
+        stats_dict['bytes_sent'] = stats_dict.get('bytes_sent', 0) + sock.bytes_sent
+        stats_dict['bytes_received'] = stats_dict.get('bytes_received', 0) + sock.bytes_received
+        sock.bytes_sent = sock.bytes_received = 0
+        sock.close()
+
+    def current():
+        sock = StatsSocket(NullSocket())
+        host = next_host()
+        counters = balancer.counters.get(host)
+        if counters is None:
+            counters = balancer.counters[host] = HostCounters()
+        counters.open_requests += 1
+        sock.recv(4096)
+        sock.sendall(head)
+        sock.sendall("ok")
+        counters.open_requests -= 1
+        counters.completed_requests += 1
+        counters.bytes_sent += sock.bytes_sent
+        counters.bytes_received += sock.bytes_received
+        sock.bytes_sent = sock.bytes_received = 0
+        sock.close()
+
+    old = min(timeit.Timer(legacy).repeat(3, number)) * 1000000.0 / number
+    new = min(timeit.Timer(current).repeat(3, number)) * 1000000.0 / number
+    print "%-25s %8.2f us/request" % ("stats dicts", old)
+    print "%-25s %8.2f us/request" % ("HostCounters", new)
+    # Folding is only done when /stats/ is read or the state is saved
+    start = time.time()
+    balancer.snapshot_stats()
+    print "%-25s %8.2f ms per /stats/ read (%i hosts)" % ("snapshot", (time.time() - start) * 1000, len(hosts))
+
+
+if __name__ == "__main__":
+    main()
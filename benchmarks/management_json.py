@@ -0,0 +1,73 @@
+"""
+Compares encoding a large host table and its stats for GET /hostname/
+and /stats/ as one mantrid.json.dumps() call every time, as they used to
+be, against EncodedItems, which only encodes the entries changed since
+the last request.
+
+Run with: python benchmarks/management_json.py [number_of_hosts]
+"""
+
+import copy
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mantrid.json
+from mantrid.backend import Backend
+
+
+def legacy_dumps(*args, **kwargs):
+    "mantrid.json.dumps as it was before it reused an encoder"
+    new_kwargs = copy.copy(kwargs)
+    new_kwargs['cls'] = mantrid.json.MantridEncoder
+    return json.dumps(*args, **new_kwargs)
+
+
+def best_of(function, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        function()
+        taken = time.time() - start
+        best = taken if best is None else min(best, taken)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    hosts = {}
+    for i in range(count):
+        hosts["site%i.example.com" % i] = ["proxy", {
+            "backends": [Backend(("10.0.%i.%i" % (j, i % 256), 8000 + j)) for j in range(3)],
+            "algorithm": "least_connections",
+        }, True]
+    stats = dict(
+        (host, {"open_requests": 0, "completed_requests": 10, "bytes_sent": 1000, "bytes_received": 100})
+        for host in hosts
+    )
+    hosts_json = mantrid.json.EncodedItems()
+    stats_json = mantrid.json.EncodedItems(by_value=True)
+    assert json.loads(hosts_json.encode(hosts)) == json.loads(legacy_dumps(hosts))
+    assert json.loads(stats_json.encode(stats)) == json.loads(legacy_dumps(stats))
+
+    def change_some():
+        # A few hosts get requests between each scrape
+        for i in range(0, count, 1000):
+            stats["site%i.example.com" % i]["completed_requests"] += 1
+        hosts["site0.example.com"] = list(hosts["site0.example.com"])
+
+    print "%i hosts" % count
+    for name, function in [
+        ("hosts dumps", lambda: legacy_dumps(hosts)),
+        ("hosts items", lambda: (change_some(), hosts_json.encode(hosts))),
+        ("stats dumps", lambda: legacy_dumps(stats)),
+        ("stats items", lambda: (change_some(), stats_json.encode(stats))),
+    ]:
+        print "%-12s %8.1f ms" % (name, best_of(function) * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Measures the latency of requests proxied through a balancer while big
+management requests (replacing, fetching and saving a large host table)
+are being made, with management_offload off and then on.
+
+The backend, the balancer and the client sending proxied requests each
+run in their own process, so the only thing sharing the balancer's hub
+with the proxied requests is the management work.
+
+Run with: python benchmarks/management_latency.py [number_of_hosts] [seconds]
+"""
+
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+BACKEND_PORT = 31801
+PROXY_PORT = 31802
+MANAGEMENT_PORT = 31803
+
+
+def run_backend():
+    "Answers every request with a small response, on a keep-alive connection"
+    import eventlet
+    from eventlet import wsgi
+
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", "2")])
+        return ["ok"]
+
+    with open("/dev/null", "w") as log:
+        wsgi.server(eventlet.listen(("127.0.0.1", BACKEND_PORT)), app, log=log)
+
+
+def run_balancer(state_file, offload):
+    from mantrid.loadbalancer import Balancer
+    balancer = Balancer(
+        [(("127.0.0.1", PROXY_PORT), socket.AF_INET)],
+        [],
+        [(("127.0.0.1", MANAGEMENT_PORT), socket.AF_INET)],
+        state_file,
+        management_offload=offload,
+    )
+    balancer.run()
+
+
+def fork(function, *args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            function(*args)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def management(method, path, body=None):
+    request = urllib2.Request("http://127.0.0.1:%i%s" % (MANAGEMENT_PORT, path), body)
+    request.get_method = lambda: method
+    return urllib2.urlopen(request, timeout=300).read()
+
+
+def proxied_request():
+    "Sends one request through the balancer, returning how long it took"
+    start = time.time()
+    sock = socket.create_connection(("127.0.0.1", PROXY_PORT))
+    try:
+        sock.sendall("GET / HTTP/1.0\r\nHost: bench.local\r\n\r\n")
+        while sock.recv(4096):
+            pass
+    finally:
+        sock.close()
+    return time.time() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(count, seconds, offload):
+    directory = tempfile.mkdtemp()
+    pids = [fork(run_backend), fork(run_balancer, os.path.join(directory, "state.json"), offload)]
+    try:
+        time.sleep(1)
+        bench_rule = ["proxy", {"backends": [{"__backend__": ["127.0.0.1", BACKEND_PORT]}]}, False]
+        management("PUT", "/hostname/bench.local/", json.dumps(bench_rule))
+        table = dict(
+            ("site%i.example.com" % i, ["proxy", {"backends": [
+                {"__backend__": ["10.0.%i.%i" % (j, i % 256), 8000 + j]} for j in range(3)
+            ]}, True])
+            for i in range(count)
+        )
+        table["bench.local"] = bench_rule
+        body = json.dumps(table)
+        latencies = {"idle": [], "busy": []}
+        phase = ["idle"]
+        stopped = threading.Event()
+
+        def client():
+            while not stopped.is_set():
+                latency = proxied_request()
+                latencies[phase[0]].append(latency)
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        time.sleep(seconds)
+        phase[0] = "busy"
+        deadline = time.time() + seconds
+        operations = 0
+        while time.time() < deadline:
+            management("PUT", "/hostname/", body)
+            management("GET", "/hostname/")
+            management("GET", "/stats/")
+            operations += 1
+        stopped.set()
+        thread.join()
+        for name in ("idle", "busy"):
+            values = latencies[name]
+            print "offload=%-5s %-4s %6i requests  p50 %7.2f ms  p99 %7.2f ms  max %7.2f ms" % (
+                offload,
+                name,
+                len(values),
+                percentile(values, 0.5) * 1000,
+                percentile(values, 0.99) * 1000,
+                max(values) * 1000,
+            )
+        print "offload=%-5s %i rounds of management requests" % (offload, operations)
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        shutil.rmtree(directory)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print "%i hosts" % count
+    for offload in (False, True):
+        measure(count, seconds, offload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Measures what recording the latency metrics of a proxied request costs,
+next to the existing StatsSocket byte accounting of every request.
+
+Run with: python benchmarks/metrics.py
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mantrid.actions import Proxy
+from mantrid.backend import Backend
+from mantrid.loadbalancer import Balancer
+from mantrid.requesthead import RequestHead
+from mantrid.stats_socket import StatsSocket
+
+
+class NullSocket(object):
+    "A socket that does nothing, so only the accounting is timed"
+
+    def recv(self, length):
+        return "x" * 512
+
+    def sendall(self, data):
+        pass
+
+    def send(self, data):
+        return len(data)
+
+
+def main():
+    balancer = Balancer(None, None, None, None)
+    balancer.stats = {}
+    backends = [Backend(("10.0.0.%i" % i, 80)) for i in range(10)]
+    proxy = Proxy(balancer, "example.com", "example.com", backends)
+    sock = StatsSocket(NullSocket())
+    head = "HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n"
+    request = RequestHead("GET / HTTP/1.1\r\nX-Loadbalance-To: example.com\r\n")
+    number = 100000
+
+    def stats_socket():
+        # What handle_request does for every request: a read, a couple of
+        # writes, then folding the byte counts into the host's stats
+        sock.recv(4096)
+        sock.sendall(head)
+        sock.sendall("ok")
+        stats_dict = balancer.stats.setdefault("example.com", {})
+        stats_dict['open_requests'] = stats_dict.get('open_requests', 0) + 1
+        stats_dict['open_requests'] -= 1
+        stats_dict['completed_requests'] = stats_dict.get('completed_requests', 0) + 1
+        stats_dict['bytes_sent'] = stats_dict.get('bytes_sent', 0) + sock.bytes_sent
+        stats_dict['bytes_received'] = stats_dict.get('bytes_received', 0) + sock.bytes_received
+        sock.bytes_sent = sock.bytes_received = 0
+
+    backend_iter = iter(backends * (number * 3 // len(backends) + 1))
+
+    def metrics():
+        # Everything Proxy records for a request on a new connection
+        backend = next(backend_iter)
+        start = time.time()
+        proxy.histograms(backend)[0].observe(time.time() - start)
+        proxy.record(request, backend, start, time.time(), False, False)
+
+    base = min(timeit.Timer(stats_socket).repeat(3, number)) * 1000000.0 / number
+    extra = min(timeit.Timer(metrics).repeat(3, number)) * 1000000.0 / number
+    print "%-25s %8.2f us/request" % ("StatsSocket accounting", base)
+    print "%-25s %8.2f us/request (%.0f%% of StatsSocket)" % ("proxy metrics", extra, extra * 100 / base)
+
+
+if __name__ == "__main__":
+    main()
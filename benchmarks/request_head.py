@@ -0,0 +1,87 @@
+"""
+Compares parsing and rewriting a request head with read_request_head
+against the original makefile() + mimetools.Message path.
+
+Run with: python benchmarks/request_head.py
+"""
+
+import mimetools
+import os
+import socket
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mantrid.framing import BufferedSocket
+from mantrid.requesthead import read_request_head
+
+REQUEST = (
+    "GET /some/page?with=a&query=string HTTP/1.1\r\n"
+    "Host: www.example.com\r\n"
+    "X-Loadbalance-To: www.example.com\r\n"
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0\r\n"
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    "Accept-Language: en-gb,en;q=0.5\r\n"
+    "Accept-Encoding: gzip, deflate\r\n"
+    "Cookie: session=0123456789abcdef0123456789abcdef; tracking=abcdef\r\n"
+    "X-Request-Id: 4f1c2a9e-5d1b-4b7a-9c3e-0a1b2c3d4e5f\r\n"
+    "Connection: keep-alive\r\n"
+    "\r\n"
+)
+
+
+class ReplaySocket(object):
+    "Returns the same request every time it's read from"
+
+    def __init__(self, data):
+        self.data = data
+        self.sent = False
+
+    def recv(self, length):
+        if self.sent:
+            return ""
+        self.sent = True
+        return self.data
+
+    def makefile(self, mode, bufsize):
+        return socket._fileobject(self, mode, bufsize)
+
+
+def legacy():
+    "The head handling Balancer.handle used before requesthead existed"
+    rfile = ReplaySocket(REQUEST).makefile('rb', 4096)
+    first = rfile.readline().strip("\r\n")
+    words = first.split()
+    headers = mimetools.Message(rfile, 0)
+    host = headers['X-Loadbalance-To'] if 'X-Loadbalance-To' in headers else headers['LoadBalanceTo']
+    request_id = headers.get("X-Request-Id", "-")
+    headers['Connection'] = "close\r"
+    headers['X-Forwarded-For'] = "127.0.0.1"
+    headers['X-Forwarded-Protocol'] = ""
+    headers['X-Forwarded-Proto'] = ""
+    rfile._rbuf.seek(0)
+    return first + "\r\n" + str(headers) + "\r\n" + rfile._rbuf.read()
+
+
+def current():
+    "The head handling Balancer.handle_request does now"
+    headers = read_request_head(BufferedSocket(ReplaySocket(REQUEST)))
+    host = headers.get('X-Loadbalance-To') or headers.get('LoadBalanceTo') or "unknown"
+    request_id = headers.get("X-Request-Id", "-")
+    headers.set('Connection', "close")
+    headers.set('X-Forwarded-For', "127.0.0.1")
+    headers.set('X-Forwarded-Protocol', "")
+    headers.set('X-Forwarded-Proto', "")
+    return str(headers)
+
+
+def main():
+    number = 20000
+    for name, function in [("mimetools", legacy), ("requesthead", current)]:
+        best = min(timeit.Timer(function).repeat(3, number))
+        print "%-12s %.2f us/request" % (name, best * 1000000.0 / number)
+
+
+if __name__ == "__main__":
+    main()
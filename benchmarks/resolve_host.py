@@ -0,0 +1,60 @@
+"""
+Compares Balancer.resolve_host against the original split-and-format lookup.
+
+Run with: python benchmarks/resolve_host.py [number_of_hosts]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mantrid.loadbalancer import Balancer
+from mantrid.actions import NoHosts, Unknown
+
+
+def legacy_resolve_host(self, host, protocol="http"):
+    "The lookup Balancer.resolve_host used before the route table existed"
+    if not self.hosts:
+        return NoHosts(self, host, "unknown")
+    bits = host.split(".")
+    for i in range(len(bits)):
+        for prefix in ["%s://" % protocol, ""]:
+            subhost = prefix + (".".join(bits[i:]))
+            if subhost in self.hosts:
+                action, kwargs, allow_subs = self.hosts[subhost]
+                if allow_subs or i == 0:
+                    action_class = self.action_mapping[action]
+                    return action_class(
+                        balancer = self,
+                        host = host,
+                        matched_host = subhost,
+                        **kwargs
+                    )
+    return Unknown(self, host, "unknown")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    balancer = Balancer(None, None, None, None)
+    hosts = {}
+    for i in range(count):
+        hosts["site%i.example.com" % i] = ["empty", {"code": 200}, False]
+        hosts["app%i.example.net" % i] = ["redirect", {"redirect_to": "http://example.org"}, True]
+    balancer.hosts = hosts
+    lookups = [
+        "site17.example.com",
+        "www.app42.example.net",
+        "deep.sub.app99.example.net",
+        "nothing.example.org",
+    ]
+    number = 100000
+    for name, function in [("legacy", legacy_resolve_host), ("route table", Balancer.resolve_host)]:
+        timer = timeit.Timer(lambda: [function(balancer, host) for host in lookups])
+        best = min(timer.repeat(3, number // len(lookups)))
+        print "%-12s %.2f us/lookup" % (name, best * 1000000.0 / number)
+
+
+if __name__ == "__main__":
+    main()
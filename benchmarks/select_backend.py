@@ -0,0 +1,66 @@
+"""
+Compares Proxy backend selection using the maintained BackendGroup
+against the original scan of every backend on each request.
+
+Run with: python benchmarks/select_backend.py [number_of_backends]
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mantrid.actions import Proxy
+from mantrid.backend import Backend
+from mantrid.loadbalancer import Balancer
+
+
+def legacy_least_connections(proxy):
+    "The selection Proxy.least_connections did before BackendGroup existed"
+    backends = [b for b in proxy.backends if not b.blacklisted or not proxy.healthcheck]
+    min_connections = min(b.connections for b in backends)
+    return random.choice([b for b in backends if b.connections == min_connections])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    backends = [Backend(("10.0.%i.%i" % (i // 256, i % 256), 80)) for i in range(count)]
+    for backend in backends:
+        # Don't start recovery loops for the blacklisted ones
+        backend.checker = True
+    balancer = Balancer(None, None, None, None)
+    number = 20000
+    for algorithm in ["least_connections", "power_of_two"]:
+        proxy = Proxy(balancer, "example.com", "example.com", backends, algorithm=algorithm)
+        proxy.select_backend({})
+        for backend in random.sample(backends, count // 10):
+            backend.blacklisted = True
+        for backend in backends:
+            for i in range(random.randrange(5)):
+                backend.add_connection()
+
+        def legacy():
+            backend = legacy_least_connections(proxy)
+            backend.add_connection()
+            backend.drop_connection()
+
+        def current():
+            backend = proxy.select_backend({})
+            backend.add_connection()
+            backend.drop_connection()
+
+        if algorithm == "least_connections":
+            best = min(timeit.Timer(legacy).repeat(3, number))
+            print "%-20s %8.2f us/request" % ("legacy scan", best * 1000000.0 / number)
+        best = min(timeit.Timer(current).repeat(3, number))
+        print "%-20s %8.2f us/request" % (algorithm, best * 1000000.0 / number)
+        for backend in backends:
+            backend.blacklisted = False
+            while backend.connections:
+                backend.drop_connection()
+
+
+if __name__ == "__main__":
+    main()
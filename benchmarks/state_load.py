@@ -0,0 +1,55 @@
+"""
+Compares loading a large state from the JSON state file against loading
+it from the binary snapshot, as Balancer.load does at startup.
+
+Run with: python benchmarks/state_load.py [number_of_hosts]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mantrid.backend import Backend
+from mantrid.loadbalancer import Balancer
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    directory = tempfile.mkdtemp()
+    try:
+        state_file = os.path.join(directory, "state.json")
+        balancer = Balancer(None, None, None, state_file, state_snapshot=True)
+        hosts = {}
+        for i in range(count):
+            hosts["site%i.example.com" % i] = ["proxy", {
+                "backends": [Backend(("10.0.%i.%i" % (j, i % 256), 8000 + j)) for j in range(3)],
+                "algorithm": "least_connections",
+            }, True]
+        balancer.hosts = hosts
+        balancer.stats = dict((host, {"completed_requests": 10, "bytes_sent": 1000}) for host in hosts)
+        balancer.save()
+        print "%i hosts: state.json %i KB, snapshot %i KB" % (
+            count,
+            os.path.getsize(state_file) // 1024,
+            os.path.getsize(state_file + ".snapshot") // 1024,
+        )
+        for name, snapshot in [("json", False), ("snapshot", True)]:
+            best = None
+            for i in range(3):
+                loader = Balancer(None, None, None, state_file, state_snapshot=snapshot)
+                start = time.time()
+                loader.load()
+                taken = time.time() - start
+                assert len(loader.hosts) == count
+                best = taken if best is None else min(best, taken)
+            print "%-10s %8.1f ms" % (name, best * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
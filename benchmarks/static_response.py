@@ -0,0 +1,63 @@
+"""
+Compares sending the unknown static response from memory with the
+original open() + fstat() + sendfile() of its file on every request.
+
+Run with: python benchmarks/static_response.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mantrid.actions import Static, Unknown
+
+
+class Balancer(object):
+    static_dir = "/nonexistent/"
+
+
+class DevNullSocket(object):
+    "A real file descriptor to sendfile() to, that discards everything"
+
+    def __init__(self):
+        self.fh = open(os.devnull, "w")
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def sendall(self, data):
+        os.write(self.fh.fileno(), data)
+
+    def close(self):
+        pass
+
+
+def legacy(balancer, sock):
+    "Static.handle before responses were kept in memory"
+    try:
+        fh = open(os.path.join(balancer.static_dir, "unknown.http"))
+    except IOError:
+        fh = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mantrid", "static", "unknown.http"))
+    try:
+        Static._sendfile(sock.fileno(), fh.fileno(), 0, os.fstat(fh.fileno()).st_size)
+    except (TypeError, AttributeError):
+        sock.sendall(fh.read())
+    fh.close()
+    sock.close()
+
+
+def main():
+    balancer = Balancer()
+    sock = DevNullSocket()
+    action = Unknown(balancer, "example.com", "unknown")
+    number = 20000
+    old = min(timeit.Timer(lambda: legacy(balancer, sock)).repeat(3, number)) * 1000000.0 / number
+    new = min(timeit.Timer(lambda: action.handle(sock, "", "/", {})).repeat(3, number)) * 1000000.0 / number
+    print "%-28s %6.2f us/request" % ("open + fstat + sendfile", old)
+    print "%-28s %6.2f us/request (%.1fx)" % ("preloaded sendall", new, old / new)
+
+
+if __name__ == "__main__":
+    main()
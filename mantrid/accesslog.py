@@ -0,0 +1,162 @@
+"""
+The access log: one JSON object per line for each request handled.
+
+Requests only append a tuple to an in-memory buffer; a separate
+greenthread hands the buffer to one of eventlet's tpool threads every
+flush_interval seconds, which formats and writes it out in one go, so
+neither requests nor the hub ever wait on the disk. Entries arriving
+while a slow disk holds up the writing are dropped, and counted, once
+too many are waiting.
+"""
+
+import errno
+import json
+import logging
+import os
+import random
+import time
+
+import eventlet
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+
+# The fields of each buffered entry, in order
+fields = (
+    "time",
+    "duration",
+    "request_id",
+    "client",
+    "method",
+    "path",
+    "host",
+    "matched_host",
+    "backend",
+    "response_start",
+    "bytes_sent",
+    "bytes_received",
+    "first_byte",
+)
+
+
+class AccessLog(object):
+    """
+    Buffered writer of access log entries to path.
+
+    If sample is less than 1, only that fraction of requests are logged.
+    If max_bytes is non-zero, the file is rotated to path.1 (and so on,
+    keeping backups old files) once it gets bigger than that; writers
+    with rotate set to False don't rotate, but notice when some other
+    process has and start on the new file. Dropped entries are counted
+    in metrics, if given, as well as in dropped.
+    """
+
+    flush_interval = 1
+    # Entries beyond this many waiting to be written are dropped
+    max_buffered = 100000
+
+    def __init__(self, path, sample=1.0, max_bytes=0, backups=5, rotate=True, metrics=None):
+        self.path = path
+        self.sample = sample
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.rotate = rotate
+        self.metrics = metrics
+        self.buffer = []
+        self.dropped = 0
+        self.fh = None
+        # Held while writing, so batches go out in order and the file
+        # isn't closed under a write
+        self.write_lock = Semaphore()
+
+    def record(self, entry):
+        "Queues an entry (a tuple of fields) to be written"
+        if self.sample < 1 and random.random() >= self.sample:
+            return
+        if len(self.buffer) >= self.max_buffered:
+            self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.increment("mantrid_access_log_dropped_total", ())
+            return
+        self.buffer.append(entry)
+
+    def run(self):
+        "Writes out the buffered entries every flush_interval"
+        while True:
+            eventlet.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except (IOError, OSError), e:
+                logging.error("Cannot write access log %s: %s", self.path, e)
+
+    def flush(self):
+        "Writes out all the buffered entries, in a thread"
+        with self.write_lock:
+            entries, self.buffer = self.buffer, []
+            if self.dropped:
+                logging.warn("Access log buffer full; dropped %i entries", self.dropped)
+                self.dropped = 0
+            tpool.execute(self.write, entries)
+
+    def write(self, entries):
+        "Rotates the file if it is full, then writes entries to it"
+        if self.rotate and self.max_bytes:
+            self.rotate_if_full()
+        if not entries:
+            return
+        self.reopen_if_moved()
+        self.fh.write("".join(format_entry(entry) for entry in entries))
+        self.fh.flush()
+
+    def reopen_if_moved(self):
+        "Opens the log file, or reopens it if it has been rotated away"
+        if self.fh is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.fh.fileno()).st_ino:
+                    return
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self.fh.close()
+        self.fh = open(self.path, "a")
+
+    def rotate_if_full(self):
+        try:
+            if os.path.getsize(self.path) < self.max_bytes:
+                return
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%i" % (self.path, i)):
+                os.rename("%s.%i" % (self.path, i), "%s.%i" % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, "%s.1" % self.path)
+        else:
+            os.unlink(self.path)
+        self.reopen_if_moved()
+
+    def close(self):
+        with self.write_lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+
+def format_entry(entry):
+    "Returns the log line for a buffered entry"
+    values = dict(zip(fields, entry))
+    values["time"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(values["time"])) + ".%03iZ" % (values["time"] % 1 * 1000)
+    values["duration"] = round(values["duration"], 6)
+    if values["first_byte"] is not None:
+        values["first_byte"] = round(values["first_byte"], 6)
+    if values["backend"] is not None:
+        values["backend"] = "%s:%s" % (values["backend"].host, values["backend"].port)
+    # The status is only known if the response went out through Python
+    response_start = values.pop("response_start")
+    values["status"] = None
+    if response_start and response_start.startswith("HTTP/"):
+        words = response_start.split(None, 2)
+        if len(words) > 1 and words[1].isdigit():
+            values["status"] = int(words[1])
+    return json.dumps(values, sort_keys=True) + "\n"
@@ -7,21 +7,45 @@ import logging
 import operator
 import os
 import random
+import time
 
 import eventlet
+from eventlet.event import Event
 from eventlet.green import socket
 from eventlet.timeout import Timeout
 from httplib import responses
 
-from mantrid.backend import Backend
+from mantrid.algorithms import NoHealthyBackends, algorithm_mapping
+from mantrid.backend import Backend, BackendGroup
+from mantrid.cache import TeeSocket, cache_directives, cacheable_response
+from mantrid.mirror import RecordingSocket
+from mantrid.framing import BufferedSocket, FramingError, MessageHead, body_framing, read_head, relay_chunked, relay_length, relay_until_close, split_head
 from mantrid.socketmeld import SocketMelder
+from mantrid.static_responses import static_responses
+from mantrid.stats import HostCounters
+
+def request_has_body(headers):
+    """
+    Returns True if a request has a body. Actions that answer without
+    reading it must close the connection afterwards, or the body would
+    be read as the next request.
+    """
+    if headers.get("Transfer-Encoding") is not None:
+        return True
+    return (headers.get("Content-Length") or "0").strip().lstrip("0") != ""
 
-class NoHealthyBackends(Exception):
-    "Poll of usable backends is empty"
-    pass
 
 class Action(object):
-    "Base action. Doesn't do anything."
+    """
+    Base action. Doesn't do anything.
+
+    Actions that can leave the client connection usable for another
+    request set supports_keepalive; their handle() is then passed
+    keepalive=True when the client asked for it, and returns True if
+    the connection can be reused.
+    """
+
+    supports_keepalive = False
 
     def __init__(self, balancer, host, matched_host):
         self.host = host
@@ -36,18 +60,31 @@ class Empty(Action):
     "Sends a code-only HTTP response"
 
     code = None
+    supports_keepalive = True
 
     def __init__(self, balancer, host, matched_host, code):
         super(Empty, self).__init__(balancer, host, matched_host)
         self.code = code
+        # The response to send, indexed by keepalive
+        self.responses = tuple(
+            "HTTP/1.0 %s %s\r\nConnection: %s\r\nContent-length: 0\r\n\r\n" % (
+                self.code,
+                responses.get(self.code, "Unknown"),
+                connection,
+            )
+            for connection in ("close", "keep-alive")
+        )
 
-    def handle(self, sock, read_data, path, headers):
+    def handle(self, sock, read_data, path, headers, keepalive=False):
         "Sends back a static error page."
+        keepalive = keepalive and not request_has_body(headers)
         try:
-            sock.sendall("HTTP/1.0 %s %s\r\nConnection: close\r\nContent-length: 0\r\n\r\n" % (self.code, responses.get(self.code, "Unknown")))
+            sock.sendall(self.responses[bool(keepalive)])
         except socket.error, e:
             if e.errno != errno.EPIPE:
                 raise
+            return False
+        return keepalive
 
 
 class Static(Action):
@@ -73,18 +110,17 @@ class Static(Action):
         "Sends back a static error page."
         assert self.type is not None
         try:
-            # Get the correct file
-            try:
-                fh = open(os.path.join(self.balancer.static_dir, "%s.http" % self.type))
-            except IOError:
-                fh = open(os.path.join(os.path.dirname(__file__), "static", "%s.http" % self.type))
-            # Send it, using sendfile if poss. (no fileno() means we're probably using mock sockets)
-            try:
-                self._sendfile(sock.fileno(), fh.fileno(), 0, os.fstat(fh.fileno()).st_size)
-            except (TypeError, AttributeError):
-                sock.sendall(fh.read())
-            # Close the file and socket
-            fh.close()
+            response = static_responses.get(self.balancer.static_dir, self.type)
+            if response.data is not None:
+                sock.sendall(response.data)
+            else:
+                # Too big to keep in memory; send it, using sendfile if
+                # poss. (no fileno() means we're probably using mock sockets)
+                with open(response.path) as fh:
+                    try:
+                        self._sendfile(sock.fileno(), fh.fileno(), 0, os.fstat(fh.fileno()).st_size)
+                    except (TypeError, AttributeError):
+                        sock.sendall(fh.read())
             sock.close()
         except socket.error, e:
             if e.errno != errno.EPIPE:
@@ -111,21 +147,21 @@ class Redirect(Action):
     def __init__(self, balancer, host, matched_host, redirect_to):
         super(Redirect, self).__init__(balancer, host, matched_host)
         self.redirect_to = redirect_to
+        # The response up to the path, for plain and secure requests
+        if "://" not in self.redirect_to:
+            destinations = ["http%s://%s" % (s, self.redirect_to) for s in ("", "s")]
+        else:
+            destinations = [self.redirect_to] * 2
+        self.prefixes = tuple(
+            "HTTP/1.0 302 Found\r\nLocation: %s/" % destination.rstrip("/")
+            for destination in destinations
+        )
 
     def handle(self, sock, read_data, path, headers):
         "Sends back a static error page."
-        if "://" not in self.redirect_to:
-            destination = "http%s://%s" % (
-                "s" if headers.get('X-Forwarded-Protocol', headers.get('X-Forwarded-Proto', "")).lower() in ("https", "ssl") else "",
-                self.redirect_to
-            )
-        else:
-            destination = self.redirect_to
+        secure = headers.get('X-Forwarded-Protocol', headers.get('X-Forwarded-Proto', "")).lower() in ("https", "ssl")
         try:
-            sock.sendall("HTTP/1.0 302 Found\r\nLocation: %s/%s\r\n\r\n" % (
-                destination.rstrip("/"),
-                path.lstrip("/"),
-            ))
+            sock.sendall("%s%s\r\n\r\n" % (self.prefixes[secure], path.lstrip("/")))
         except socket.error, e:
             if e.errno != errno.EPIPE:
                 raise
@@ -138,54 +174,101 @@ class Proxy(Action):
     delay = 1
     default_healthcheck = True
     default_algorithm = "least_connections"
+    algorithm_mapping = algorithm_mapping
     connection_timeout_seconds = 2
+    supports_keepalive = True
 
-    def __init__(self, balancer, host, matched_host, backends, attempts=None, delay=None, algorithm=default_algorithm, healthcheck=default_healthcheck):
+    def __init__(self, balancer, host, matched_host, backends, attempts=None, delay=None, algorithm=default_algorithm, healthcheck=default_healthcheck, healthcheck_path=None, healthcheck_status=None, hash_header=None):
         super(Proxy, self).__init__(balancer, host, matched_host)
         self.host = host
         self.backends = backends
         self.algorithm = algorithm
         self.healthcheck = healthcheck
-        self.select_backend = self.random if algorithm == 'random' else self.least_connections
+        # healthcheck_path and healthcheck_status are used by HealthChecker
+        self.hash_header = hash_header
         assert self.backends
+        self._selector = None
+        # Metric labels and histograms, found once rather than on every request
+        self.host_labels = (("host", matched_host), )
+        self.backend_labels = {}
+        self.backend_histograms = {}
         if attempts is not None:
             self.attempts = int(attempts)
         if delay is not None:
             self.delay = float(delay)
 
-    def valid_backends(self):
-        return [b for b in self.backends if not b.blacklisted or not self.healthcheck]
-
-    def random(self):
-        return random.choice(self.valid_backends())
-
-    def least_connections(self):
-        backends = self.valid_backends()
-        
-        try:
-            min_connections = min(b.connections for b in backends)
-        except ValueError:
-            raise NoHealthyBackends()
-
-        # this is possibly a little bit safer than always returning the first backend
-        return random.choice([b for b in backends if b.connections == min_connections])
+    @property
+    def selector(self):
+        "The algorithm instance, made when the first request needs it"
+        if self._selector is None:
+            algorithm = self.algorithm_mapping.get(self.algorithm)
+            if algorithm is None:
+                # Only the REST API checks names; a state file can still
+                # name one that is unknown (or no longer exists)
+                logging.warn("Unknown algorithm %r for %s; using %s", self.algorithm, self.host, self.default_algorithm)
+                algorithm = self.algorithm_mapping[self.default_algorithm]
+            # Actions for every hostname a host entry matches share one,
+            # kept with the entry's backends
+            group = BackendGroup.of(self.backends, self.healthcheck)
+            key = (algorithm, self.hash_header)
+            self._selector = group.selectors.get(key)
+            if self._selector is None:
+                self._selector = group.selectors[key] = algorithm(self)
+        return self._selector
 
-    def handle(self, sock, read_data, path, headers):
-        request_id = headers.get("X-Request-Id", "-")
+    def valid_backends(self):
+        return self.selector.valid_backends()
+
+    def labels(self, backend):
+        "Returns the metric labels for requests to backend"
+        labels = self.backend_labels.get(backend)
+        if labels is None:
+            labels = self.backend_labels[backend] = self.host_labels + (("backend", "%s:%s" % (backend.host, backend.port)), )
+        return labels
+
+    def histograms(self, backend):
+        "Returns the (connect, first byte, request) histograms for backend"
+        histograms = self.backend_histograms.get(backend)
+        if histograms is None:
+            labels = self.labels(backend)
+            histograms = self.backend_histograms[backend] = tuple(
+                self.balancer.metrics.histogram(name, labels)
+                for name in ("mantrid_backend_connect_seconds", "mantrid_backend_first_byte_seconds", "mantrid_backend_request_seconds")
+            )
+        return histograms
+
+    def select_backend(self, headers):
+        "Picks a backend for the request using the host's algorithm"
+        return self.selector.select(headers)
+
+    def connect(self, request_id, headers, pooled=False):
+        """
+        Picks a backend and connects to it, retrying on failure.
+        Returns (backend, socket, reused), where reused says if the
+        socket is a keep-alive connection from the backend's pool.
+        """
         for attempt in range(self.attempts):
             if attempt > 0:
                 logging.warn("[%s] Retrying connection for host %s", request_id, self.host)
-
-            backend = self.select_backend()
+                self.balancer.metrics.increment("mantrid_backend_retries_total", self.host_labels)
+
+            backend = self.select_backend(headers)
+            if pooled:
+                server_sock = backend.pool.get(self.balancer.backend_pool_idle_timeout)
+                if server_sock is not None:
+                    backend.add_connection()
+                    return backend, server_sock, True
             try:
+                start = time.time()
                 timeout = Timeout(self.connection_timeout_seconds)
                 try:
                     server_sock = eventlet.connect((backend.host, backend.port))
                 finally:
                     timeout.cancel()
 
+                self.histograms(backend)[0].observe(time.time() - start)
                 backend.add_connection()
-                break
+                return backend, server_sock, False
             except socket.error:
                 logging.error("[%s] Proxy socket error on connect() to %s of %s", request_id, backend, self.host)
                 self.blacklist(backend)
@@ -193,30 +276,437 @@ class Proxy(Action):
                 continue
             except:
                 logging.warn("[%s] Proxy timeout on connect() to %s of %s", request_id, backend, self.host)
+                self.balancer.metrics.increment("mantrid_backend_timeouts_total", self.labels(backend))
                 self.blacklist(backend)
                 eventlet.sleep(self.delay)
                 continue
+        raise NoHealthyBackends()
+
+    def handle(self, sock, read_data, path, headers, keepalive=False):
+        request_id = headers.get("X-Request-Id", "-")
+        if keepalive or self.balancer.backend_pool_size:
+            method = read_data.split(" ", 1)[0].upper()
+            length = self.request_length(method, headers)
+            if length is not None:
+                return self.handle_framed(sock, read_data, headers, request_id, method, length, keepalive)
+
+        backend, server_sock, reused = self.connect(request_id, headers)
 
         # Function to help track data usage
         def send_onwards(data):
             server_sock.sendall(data)
             return len(data)
 
+        start = time.time()
+        melder = self.melder(sock, server_sock, backend)
         try:
             size = send_onwards(read_data)
-            size += SocketMelder(sock, server_sock, backend, self.host).run()
+            size += melder.run()
         except socket.error, e:
             if e.errno != errno.EPIPE:
                 raise
         finally:
             backend.drop_connection()
+            self.record(headers, backend, start, melder.first_byte_time, melder.timed_out, melder.timeout_response_sent)
+
+    def melder(self, sock, server_sock, backend, framed=False):
+        """
+        Returns a SocketMelder with the balancer's relay settings. Framed
+        requests don't run theirs, but pass what they relay through its
+        moved() for the rate limit, and are listed in /sessions/ by it.
+        """
+        return SocketMelder(
+            sock,
+            server_sock,
+            backend,
+            self.host,
+            splice = self.balancer.splice and not framed,
+            buffer_size = self.balancer.relay_buffer_size,
+            idle_timeout = self.balancer.relay_idle_timeout,
+            rate_limit = self.balancer.relay_rate_limit,
+            high_watermark = self.balancer.relay_high_watermark,
+            low_watermark = self.balancer.relay_low_watermark,
+            sessions = self.balancer.sessions,
+        )
+
+    def record(self, headers, backend, start, first_byte_time, timed_out, timeout_response_sent):
+        "Records the metrics of one request to backend"
+        connect, first_byte, request = self.histograms(backend)
+        request.observe(time.time() - start)
+        headers.backend = backend
+        if first_byte_time is not None:
+            first_byte.observe(first_byte_time - start)
+            headers.first_byte = first_byte_time - start
+        if timed_out:
+            self.balancer.metrics.increment("mantrid_backend_timeouts_total", self.labels(backend))
+        if timeout_response_sent:
+            self.balancer.metrics.increment("mantrid_responses_total", self.host_labels + (("code", "594"), ))
+
+    def request_length(self, method, headers):
+        """
+        Returns the length of the request body, "chunked" for a chunked
+        body, or None if the request can't be relayed with framing
+        (upgrades, unknown lengths).
+        """
+        if method == "CONNECT" or "Upgrade" in headers:
+            return None
+        if "Transfer-Encoding" in headers:
+            if headers["Transfer-Encoding"].split(",")[-1].strip().lower() == "chunked":
+                return "chunked"
+            return None
+        try:
+            length = int(headers.get("Content-Length") or 0)
+        except ValueError:
+            return None
+        if length < 0:
+            return None
+        return length
+
+    def handle_framed(self, sock, read_data, headers, request_id, method, length, keepalive=False):
+        """
+        Sends the request and relays back exactly one response, reading
+        the framing of both so that the backend connection can be
+        returned to its pool and the client connection used again.
+        Returns True if the client connection can be reused.
+        """
+        pooled = bool(self.balancer.backend_pool_size)
+        head, body = split_head(read_data)
+        request = MessageHead(head)
+        request.set("Connection", "keep-alive" if pooled else "close")
+        if length == "chunked":
+            # Chunks are passed on as they arrive from the client
+            request_data = str(request)
+            remaining = None
+        else:
+            body = body[:length]
+            request_data = str(request) + body
+            remaining = length - len(body)
+        # A pooled connection may have been closed by the backend just as
+        # we picked it up; if nothing has been read from the client yet,
+        # try again on a fresh connection.
+        chunk = self.balancer.relay_buffer_size
+        for attempt in range(2):
+            backend, server_sock, reused = self.connect(request_id, headers, pooled=(pooled and attempt == 0))
+            server = BufferedSocket(server_sock)
+            sender = None
+            head_error = None
+            start = time.time()
+            melder = self.melder(sock, server_sock, backend, framed=True)
+            to_backend = lambda length: melder.moved(False, length)
+            to_client = lambda length: melder.moved(True, length)
+            melder.sessions.add(melder)
+            # Give up once the backend has made no progress for a while
+            server_sock.settimeout(self.balancer.relay_idle_timeout)
+            try:
+                server.sendall(request_data)
+                to_backend(len(request_data))
+                if remaining is None:
+                    sender = eventlet.spawn(relay_chunked, sock, server_sock, chunk, to_backend)
+                elif remaining:
+                    sender = eventlet.spawn(relay_length, sock, server_sock, remaining, chunk, to_backend)
+                raw_head = read_head(server)
+                first_byte_time = time.time()
+            except socket.timeout, e:
+                # Answered with a 594 below; the backend may still be
+                # working on the request, so it isn't sent again.
+                head_error = e
+                raw_head = None
+            except (socket.error, FramingError), e:
+                # Answered with a 502 below, unless we can try again
+                if not (reused and sender is None):
+                    head_error = e
+                raw_head = None
+            if raw_head is None and reused and sender is None and head_error is None:
+                melder.sessions.discard(melder)
+                backend.drop_connection()
+                server_sock.close()
+                continue
+            break
+
+        reusable = False
+        completed = False
+        responded = False
+        timed_out = False
+        timeout_response_sent = False
+        # Give up once either side has made no progress for a while
+        sock.settimeout(self.balancer.relay_idle_timeout)
+        try:
+            if head_error is not None:
+                raise head_error
+            if raw_head is None:
+                raise FramingError("closed_before_response")
+            response = MessageHead(raw_head)
+            # Pass on interim responses (100 Continue) before the real one
+            while 100 <= response.status < 200 and response.status != 101:
+                sock.sendall(raw_head + "\r\n\r\n")
+                to_client(len(raw_head) + 4)
+                responded = True
+                raw_head = read_head(server)
+                if raw_head is None:
+                    raise FramingError("closed_before_response")
+                response = MessageHead(raw_head)
+            framing, size = body_framing(response, method)
+            keep_alive = response.keep_alive()
+            keepalive = keepalive and framing != "close"
+            response.set("Connection", "keep-alive" if keepalive else "close")
+            response.remove("Keep-Alive")
+            response_head = str(response)
+            sock.sendall(response_head)
+            to_client(len(response_head))
+            responded = True
+            if framing == "length":
+                relay_length(server, sock, size, chunk, to_client)
+            elif framing == "chunked":
+                relay_chunked(server, sock, chunk, to_client)
+            elif framing == "close":
+                relay_until_close(server, sock, chunk, to_client)
+            # Only reuse the connection if the request went out in full
+            # and nothing unexpected followed the response.
+            reusable = keep_alive and framing != "close" and not server.buffer
+            completed = True
+            if sender is not None:
+                if sender.dead:
+                    sender.wait()
+                else:
+                    reusable = completed = False
+        except socket.timeout:
+            timed_out = True
+            if not responded:
+                timeout_response_sent = True
+                sock.sendall("HTTP/1.0 594 Backend timeout\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+            logging.warn("[%s] Timeout serving request to backend %s of %s", request_id, backend, self.host)
+            reusable = False
+        except FramingError, e:
+            logging.warn("[%s] Bad response framing from backend %s of %s: %s", request_id, backend, self.host, e)
+            reusable = False
+            if not responded:
+                self.bad_gateway(sock)
+        except socket.error, e:
+            reusable = False
+            if e is head_error:
+                logging.warn("[%s] Error sending request to backend %s of %s: %s", request_id, backend, self.host, e)
+                self.bad_gateway(sock)
+            elif e.errno != errno.EPIPE:
+                raise
+        finally:
+            melder.sessions.discard(melder)
+            sock.settimeout(None)
+            server_sock.settimeout(None)
+            if sender is not None:
+                sender.kill()
+            backend.drop_connection()
+            if reusable and not (backend.retired or backend.draining):
+                backend.pool.put(server_sock, self.balancer.backend_pool_size, self.balancer.backend_pool_idle_timeout)
+            else:
+                server_sock.close()
+            self.record(headers, backend, start, first_byte_time if raw_head is not None else None, timed_out, timeout_response_sent)
+        return keepalive and completed
+
+    def bad_gateway(self, sock):
+        "Answers a request the backend closed or broke without responding to"
+        self.balancer.metrics.increment("mantrid_responses_total", self.host_labels + (("code", "502"), ))
+        sock.sendall("HTTP/1.0 502 Bad Gateway\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
 
     def blacklist(self, backend):
         if self.healthcheck and not backend.blacklisted:
             logging.warn("Blacklisting backend %s of %s", backend, self.host)
+            self.balancer.metrics.increment("mantrid_backend_blacklists_total", self.labels(backend))
             backend.blacklisted = True
 
 
+class Cache(Action):
+    """
+    Proxies requests like Proxy, but keeps responses to GETs that their
+    Cache-Control or Expires headers allow, and answers later requests
+    for them from memory (or from disk, if disk_dir is set).
+
+    Concurrent requests for something not yet cached wait for the first
+    one's response rather than all going to the backends. Responses are
+    keyed on the protocol, hostname, path and Accept-Encoding.
+    """
+
+    supports_keepalive = True
+    algorithm_mapping = Proxy.algorithm_mapping
+    default_algorithm = Proxy.default_algorithm
+    max_bytes = 64 * 1024 * 1024
+    max_object_bytes = 1024 * 1024
+    ttl = 0
+    disk_max_bytes = 1024 * 1024 * 1024
+
+    def __init__(self, balancer, host, matched_host, backends, max_bytes=None, max_object_bytes=None, ttl=None, disk_dir=None, disk_max_bytes=None, **kwargs):
+        super(Cache, self).__init__(balancer, host, matched_host)
+        self.proxy = Proxy(balancer, host, matched_host, backends, **kwargs)
+        self.backends = self.proxy.backends
+        if max_bytes is not None:
+            self.max_bytes = int(max_bytes)
+        if max_object_bytes is not None:
+            self.max_object_bytes = int(max_object_bytes)
+        if ttl is not None:
+            self.ttl = int(ttl)
+        if disk_max_bytes is not None:
+            self.disk_max_bytes = int(disk_max_bytes)
+        self.cache = balancer.response_cache(matched_host, self.max_bytes, self.max_object_bytes, disk_dir, self.disk_max_bytes)
+
+    @classmethod
+    def options_errors(cls, options):
+        "Returns an error string if the cache options are invalid"
+        for name in ("max_bytes", "max_object_bytes", "ttl", "disk_max_bytes"):
+            if name in options:
+                try:
+                    if int(options[name]) < 0:
+                        return "host_%s_invalid" % name
+                except (TypeError, ValueError):
+                    return "host_%s_invalid" % name
+        if options.get("disk_dir") is not None and not isinstance(options["disk_dir"], basestring):
+            return "host_disk_dir_invalid"
+        return None
+
+    def valid_backends(self):
+        return self.proxy.valid_backends()
+
+    def cacheable_request(self, headers):
+        "Returns True if the request can be answered from the cache"
+        if headers.method not in ("GET", "HEAD"):
+            return False
+        for name in ("Authorization", "Range", "Upgrade"):
+            if name in headers:
+                return False
+        return not request_has_body(headers)
+
+    def handle(self, sock, read_data, path, headers, keepalive=False):
+        directives = cache_directives(headers.get("Cache-Control"))
+        if "no-store" in directives or not self.cacheable_request(headers):
+            return self.proxy.handle(sock, read_data, path, headers, keepalive=keepalive)
+        counters = self.balancer.counters.get(self.matched_host)
+        if counters is None:
+            counters = self.balancer.counters[self.matched_host] = HostCounters()
+        # Responses such as redirects to https differ by protocol
+        secure = headers.get('X-Forwarded-Protocol', headers.get('X-Forwarded-Proto', "")).lower() in ("https", "ssl")
+        key = (secure, self.host, path, headers.get("Accept-Encoding", ""))
+        # Clients can ask for a fresh copy, which then replaces ours
+        if not ("no-cache" in directives or headers.get("Pragma") == "no-cache"):
+            entry = self.cache.get(key)
+            if entry is None and key in self.cache.pending:
+                entry = self.cache.pending[key].wait()
+            if entry is not None:
+                counters.cache_hits += 1
+                try:
+                    sock.sendall(entry.render(time.time(), keepalive, headers.method != "HEAD"))
+                except socket.error, e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                    return False
+                return keepalive
+        counters.cache_misses += 1
+        if headers.method == "HEAD" or key in self.cache.pending:
+            return self.proxy.handle(sock, read_data, path, headers, keepalive=keepalive)
+        return self.fetch(sock, read_data, headers, key, keepalive)
+
+    def fetch(self, sock, read_data, headers, key, keepalive=False):
+        """
+        Proxies the request, storing the response if it can be, and gives
+        it to any other requests for the same key that arrive meanwhile.
+        """
+        waiting = self.cache.pending[key] = Event()
+        entry = None
+        try:
+            # Responses are copied as they are relayed; the head may be
+            # up to read_head()'s limit on top of the body.
+            tee = TeeSocket(sock, self.cache.max_object_bytes + 65536)
+            reusable = self.proxy.handle_framed(tee, read_data, headers, headers.get("X-Request-Id", "-"), "GET", 0, keepalive)
+            if tee.data is not None:
+                entry = cacheable_response(tee.data, time.time(), self.ttl)
+                if entry is not None:
+                    self.cache.put(key, entry)
+            return reusable
+        finally:
+            del self.cache.pending[key]
+            waiting.send(entry)
+
+
+class Mirror(Action):
+    """
+    Proxies requests like Proxy, and also sends a copy of each to every
+    one of its mirrors, throwing away their responses.
+
+    Copies are only queued once the real request has been answered, and
+    each mirror has a bounded queue (see MirrorTarget), so mirrors never
+    slow down the real requests. Requests with bodies bigger than
+    max_body_bytes, or that are chunked or upgraded, aren't copied.
+    """
+
+    supports_keepalive = True
+    algorithm_mapping = Proxy.algorithm_mapping
+    default_algorithm = Proxy.default_algorithm
+    max_queued = 100
+    concurrency = 10
+    timeout = 5
+    max_body_bytes = 65536
+    sample = 1.0
+
+    def __init__(self, balancer, host, matched_host, backends, mirrors, max_queued=None, concurrency=None, timeout=None, max_body_bytes=None, sample=None, **kwargs):
+        super(Mirror, self).__init__(balancer, host, matched_host)
+        self.proxy = Proxy(balancer, host, matched_host, backends, **kwargs)
+        self.backends = self.proxy.backends
+        if max_queued is not None:
+            self.max_queued = int(max_queued)
+        if concurrency is not None:
+            self.concurrency = int(concurrency)
+        if timeout is not None:
+            self.timeout = float(timeout)
+        if max_body_bytes is not None:
+            self.max_body_bytes = int(max_body_bytes)
+        if sample is not None:
+            self.sample = float(sample)
+        self.targets = [
+            balancer.mirror_target((mirror.host, mirror.port), self.max_queued, self.concurrency, self.timeout)
+            for mirror in mirrors
+        ]
+
+    @classmethod
+    def options_errors(cls, options):
+        "Returns an error string if the mirror options are invalid"
+        mirrors = options.get("mirrors")
+        if not isinstance(mirrors, list) or not mirrors or not all(isinstance(mirror, Backend) for mirror in mirrors):
+            return "host_mirrors_invalid"
+        for name, convert, valid in [
+            ("max_queued", int, lambda value: value >= 1),
+            ("concurrency", int, lambda value: value >= 1),
+            ("timeout", float, lambda value: value > 0),
+            ("max_body_bytes", int, lambda value: value >= 0),
+            ("sample", float, lambda value: 0 <= value <= 1),
+        ]:
+            if name in options:
+                try:
+                    if not valid(convert(options[name])):
+                        return "host_%s_invalid" % name
+                except (TypeError, ValueError):
+                    return "host_%s_invalid" % name
+        return None
+
+    def valid_backends(self):
+        return self.proxy.valid_backends()
+
+    def handle(self, sock, read_data, path, headers, keepalive=False):
+        length = self.proxy.request_length(headers.method, headers)
+        if length is None or length == "chunked" or length > self.max_body_bytes or (self.sample < 1 and random.random() >= self.sample):
+            return self.proxy.handle(sock, read_data, path, headers, keepalive=keepalive)
+        head, body = split_head(read_data)
+        body = body[:length]
+        # The rest of the body is copied as it is relayed
+        recorder = RecordingSocket(sock, length - len(body))
+        reusable = self.proxy.handle_framed(recorder, read_data, headers, headers.get("X-Request-Id", "-"), headers.method, length, keepalive)
+        if recorder.complete:
+            request = MessageHead(head)
+            request.set("Connection", "close")
+            request.remove("Keep-Alive")
+            request.remove("Expect")
+            data = str(request) + body + recorder.data
+            for target in self.targets:
+                target.put(data)
+        return reusable
+
+
 class Spin(Action):
     """
     Just holds the request open until either the timeout expires, or
@@ -259,6 +749,7 @@ class Alias(Action):
         action, kwargs, allow_subs = self.balancer.hosts[self.hostname]
         action_class = self.balancer.action_mapping[action]
         self.aliased = action_class(balancer = self.balancer, host = self.host, matched_host = self.matched_host, **kwargs)
+        self.supports_keepalive = self.aliased.supports_keepalive
 
     def handle(self, **kwargs):
         return self.aliased.handle(**kwargs)
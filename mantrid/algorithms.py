@@ -0,0 +1,195 @@
+"""
+Backend selection algorithms for the proxy action.
+"""
+
+import bisect
+import hashlib
+import random
+import struct
+
+from mantrid.backend import BackendGroup
+
+
+class NoHealthyBackends(Exception):
+    "Poll of usable backends is empty"
+    pass
+
+
+class Algorithm(object):
+    """
+    Base algorithm. Chooses a backend for each request from a Proxy's
+    backends, skipping blacklisted ones if the proxy is health checked.
+
+    The usable backends are tracked by a BackendGroup shared by every
+    action built from the same host entry.
+    """
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.backends = proxy.backends
+        self.healthcheck = proxy.healthcheck
+        self.group = BackendGroup.of(self.backends, self.healthcheck)
+
+    @classmethod
+    def options_errors(cls, options):
+        """
+        Validates the host options this algorithm uses.
+        Returns an error string, or None if they are valid.
+        """
+        return None
+
+    def usable(self, backend):
+        return backend in self.group.healthy
+
+    def valid_backends(self):
+        return list(self.group.healthy)
+
+    def least_connected(self):
+        "Returns one of the usable backends with the fewest open connections"
+        # Picking at random among them is possibly a little bit safer
+        # than always returning the first backend
+        backend = self.group.least_connected()
+        if backend is None:
+            raise NoHealthyBackends()
+        return backend
+
+    def select(self, headers):
+        "Returns a backend for a request with the given headers"
+        raise NotImplementedError()
+
+
+class Random(Algorithm):
+    "Picks any usable backend."
+
+    def select(self, headers):
+        backend = self.group.any()
+        if backend is None:
+            raise NoHealthyBackends()
+        return backend
+
+
+class LeastConnections(Algorithm):
+    "Picks one of the usable backends with the fewest open connections."
+
+    def select(self, headers):
+        return self.least_connected()
+
+
+class PowerOfTwoChoices(Algorithm):
+    """
+    Picks two usable backends at random and uses the one with fewer open
+    connections; spreads load like least_connections, but without sending
+    every new request to the same idle backend.
+    """
+
+    def select(self, headers):
+        first = self.group.any()
+        if first is None:
+            raise NoHealthyBackends()
+        second = self.group.any()
+        if second.connections < first.connections:
+            return second
+        return first
+
+
+class WeightedRoundRobin(Algorithm):
+    """
+    Cycles through the backends in proportion to their weights, spreading
+    each backend's turns out over the cycle (nginx's smooth weighted
+    round-robin). Each pick adds every usable backend's weight to its
+    running total, picks the biggest, and takes the total weight off that
+    one, so it costs O(backends) however big the weights are; blacklisted
+    backends just sit out until they come back.
+    """
+
+    def __init__(self, proxy):
+        super(WeightedRoundRobin, self).__init__(proxy)
+        self.current = [0] * len(self.backends)
+        # Ties go to backends in this order, which starts somewhere
+        # random so that each action doesn't begin on the same backend
+        start = random.randrange(len(self.backends)) if self.backends else 0
+        self.order = range(start, len(self.backends)) + range(start)
+
+    def select(self, headers):
+        backends = self.backends
+        current = self.current
+        best = None
+        total = 0
+        for i in self.order:
+            backend = backends[i]
+            if not self.usable(backend):
+                continue
+            current[i] += backend.weight
+            total += backend.weight
+            if best is None or current[i] > current[best]:
+                best = i
+        if best is None:
+            raise NoHealthyBackends()
+        current[best] -= total
+        return backends[best]
+
+
+class ConsistentHash(Algorithm):
+    """
+    Ketama-style consistent hashing: each backend gets points on a ring
+    in proportion to its weight, and requests go to the first usable
+    backend after the hash of their key. The key is the hash_header
+    header if the host sets one, otherwise the client's IP address.
+    Adding or removing a backend only moves the keys nearest to it.
+    """
+
+    points_per_weight = 40
+    # Building the ring takes one MD5 digest per four points; past this
+    # many, every backend gets proportionally fewer
+    max_digests = 5000
+
+    def __init__(self, proxy):
+        super(ConsistentHash, self).__init__(proxy)
+        self.header = proxy.hash_header
+        digests = self.points_per_weight * sum(backend.weight for backend in self.backends)
+        scale = min(1.0, self.max_digests / float(digests or 1))
+        ring = []
+        for backend in self.backends:
+            for i in range(max(1, int(self.points_per_weight * backend.weight * scale))):
+                digest = hashlib.md5("%s:%s-%i" % (backend.host, backend.port, i)).digest()
+                # Four points from each digest, as ketama does
+                for point in struct.unpack("<4I", digest):
+                    ring.append((point, backend))
+        ring.sort(key=lambda entry: entry[0])
+        self.points = [point for point, backend in ring]
+        self.ring = [backend for point, backend in ring]
+
+    @classmethod
+    def options_errors(cls, options):
+        header = options.get("hash_header")
+        if header is not None and not (isinstance(header, basestring) and header):
+            return "host_hash_header_invalid"
+        return None
+
+    def key(self, headers):
+        if self.header:
+            value = headers.get(self.header)
+            if value is not None:
+                return value
+        # X-Forwarded-For is the client's own address on external ports
+        return headers.get("X-Forwarded-For", "").split(",")[0].strip()
+
+    def select(self, headers):
+        if not self.group.healthy:
+            raise NoHealthyBackends()
+        point = struct.unpack("<I", hashlib.md5(self.key(headers)).digest()[:4])[0]
+        start = bisect.bisect(self.points, point)
+        for i in range(len(self.ring)):
+            backend = self.ring[(start + i) % len(self.ring)]
+            if self.usable(backend):
+                return backend
+        raise NoHealthyBackends()
+
+
+algorithm_mapping = {
+    "random": Random,
+    "least_connections": LeastConnections,
+    "power_of_two": PowerOfTwoChoices,
+    "weighted_round_robin": WeightedRoundRobin,
+    "consistent_hash": ConsistentHash,
+}
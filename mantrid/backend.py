@@ -1,19 +1,205 @@
 import eventlet
 import logging
+import random
+import select
+import time
 
 from eventlet.green import socket
 from eventlet.timeout import Timeout
 
+# Open connections to each (host, port), across every Backend object for
+# it - including those retired from host entries that have since been
+# replaced, whose requests may still be running.
+address_connections = {}
+
+# Called with a Backend whenever it is blacklisted or unblacklisted, or
+# retired while blacklisted; the balancer sets this to feed its change
+# feed. Retired backends are not reported again.
+blacklist_listener = None
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections to a single backend, most recently
+    used first.
+    """
+
+    def __init__(self):
+        self.idle = []
+
+    def get(self, idle_timeout):
+        "Returns a live idle connection, or None if there isn't one."
+        now = time.time()
+        while self.idle:
+            sock, released = self.idle.pop()
+            if now - released < idle_timeout and self._alive(sock):
+                return sock
+            sock.close()
+        return None
+
+    def put(self, sock, max_idle, idle_timeout):
+        "Returns a connection to the pool, closing it if the pool is full."
+        now = time.time()
+        while self.idle and now - self.idle[0][1] >= idle_timeout:
+            self.idle.pop(0)[0].close()
+        if len(self.idle) >= max_idle:
+            sock.close()
+        else:
+            self.idle.append((sock, now))
+
+    def clear(self):
+        while self.idle:
+            self.idle.pop()[0].close()
+
+    def __len__(self):
+        return len(self.idle)
+
+    def _alive(self, sock):
+        # An idle connection has nothing to read unless the backend
+        # closed it (or sent something it shouldn't have).
+        try:
+            return not select.select([sock.fileno()], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
+
+class IndexedSet(object):
+    "A set that can also pick a random member in O(1)"
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def remove(self, item):
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        last = self.items.pop()
+        if last is not item:
+            self.items[position] = last
+            self.positions[last] = position
+
+    def choice(self):
+        return random.choice(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class BackendGroup(object):
+    """
+    The backends of a single host entry, with the usable ones kept
+    bucketed by their number of open connections, so that picking any
+    usable backend, or one of the least busy, doesn't look at them all.
+
+    Backends tell their groups whenever they are blacklisted or their
+    connection count changes. If healthcheck is False, blacklisted
+    backends stay usable, as Proxy has always done; draining backends
+    never are.
+    """
+
+    def __init__(self, backends, healthcheck=True):
+        self.backends = backends
+        self.healthcheck = healthcheck
+        self.healthy = IndexedSet()
+        self.buckets = {}
+        self.min_connections = 0
+        # Selection algorithm instances using this group, by
+        # (algorithm class, hash_header)
+        self.selectors = {}
+        for backend in backends:
+            backend.groups.append(self)
+            if self.usable(backend):
+                self._add(backend)
+
+    @classmethod
+    def of(cls, backends, healthcheck=True):
+        "Returns the group for a host's list of backends, making it if needed"
+        for group in backends[0].groups:
+            if group.backends is backends and group.healthcheck == healthcheck:
+                return group
+        return cls(backends, healthcheck)
+
+    def usable(self, backend):
+        if backend.draining:
+            return False
+        return not (self.healthcheck and backend.blacklisted)
+
+    def _add(self, backend):
+        self.healthy.add(backend)
+        connections = backend.connections
+        self.buckets.setdefault(connections, IndexedSet()).add(backend)
+        if len(self.healthy) == 1 or connections < self.min_connections:
+            self.min_connections = connections
+
+    def _remove(self, backend, connections):
+        self.healthy.remove(backend)
+        bucket = self.buckets.get(connections)
+        if bucket is None:
+            return
+        bucket.remove(backend)
+        if not bucket:
+            del self.buckets[connections]
+            if connections == self.min_connections and self.buckets:
+                self.min_connections = min(self.buckets)
+
+    def health_changed(self, backend):
+        "Called after a backend is blacklisted, drained or brought back"
+        if self.usable(backend):
+            if backend not in self.healthy:
+                self._add(backend)
+        elif backend in self.healthy:
+            self._remove(backend, backend.connections)
+
+    def connections_changed(self, backend, old):
+        "Called after a backend's open connection count changes from old"
+        if backend not in self.healthy:
+            return
+        self._remove(backend, old)
+        self._add(backend)
+
+    def any(self):
+        "Returns any usable backend, or None"
+        if not self.healthy:
+            return None
+        return self.healthy.choice()
+
+    def least_connected(self):
+        "Returns one of the usable backends with the fewest open connections, or None"
+        if not self.healthy:
+            return None
+        return self.buckets[self.min_connections].choice()
+
+
 class Backend(object):
 
+    # Selection algorithms do work in proportion to weights
+    max_weight = 1000
     healthcheck_delay_seconds = 1
     healthcheck_timeout_seconds = 1
+    # Set when something else (a HealthChecker) is probing this backend
+    checker = None
 
-    def __init__(self, address_tuple):
+    def __init__(self, address_tuple, weight=1):
         self.address_tuple = address_tuple
+        self.weight = weight
         self.active_connections = 0
         self._blacklisted = False 
+        self._draining = False
         self.retired = False
+        self.pool = ConnectionPool()
+        self.groups = []
 
     @property
     def blacklisted(self):
@@ -22,18 +208,57 @@ class Backend(object):
     @blacklisted.setter
     def blacklisted(self, value):
         if value:
-            self.start_health_check()
+            self.pool.clear()
+            if self.checker is None:
+                self.start_health_check()
+        changed = bool(value) != bool(self._blacklisted)
         self._blacklisted = value
+        for group in self.groups:
+            group.health_changed(self)
+        if changed and not self.retired and blacklist_listener is not None:
+            blacklist_listener(self)
+
+    @property
+    def draining(self):
+        "If True, the backend gets no new connections"
+        return self._draining
+
+    @draining.setter
+    def draining(self, value):
+        if value:
+            self.pool.clear()
+        self._draining = value
+        for group in self.groups:
+            group.health_changed(self)
 
     @property
     def address(self):
         return self.address_tuple
 
+    def retire(self):
+        "Marks the backend as no longer in use by its host"
+        was_retired = self.retired
+        self.retired = True
+        self.pool.clear()
+        if self.blacklisted and not was_retired and blacklist_listener is not None:
+            blacklist_listener(self)
+
     def add_connection(self):
         self.active_connections += 1
+        address = (self.host, self.port)
+        address_connections[address] = address_connections.get(address, 0) + 1
+        for group in self.groups:
+            group.connections_changed(self, self.active_connections - 1)
 
     def drop_connection(self):
         self.active_connections -= 1
+        address = (self.host, self.port)
+        if address_connections.get(address, 0) <= 1:
+            address_connections.pop(address, None)
+        else:
+            address_connections[address] -= 1
+        for group in self.groups:
+            group.connections_changed(self, self.active_connections + 1)
 
     @property
     def connections(self):
@@ -0,0 +1,366 @@
+"""
+The response cache used by the cache action.
+
+Each host entry using the cache action has a ResponseCache, kept by the
+balancer so it outlives the action objects, which are rebuilt whenever
+the host table changes. Responses are held in memory in least recently
+used order, and those pushed out can be spilled to a directory on disk
+instead of being thrown away.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import time
+from collections import OrderedDict
+from email.utils import mktime_tz, parsedate_tz
+
+from mantrid.framing import FramingError, MessageHead, split_head
+
+# Statuses whose responses can be cached
+cacheable_statuses = frozenset([200, 203, 300, 301, 404, 410])
+
+# Response headers that aren't stored; they are set again for each client
+unstored_headers = frozenset(["connection", "keep-alive", "age"])
+
+
+class CachedResponse(object):
+    """
+    A stored response: its head (the status line and headers, each line
+    ending in CRLF, but without the blank line) and body.
+    """
+
+    __slots__ = ("head", "body", "stored", "expires", "age")
+
+    def __init__(self, head, body, stored, expires, age=0):
+        self.head = head
+        self.body = body
+        self.stored = stored
+        self.expires = expires
+        # Age the response already had when we got it
+        self.age = age
+
+    @property
+    def size(self):
+        return len(self.head) + len(self.body)
+
+    def render(self, now, keepalive, include_body=True):
+        "Returns the response to send to a client"
+        return "%sAge: %i\r\nX-Cache: HIT\r\nConnection: %s\r\n\r\n%s" % (
+            self.head,
+            self.age + int(now - self.stored),
+            "keep-alive" if keepalive else "close",
+            self.body if include_body else "",
+        )
+
+
+class ResponseCache(object):
+    """
+    An LRU cache of responses, holding at most max_bytes of them in memory
+    and none bigger than max_object_bytes. If disk_dir is set, responses
+    pushed out of memory are kept there instead, up to disk_max_bytes.
+
+    pending holds an Event for each key that a request is currently
+    fetching, so other requests for it can wait for that response rather
+    than all going to the backends.
+    """
+
+    def __init__(self, max_bytes, max_object_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.disk = None
+        if disk_dir and disk_max_bytes:
+            self.disk = DiskSpill(disk_dir, disk_max_bytes)
+
+    def settings(self):
+        "Returns the arguments the cache was made with"
+        return (self.max_bytes, self.max_object_bytes, self.disk_dir, self.disk_max_bytes)
+
+    def get(self, key, now=None):
+        "Returns the fresh response stored for key, or None"
+        now = now or time.time()
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            if self.disk is None:
+                return None
+            entry = self.disk.pop(key)
+            if entry is None:
+                return None
+            if entry.expires > now:
+                # Back into memory, as it's being used again
+                self.put(key, entry)
+            return entry if entry.expires > now else None
+        if entry.expires <= now:
+            self.size -= entry.size
+            return None
+        # Re-inserting it makes it the most recently used
+        self.entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        "Stores a response, pushing out the least recently used ones to make room"
+        if entry.size > self.max_object_bytes or entry.size > self.max_bytes:
+            return
+        self.discard(key)
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.size -= old_entry.size
+            if self.disk is not None and old_entry.expires > time.time():
+                self.disk.put(old_key, old_entry)
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+        if self.disk is not None:
+            self.disk.discard(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+        if self.disk is not None:
+            self.disk.clear()
+
+
+class DiskSpill(object):
+    """
+    Responses pushed out of a ResponseCache's memory, as files in a
+    directory of this process's own under directory, so worker processes
+    sharing the directory don't see each other's. Directories left by
+    processes that have exited are removed when a new one is made.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Key: (filename, head size, size, stored, expires, age)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.path = None
+
+    def process_directory(self):
+        "Returns this process's directory, making it if needed"
+        path = os.path.join(self.directory, "mantrid-cache-%i" % os.getpid())
+        if path != self.path:
+            # We may be a newly forked worker, or the directory may be new
+            remove_abandoned(self.directory)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.path = path
+        return path
+
+    def filename(self, key):
+        return os.path.join(self.process_directory(), hashlib.sha1(repr(key)).hexdigest())
+
+    def put(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        self.discard(key)
+        filename = self.filename(key)
+        try:
+            with open(filename, "wb") as fh:
+                fh.write(entry.head)
+                fh.write(entry.body)
+        except (IOError, OSError), e:
+            logging.error("Cannot write cached response to %s: %s", filename, e)
+            return
+        self.entries[key] = (filename, len(entry.head), entry.size, entry.stored, entry.expires, entry.age)
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            self.discard(next(iter(self.entries)))
+
+    def pop(self, key):
+        "Removes and returns the response stored for key, or None"
+        details = self.entries.get(key)
+        if details is None:
+            return None
+        filename, head_size, size, stored, expires, age = details
+        try:
+            with open(filename, "rb") as fh:
+                data = fh.read()
+        except (IOError, OSError), e:
+            logging.error("Cannot read cached response from %s: %s", filename, e)
+            data = None
+        self.discard(key)
+        if data is None or len(data) != size:
+            return None
+        return CachedResponse(data[:head_size], data[head_size:], stored, expires, age)
+
+    def discard(self, key):
+        details = self.entries.pop(key, None)
+        if details is None:
+            return
+        self.size -= details[2]
+        try:
+            os.unlink(details[0])
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def clear(self):
+        for key in list(self.entries):
+            self.discard(key)
+
+
+class TeeSocket(object):
+    """
+    Wrapper around a socket that keeps a copy of everything sent on it,
+    until more than limit bytes have been.
+    """
+
+    def __init__(self, sock, limit):
+        self.sock = sock
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.sock, attr)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        if self.chunks is not None:
+            self.size += len(data)
+            if self.size > self.limit:
+                self.chunks = None
+            else:
+                self.chunks.append(data)
+
+    @property
+    def data(self):
+        "Everything sent, or None if it was too much"
+        if self.chunks is None:
+            return None
+        return "".join(self.chunks)
+
+
+def remove_abandoned(directory):
+    "Removes the spill directories of processes that no longer exist"
+    try:
+        names = os.listdir(directory)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    for name in names:
+        if not name.startswith("mantrid-cache-"):
+            continue
+        try:
+            pid = int(name[len("mantrid-cache-"):])
+        except ValueError:
+            continue
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def parse_date(value):
+    "Returns an HTTP date header as a timestamp, or None if it isn't one"
+    if not value:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+
+def cache_directives(value):
+    "Returns the directives of a Cache-Control header as a dict"
+    directives = {}
+    for token in (value or "").split(","):
+        name, _, argument = token.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip().strip('"')
+    return directives
+
+
+def freshness(response, now, default_ttl=0):
+    """
+    Returns how many more seconds a response (a MessageHead) can be
+    served from the cache, following its Cache-Control or Expires
+    headers, or default_ttl if it has neither. Returns 0 if it can't
+    be stored at all.
+    """
+    directives = cache_directives(response.get("Cache-Control"))
+    if "no-store" in directives or "private" in directives or "no-cache" in directives:
+        return 0
+    if response.get("Set-Cookie") is not None:
+        return 0
+    # Every key includes Accept-Encoding; anything else it varies on can't be cached
+    for name in response.tokens("Vary"):
+        if name != "accept-encoding":
+            return 0
+    lifetime = None
+    for directive in ("s-maxage", "max-age"):
+        if directive in directives:
+            try:
+                lifetime = int(directives[directive])
+            except ValueError:
+                return 0
+            break
+    else:
+        expires = response.get("Expires")
+        if expires is not None:
+            expires = parse_date(expires)
+            if expires is None:
+                # Invalid dates mean already expired
+                return 0
+            lifetime = expires - (parse_date(response.get("Date")) or now)
+    if lifetime is None:
+        lifetime = default_ttl
+    try:
+        lifetime -= int(response.get("Age") or 0)
+    except ValueError:
+        pass
+    return max(lifetime, 0)
+
+
+def cacheable_response(data, now, default_ttl=0):
+    """
+    Given a whole response as sent to a client, returns a CachedResponse
+    for it, or None if it can't be cached: an uncacheable status or
+    headers, or a body that isn't complete and delimited by length.
+    """
+    raw_head, body = split_head(data)
+    try:
+        response = MessageHead(raw_head)
+        if response.status not in cacheable_statuses:
+            return None
+    except FramingError:
+        return None
+    try:
+        length = int(response.get("Content-Length"))
+    except (TypeError, ValueError):
+        return None
+    if response.get("Transfer-Encoding") is not None or len(body) != length:
+        return None
+    lifetime = freshness(response, now, default_ttl)
+    if lifetime <= 0:
+        return None
+    try:
+        age = int(response.get("Age") or 0)
+    except ValueError:
+        age = 0
+    head = "%s\r\n%s" % (
+        response.first,
+        "".join(
+            "%s: %s\r\n" % (name, value)
+            for name, value in response.headers
+            if name.lower() not in unstored_headers
+        ),
+    )
+    return CachedResponse(head, body, now, now + lifetime, age)
@@ -0,0 +1,99 @@
+"""
+The change feed served at /changes/ on the management port.
+
+Every change to the host table, and every backend address going in or
+out of the blacklist, is given the next revision number and kept in a
+bounded window, so something watching the balancer can ask for just
+what has happened since the revision it last saw, waiting until there
+is something if there isn't yet, instead of fetching the whole host
+table or stats again.
+"""
+
+import os
+import time
+
+from eventlet.event import Event
+from eventlet.timeout import Timeout
+
+
+class ChangeFeed(object):
+    """
+    The last max_changes changes, each a dict with its "revision" and a
+    "type" of set, delete, replace, blacklist or unblacklist.
+
+    Revisions start again from 1 in a new process, so each feed has an
+    epoch; a revision from another epoch, or one older than the window,
+    can't be caught up from and the watcher has to start afresh.
+    """
+
+    max_changes = 10000
+
+    def __init__(self, max_changes=None):
+        if max_changes is not None:
+            self.max_changes = max_changes
+        self.epoch = "%x-%x" % (int(time.time()), os.getpid())
+        self.revision = 0
+        self.changes = []
+        # Sent, and replaced, whenever a change is recorded
+        self.event = Event()
+
+    def record(self, change):
+        "Adds a change (a dict), and wakes anything waiting for one"
+        self.revision += 1
+        change["revision"] = self.revision
+        self.changes.append(change)
+        if len(self.changes) > self.max_changes * 2:
+            # Trimming in bulk keeps each record() cheap on average
+            del self.changes[:-self.max_changes]
+        event, self.event = self.event, Event()
+        event.send()
+
+    def since(self, revision, epoch=None):
+        """
+        Returns the changes after revision, or None if they can't all
+        be given.
+        """
+        if epoch is not None and epoch != self.epoch:
+            return None
+        if revision > self.revision:
+            return None
+        missing = self.revision - revision
+        if missing > min(len(self.changes), self.max_changes):
+            return None
+        return self.changes[len(self.changes) - missing:]
+
+    def wait(self, revision, timeout, epoch=None):
+        """
+        Like since(), but waits up to timeout seconds for a change if
+        there are none after revision yet.
+        """
+        if timeout > 0 and revision == self.revision and (epoch is None or epoch == self.epoch):
+            with Timeout(timeout, False):
+                self.event.wait()
+        return self.since(revision, epoch)
+
+    def response(self, revision, timeout, epoch=None):
+        "Returns the /changes/ reply for a watcher at revision"
+        changes = self.wait(revision, timeout, epoch)
+        if changes is None:
+            return {"epoch": self.epoch, "revision": self.revision, "reset": True, "changes": []}
+        return {"epoch": self.epoch, "revision": self.revision, "changes": changes}
+
+    def stream(self, revision, heartbeat, epoch=None, running=lambda: True):
+        """
+        Yields a reply like response()'s for every batch of changes after
+        revision as they happen, and None after each heartbeat seconds of
+        quiet, for as long as running() is true.
+        """
+        while running():
+            changes = self.wait(revision, heartbeat, epoch)
+            if changes is None:
+                reply = {"epoch": self.epoch, "revision": self.revision, "reset": True, "changes": []}
+            elif changes:
+                reply = {"epoch": self.epoch, "revision": changes[-1]["revision"], "changes": changes}
+            else:
+                yield None
+                continue
+            revision = reply["revision"]
+            epoch = self.epoch
+            yield reply
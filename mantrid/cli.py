@@ -1,5 +1,6 @@
 import sys
 
+import mantrid.json
 from mantrid.actions import Proxy
 from mantrid.backend import Backend
 from mantrid.client import MantridClient
@@ -49,16 +50,21 @@ class MantridCli(object):
         format = "%-35s %-25s %-8s"
         print format % ("HOST", "ACTION", "SUBDOMS")
         for host, details in sorted(self.client.get_all().items()):
-            if details[0] in ("proxy", "mirror"):
+            if details[0] in ("proxy", "cache", "mirror"):
                 action = "%s[algorithm=%s,healthcheck=%s]<%s>" % (
                     details[0],
                     details[1].get('algorithm', Proxy.default_algorithm),
                     details[1].get('healthcheck', Proxy.default_healthcheck),
                     ",".join(
-                        "%s:%s" % (backend.host, backend.port)
+                        "%s:%s" % (backend.host, backend.port) + (":%s" % backend.weight if backend.weight != 1 else "")
                         for backend in details[1]['backends']
                     )
                 )
+                if details[0] == "mirror":
+                    action += "<mirrors=%s>" % ",".join(
+                        "%s:%s" % (mirror.host, mirror.port)
+                        for mirror in details[1]['mirrors']
+                    )
             elif details[0] == "static":
                 action = "%s<%s>" % (
                     details[0],
@@ -109,15 +115,21 @@ class MantridCli(object):
             key, value = arg.split("=", 1)
             options[key] = value
         # Sanity-check options
-        if action in ("proxy, mirror") and "backends" not in options:
+        if action in ("proxy", "cache", "mirror") and "backends" not in options:
             sys.stderr.write("The %s action requires a backends option.\n" % action)
             sys.exit(1)
+        if action == "mirror" and "mirrors" not in options:
+            sys.stderr.write("The %s action requires a mirrors option.\n" % action)
+            sys.exit(1)
         if action == "alias" and "hostname" not in options:
             sys.stderr.write("The %s action requires hostname option.\n" % action)
             sys.exit(1)
         if "healthcheck" in options and options["healthcheck"].lower() not in ("true", "false"):
             sys.stderr.write("The healthcheck option must be one of (true, false)")
             sys.exit(1)
+        if "algorithm" in options and options["algorithm"] not in Proxy.algorithm_mapping:
+            sys.stderr.write("The algorithm option must be one of (%s)\n" % ", ".join(sorted(Proxy.algorithm_mapping)))
+            sys.exit(1)
         if action == "static" and "type" not in options:
             sys.stderr.write("The %s action requires a type option.\n" % action)
             sys.exit(1)
@@ -128,11 +140,17 @@ class MantridCli(object):
             sys.stderr.write("The %s action requires a code option.\n" % action)
             sys.exit(1)
         # Expand some options from text to datastructure
-        if "backends" in options:
-            options['backends'] = [
-                Backend((lambda x: (x[0], int(x[1])))(bit.split(":", 1)))
-                for bit in options['backends'].split(",")
-            ]
+        for name in ("backends", "mirrors"):
+            if name in options:
+                # Each backend is host:port, or host:port:weight
+                options[name] = [
+                    Backend(*(lambda x: ((x[0], int(x[1])), int(x[2]) if len(x) > 2 else 1))(bit.split(":", 2)))
+                    for bit in options[name].split(",")
+                ]
+                for backend in options[name]:
+                    if not 1 <= backend.weight <= Backend.max_weight:
+                        sys.stderr.write("Backend weights must be between 1 and %i.\n" % Backend.max_weight)
+                        sys.exit(1)
         if "healthcheck" in options:
             options['healthcheck'] = (options['healthcheck'].lower() == "true")
         # Set!
@@ -147,6 +165,26 @@ class MantridCli(object):
             hostname,
         )
     
+    def action_batch(self, filename=None):
+        "Sets and deletes many hostnames at once, from a JSON file"
+        if filename is None:
+            sys.stderr.write("You must supply a file (or - for standard input).\n")
+            sys.stderr.write("Usage: batch <file>\n")
+            sys.stderr.write('The file contains {"set": {hostname: [action, options, subdoms], ...}, "delete": [hostname, ...]}\n')
+            sys.exit(1)
+        if filename == "-":
+            batch = mantrid.json.load(sys.stdin)
+        else:
+            with open(filename) as fh:
+                batch = mantrid.json.load(fh)
+        if not isinstance(batch, dict):
+            sys.stderr.write("The file must contain a JSON object.\n")
+            sys.exit(1)
+        changed = self.client.update_many(batch.get("set"), batch.get("delete"))
+        print "%i hostnames changed" % len(changed)
+        for hostname in changed:
+            print hostname
+    
     def action_stats(self, hostname=None):
         "Shows stats (possibly limited by hostname)"
         format = "%-35s %-11s %-11s %-11s %-11s"
@@ -160,5 +198,33 @@ class MantridCli(object):
                 details.get("bytes_sent", 0),
             )
 
+    def action_backends(self):
+        "Shows the open connections to each backend, and if it is draining"
+        format = "%-35s %-11s %-8s"
+        print format % ("BACKEND", "OPEN", "DRAINING")
+        for address, details in sorted(self.client.backends().items()):
+            print format % (address, details["connections"], details["draining"])
+
+    def action_drain(self, address=None, wait="0"):
+        "Stops sending new requests to a backend, and waits for it to finish"
+        usage = "drain <host:port> [wait_seconds]"
+        if address is None:
+            sys.stderr.write("You must supply a backend.\n")
+            sys.stderr.write("Usage: %s\n" % usage)
+            sys.exit(1)
+        details = self.client.drain(address, float(wait))
+        if details["connections"]:
+            print "%s still has %s open connections" % (address, details["connections"])
+            sys.exit(2)
+        print "%s is drained" % address
+
+    def action_undrain(self, address=None):
+        "Starts sending requests to a drained backend again"
+        if address is None:
+            sys.stderr.write("You must supply a backend.\n")
+            sys.stderr.write("Usage: undrain <host:port>\n")
+            sys.exit(1)
+        self.client.undrain(address)
+
 if __name__ == "__main__":
     MantridCli.main()
@@ -4,6 +4,8 @@ try:
 except ImportError:
     import httplib2
 
+import urllib
+
 import mantrid.json
 
 class MantridClient(object):
@@ -48,8 +50,46 @@ class MantridClient(object):
         "Deletes a single hostname"
         return self._request("/hostname/%s/" % hostname, "DELETE")
 
+    def update_many(self, sets=None, deletes=None):
+        """
+        Sets (a dict of hostname: entry) and deletes (a list of hostnames)
+        many endpoints at once; returns the hostnames that changed.
+        """
+        return self._request("/hostname/", "PATCH", {"set": sets or {}, "delete": deletes or []})["changed"]
+
     def stats(self, hostname=None):
         if hostname:
             return self._request("/stats/%s/" % hostname, "GET")
         else:
             return self._request("/stats/", "GET")
+
+    def changes(self, since=0, wait=0, epoch=None):
+        """
+        Returns the changes made after revision since, waiting up to wait
+        seconds for one if there are none yet. If the reply has "reset"
+        set, they couldn't all be given, and everything should be fetched
+        again before carrying on from its "revision".
+        """
+        params = {"since": since, "wait": wait}
+        if epoch:
+            params["epoch"] = epoch
+        return self._request("/changes/?%s" % urllib.urlencode(params), "GET")
+
+    def backends(self):
+        "Returns the open connections and draining state of every backend"
+        return self._request("/backend/", "GET")
+
+    def backend(self, address):
+        "Returns the open connections and draining state of a host:port backend"
+        return self._request("/backend/%s/" % address, "GET")
+
+    def drain(self, address, wait=0):
+        """
+        Stops new connections going to a host:port backend, waiting up to
+        wait seconds for its open ones to finish. Returns its state.
+        """
+        return self._request("/backend/%s/" % address, "PUT", {"draining": True, "wait": wait})
+
+    def undrain(self, address):
+        "Lets a drained host:port backend get new connections again"
+        return self._request("/backend/%s/" % address, "PUT", {"draining": False})
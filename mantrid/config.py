@@ -43,6 +43,19 @@ class SimpleConfig(object):
     def get_int(self, item, default):
         return int(self.get(item, default))
     
+    def get_float(self, item, default):
+        return float(self.get(item, default))
+    
+    def get_bool(self, item, default):
+        value = self.get(item, None)
+        if value is None:
+            return default
+        if value.lower() in ("true", "yes", "on", "1"):
+            return True
+        if value.lower() in ("false", "no", "off", "0"):
+            return False
+        raise ValueError("Invalid boolean for %s: %s" % (item, value))
+    
     def get_all(self, item):
         return self.items.get(item, set())
     
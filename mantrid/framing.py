@@ -0,0 +1,258 @@
+"""
+Just enough HTTP/1.x message framing to know where a message ends,
+so connections can be reused for another request.
+"""
+
+import re
+
+head_end_regex = re.compile(r"\r?\n\r?\n")
+
+
+class FramingError(Exception):
+    "The other end sent something that isn't validly framed HTTP"
+    pass
+
+
+class BufferedSocket(object):
+    """
+    Wrapper around a socket that allows line-based reads, keeping
+    anything read past the end of the line for the next recv().
+    """
+
+    fill_size = 65536
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ""
+
+    def __getattr__(self, attr):
+        return getattr(self.sock, attr)
+
+    def fill(self):
+        "Reads more data into the buffer; returns what was read."
+        data = self.sock.recv(self.fill_size)
+        self.buffer += data
+        return data
+
+    def recv(self, length):
+        if self.buffer:
+            data = self.buffer[:length]
+            self.buffer = self.buffer[length:]
+            return data
+        return self.sock.recv(length)
+
+    def readline(self, limit=65536):
+        "Reads up to and including the next newline, or until EOF."
+        start = 0
+        while True:
+            end = self.buffer.find("\n", start)
+            if end != -1:
+                line = self.buffer[:end + 1]
+                self.buffer = self.buffer[end + 1:]
+                return line
+            if len(self.buffer) > limit:
+                raise FramingError("line_too_long")
+            start = len(self.buffer)
+            if not self.fill():
+                line = self.buffer
+                self.buffer = ""
+                return line
+
+
+class MessageHead(object):
+    """
+    A parsed request or response head: the first line, and the headers
+    as an ordered list of (name, value) pairs.
+    """
+
+    def __init__(self, raw):
+        lines = raw.split("\n")
+        self.first = lines[0].rstrip("\r")
+        self.headers = []
+        for line in lines[1:]:
+            line = line.rstrip("\r")
+            if not line:
+                continue
+            if line[0] in " \t" and self.headers:
+                # Folded continuation of the previous header
+                name, value = self.headers[-1]
+                self.headers[-1] = (name, value + " " + line.strip())
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise FramingError("bad_header_line")
+            self.headers.append((name.strip(), value.strip()))
+
+    def get(self, name, default=None):
+        "Returns the value of the last header called name."
+        name = name.lower()
+        for header, value in reversed(self.headers):
+            if header.lower() == name:
+                return value
+        return default
+
+    def set(self, name, value):
+        "Sets a header, replacing any existing ones with the same name."
+        self.remove(name)
+        self.headers.append((name, value))
+
+    def remove(self, name):
+        name = name.lower()
+        self.headers = [(h, v) for h, v in self.headers if h.lower() != name]
+
+    def tokens(self, name):
+        "Returns the lowercased comma-separated tokens of a header."
+        value = self.get(name)
+        if not value:
+            return []
+        return [token.strip().lower() for token in value.split(",")]
+
+    @property
+    def version(self):
+        "HTTP version of a response head"
+        return self.first.split(None, 1)[0].upper()
+
+    @property
+    def status(self):
+        "Status code of a response head"
+        try:
+            return int(self.first.split(None, 2)[1])
+        except (IndexError, ValueError):
+            raise FramingError("bad_status_line")
+
+    def keep_alive(self):
+        "Returns True if the sender is willing to reuse the connection."
+        tokens = self.tokens("Connection")
+        if self.version == "HTTP/1.1":
+            return "close" not in tokens
+        return "keep-alive" in tokens
+
+    def __str__(self):
+        return "%s\r\n%s\r\n" % (
+            self.first,
+            "".join("%s: %s\r\n" % header for header in self.headers),
+        )
+
+
+def split_head(data):
+    """
+    Splits data into a message head (without the terminating blank line)
+    and whatever follows it. Tolerates bare LF line endings.
+    """
+    match = head_end_regex.search(data)
+    if match is None:
+        return data, ""
+    return data[:match.start()], data[match.end():]
+
+
+def read_head(sock, limit=65536):
+    """
+    Reads a message head from a BufferedSocket, returning it without the
+    terminating blank line. Returns None if the connection closed first.
+    Tolerates bare LF line endings.
+    """
+    start = 0
+    while True:
+        match = head_end_regex.search(sock.buffer, start)
+        if match is not None:
+            head = sock.buffer[:match.start()]
+            sock.buffer = sock.buffer[match.end():]
+            return head
+        if len(sock.buffer) > limit:
+            raise FramingError("head_too_long")
+        start = max(0, len(sock.buffer) - 3)
+        if not sock.fill():
+            if sock.buffer:
+                raise FramingError("closed_in_head")
+            return None
+
+
+def body_framing(head, method=None):
+    """
+    Works out how a response body is delimited. Returns ("none", 0),
+    ("length", n), ("chunked", None) or ("close", None).
+    """
+    status = head.status
+    if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+        return ("none", 0)
+    if "chunked" in head.tokens("Transfer-Encoding"):
+        return ("chunked", None)
+    length = head.get("Content-Length")
+    if length is not None:
+        try:
+            length = int(length)
+        except ValueError:
+            raise FramingError("bad_content_length")
+        if length < 0:
+            raise FramingError("bad_content_length")
+        return ("length", length)
+    return ("close", None)
+
+
+def relay_length(in_sock, out_sock, length, chunk=65536, moved=None):
+    """
+    Relays exactly length bytes from in_sock to out_sock. If moved is
+    given, it is called with the size of each piece once it is written.
+    """
+    remaining = length
+    while remaining > 0:
+        data = in_sock.recv(min(remaining, chunk))
+        if not data:
+            raise FramingError("closed_in_body")
+        out_sock.sendall(data)
+        remaining -= len(data)
+        if moved is not None:
+            moved(len(data))
+    return length
+
+
+def relay_chunked(in_sock, out_sock, chunk=65536, moved=None):
+    """
+    Relays a chunked body (including its trailers) from a BufferedSocket
+    to out_sock one chunk at a time, as it arrives; chunk and moved are
+    as for relay_length.
+    """
+    total = 0
+    while True:
+        line = in_sock.readline()
+        if not line.endswith("\n"):
+            raise FramingError("closed_in_body")
+        try:
+            size = int(line.split(";", 1)[0].strip(), 16)
+        except ValueError:
+            raise FramingError("bad_chunk_size")
+        out_sock.sendall(line)
+        total += len(line)
+        if moved is not None:
+            moved(len(line))
+        if size == 0:
+            break
+        # Chunk data plus its trailing CRLF
+        total += relay_length(in_sock, out_sock, size + 2, chunk, moved)
+    # Trailers, ending with a blank line
+    while True:
+        line = in_sock.readline()
+        if not line.endswith("\n"):
+            raise FramingError("closed_in_body")
+        out_sock.sendall(line)
+        total += len(line)
+        if moved is not None:
+            moved(len(line))
+        if line in ("\r\n", "\n"):
+            return total
+
+
+def relay_until_close(in_sock, out_sock, chunk=65536, moved=None):
+    """
+    Relays everything from in_sock to out_sock until in_sock closes;
+    chunk and moved are as for relay_length.
+    """
+    total = 0
+    while True:
+        data = in_sock.recv(chunk)
+        if not data:
+            return total
+        out_sock.sendall(data)
+        total += len(data)
+        if moved is not None:
+            moved(len(data))
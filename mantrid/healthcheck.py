@@ -0,0 +1,204 @@
+"""
+Active health checking of proxy backends.
+
+A single scheduler probes every backend of every host on a jittered
+interval, rather than waiting for a proxied request to fail first.
+"""
+
+import logging
+import random
+import time
+
+import eventlet
+from eventlet.green import socket
+from eventlet.timeout import Timeout
+
+from mantrid.actions import Proxy
+from mantrid.framing import BufferedSocket
+
+
+class ProbeTarget(object):
+    """
+    One address to probe, and all the Backend objects (possibly from
+    several hosts) that share it and the same probe settings.
+    """
+
+    def __init__(self, address, path, status):
+        self.address = address
+        self.path = path
+        self.status = status
+        self.backends = []
+        self.due = 0
+        self.probing = False
+        self.successes = 0
+        self.failures = 0
+        # Whether it was down after the last probe
+        self.was_down = False
+
+    @property
+    def down(self):
+        return any(backend.blacklisted for backend in self.backends)
+
+    def set_down(self, down):
+        for backend in self.backends:
+            if backend.blacklisted != down:
+                backend.blacklisted = down
+
+    def __repr__(self):
+        if self.path is None:
+            return "tcp://%s:%s" % self.address
+        return "http://%s:%s%s" % (self.address + (self.path,))
+
+
+class HealthChecker(object):
+    """
+    Probes the backends of all hosts that have health checking enabled.
+
+    Each distinct (address, path, status) is probed once per interval,
+    however many hostnames it appears under. Probes are a TCP connect, or
+    an HTTP GET of path if the host sets healthcheck_path, which must
+    return healthcheck_status (default 200). A backend is blacklisted after
+    fall failed probes in a row, and brought back after rise successful ones.
+    """
+
+    jitter = 0.2
+    max_concurrent_probes = 100
+    default_status = 200
+
+    def __init__(self, balancer, interval, timeout=1, rise=2, fall=3):
+        self.balancer = balancer
+        self.interval = interval
+        self.timeout = timeout
+        self.rise = rise
+        self.fall = fall
+        self.targets = {}
+        self.dirty = True
+        self.last_down = None
+        self.last_broadcast = 0
+        self.pool = eventlet.GreenPool(self.max_concurrent_probes)
+
+    def hosts_changed(self):
+        "Called when the host table changes; rebuilt before the next probe"
+        self.dirty = True
+
+    def refresh(self):
+        "Rebuilds the set of probe targets from the host table"
+        old_targets = self.targets
+        self.targets = {}
+        now = time.time()
+        for hostname, (action, kwargs, allow_subs) in self.balancer.hosts.items():
+            if not kwargs.get("healthcheck", Proxy.default_healthcheck) or not isinstance(kwargs.get("backends"), list):
+                continue
+            path = kwargs.get("healthcheck_path")
+            try:
+                status = int(kwargs.get("healthcheck_status", self.default_status))
+            except (TypeError, ValueError):
+                # The REST API refuses these, but a state file might not
+                logging.error("Not health checking %s: bad healthcheck_status %r", hostname, kwargs.get("healthcheck_status"))
+                continue
+            if path is not None and not isinstance(path, basestring):
+                logging.error("Not health checking %s: bad healthcheck_path %r", hostname, path)
+                continue
+            for backend in kwargs["backends"]:
+                key = ((backend.host, backend.port), path, status)
+                target = self.targets.get(key)
+                if target is None:
+                    target = old_targets.get(key)
+                    if target is None:
+                        target = ProbeTarget(*key)
+                        # Spread new targets over the first interval
+                        target.due = now + random.uniform(0, self.interval)
+                    target.backends = []
+                    self.targets[key] = target
+                target.backends.append(backend)
+                backend.checker = self
+        self.dirty = False
+
+    def run(self):
+        "Main scheduling loop"
+        while True:
+            if self.dirty:
+                self.refresh()
+            now = time.time()
+            next_due = now + self.interval
+            for target in self.targets.values():
+                if target.probing:
+                    continue
+                if target.due <= now:
+                    target.probing = True
+                    target.due = now + self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+                    self.pool.spawn_n(self.check, target)
+                next_due = min(next_due, target.due)
+            self.broadcast(now)
+            eventlet.sleep(max(0.01, next_due - time.time()))
+
+    def check(self, target):
+        "Probes a target and applies the rise/fall thresholds"
+        try:
+            healthy = self.probe(target)
+        finally:
+            target.probing = False
+        if target.down and not target.was_down:
+            # Blacklisted by a failed request since the last probe; it
+            # still has to pass rise probes from now on to come back
+            target.successes = 0
+        if healthy:
+            target.failures = 0
+            target.successes += 1
+            if target.down and target.successes >= self.rise:
+                logging.warn("Health check of %s passed %i times; marking available", target, target.successes)
+                target.set_down(False)
+                self.broadcast(time.time())
+        else:
+            target.successes = 0
+            target.failures += 1
+            if not target.down and target.failures >= self.fall:
+                logging.warn("Health check of %s failed %i times; blacklisting", target, target.failures)
+                target.set_down(True)
+                self.broadcast(time.time())
+        target.was_down = target.down
+
+    def probe(self, target):
+        "Returns True if the target passes a single probe"
+        try:
+            with Timeout(self.timeout):
+                sock = eventlet.connect(target.address)
+                try:
+                    if target.path is None:
+                        return True
+                    sock.sendall(
+                        "GET %s HTTP/1.0\r\nHost: %s\r\nUser-Agent: mantrid-healthcheck\r\nConnection: close\r\n\r\n" % (
+                            target.path,
+                            target.address[0],
+                        )
+                    )
+                    words = BufferedSocket(sock).readline(limit=4096).split(None, 2)
+                    return len(words) >= 2 and words[1] == str(target.status)
+                finally:
+                    sock.close()
+        except (socket.error, Timeout):
+            return False
+        except Exception:
+            logging.error("Unexpected error health checking %s", target, exc_info=True)
+            return False
+
+    def down_addresses(self):
+        "Returns the sorted list of addresses that are currently down"
+        return sorted(set(
+            target.address
+            for target in self.targets.values()
+            if target.down
+        ))
+
+    def broadcast(self, now):
+        """
+        Tells any worker processes which backends are down, whenever that
+        changes and once an interval in case they've drifted.
+        """
+        if self.balancer.worker_manager is None:
+            return
+        down = self.down_addresses()
+        if down != self.last_down or now - self.last_broadcast >= self.interval:
+            self.balancer.worker_manager.broadcast({"type": "health", "down": down})
+            self.last_down = down
+            self.last_broadcast = now
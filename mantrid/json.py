@@ -14,37 +14,75 @@ class MantridEncoder(json.JSONEncoder):
     """Custom serialization for mantrid types."""
     def default(self, obj):
         if isinstance(obj, mantrid.backend.Backend):
+            if obj.weight != 1:
+                return {'__backend__': (obj.host, obj.port), 'weight': obj.weight}
             return {'__backend__': (obj.host, obj.port)}
         return json.JSONEncoder.default(self, obj)
 
 def load_mantrid(dct):
     """Custom deserialization for mantrid types."""
     if '__backend__' in dct:
-        return mantrid.backend.Backend(dct['__backend__'])
+        return mantrid.backend.Backend(dct['__backend__'], dct.get('weight', 1))
     return dct
 
 
-def dumps(*args, **kwargs):
+# Shared by every call without options, so each doesn't make its own
+_encoder = MantridEncoder()
+_decoder = json.JSONDecoder(object_hook=load_mantrid)
+
+
+def dumps(obj, **kwargs):
     """Securely dump objects to JSON, supporting custom mantrid types."""
-    new_kwargs = copy.copy(kwargs)
-    new_kwargs['cls'] = MantridEncoder
-    return json.dumps(*args, **new_kwargs)
+    if not kwargs:
+        return _encoder.encode(obj)
+    return json.dumps(obj, cls=MantridEncoder, **kwargs)
 
-def dump(*args, **kwargs):
+def dump(obj, fp, **kwargs):
     """Securely dump objects to JSON, supporting custom mantrid types."""
-    new_kwargs = copy.copy(kwargs)
-    new_kwargs['cls'] = MantridEncoder
-    return json.dump(*args, **new_kwargs)
+    return json.dump(obj, fp, cls=MantridEncoder, **kwargs)
 
-def loads(*args, **kwargs):
+def loads(s, **kwargs):
     """Securely load objects from JSON, supporting custom mantrid types."""
-    new_kwargs = copy.copy(kwargs)
-    new_kwargs['object_hook'] = load_mantrid
-    return json.loads(*args, **new_kwargs)
+    if not kwargs:
+        return _decoder.decode(s)
+    return json.loads(s, object_hook=load_mantrid, **kwargs)
 
-def load(*args, **kwargs):
+def load(fp, **kwargs):
     """Securely load objects from JSON, supporting custom mantrid types."""
-    new_kwargs = copy.copy(kwargs)
-    new_kwargs['object_hook'] = load_mantrid
-    return json.load(*args, **new_kwargs)
+    return loads(fp.read(), **kwargs)
+
+
+class EncodedItems(object):
+    """
+    Encodes a dict to JSON one item at a time, keeping each item's
+    encoding to reuse for as long as it is unchanged, so encoding a big
+    dict again only costs as much as the items that have changed.
+
+    Items are unchanged while their value is the same object, as host
+    rules are, since they are replaced rather than changed in place; if
+    by_value is True, while it is equal to a copy of the value last
+    encoded instead, for dicts like /stats/ values that are updated in
+    place.
+    """
+
+    def __init__(self, by_value=False):
+        self.by_value = by_value
+        # Key: (value or its copy, encoded "key": value item)
+        self.items = {}
 
+    def encode(self, mapping):
+        "Returns mapping as JSON"
+        items = self.items
+        parts = []
+        for key, value in mapping.iteritems():
+            cached = items.get(key)
+            if cached is None or not (cached[0] == value if self.by_value else cached[0] is value):
+                cached = items[key] = (
+                    copy.copy(value) if self.by_value else value,
+                    "%s: %s" % (_encoder.encode(key), _encoder.encode(value)),
+                )
+            parts.append(cached[1])
+        if len(items) > len(mapping):
+            for key in [key for key in items if key not in mapping]:
+                del items[key]
+        return "{%s}" % ", ".join(parts)
@@ -1,42 +1,98 @@
 import eventlet
 import errno
+import gc
 import logging
-import mimetools
 import resource
 import os
+import signal
 import sys
+import time
 import argparse
 
-from eventlet import wsgi
+from eventlet import tpool, wsgi, StopServe
+from eventlet.event import Event
 from eventlet.green import socket
+from eventlet.semaphore import Semaphore
+from eventlet.timeout import Timeout
 
 import mantrid.json
+import mantrid.restart as restart
 
-from mantrid.actions import NoHealthyBackends, Unknown, Proxy, Empty, Static, Redirect, NoHosts, Spin, Alias
+from mantrid.accesslog import AccessLog
+from mantrid.actions import NoHealthyBackends, Unknown, Proxy, Cache, Mirror, Empty, Static, Redirect, NoHosts, Spin, Alias
+from mantrid.cache import ResponseCache
+from mantrid.changes import ChangeFeed
 from mantrid.config import SimpleConfig
+from mantrid.framing import BufferedSocket, FramingError
 from mantrid.management import ManagementApp
+from mantrid.metrics import Metrics
+from mantrid.mirror import MirrorTarget
+from mantrid.requesthead import read_request_head
+from mantrid.routing import RouteTable
+from mantrid.state import StateFile
+from mantrid.static_responses import static_responses
+from mantrid.stats import HostCounters
 from mantrid.stats_socket import StatsSocket
 from mantrid.greenbody import GreenBody
+from mantrid.healthcheck import HealthChecker
+from mantrid.workers import Worker, WorkerManager
 
 
 class ManagedHostDict(dict):
     def __init__(self, *args, **kwargs):
         super(ManagedHostDict, self).__init__(*args, **kwargs)
+        self.routes = RouteTable(self)
+        self.on_change = None
+        # Hostnames changed since the state was last saved
+        self.dirty = set()
 
     def __setitem__(self, host, settings):
         if host in self:
             self._retire_backends_of(host)
 
         super(ManagedHostDict, self).__setitem__(host, settings)
+        self.dirty.add(host)
+        self.routes.update(host)
+        if self.on_change is not None:
+            self.on_change(host)
 
     def __delitem__(self, host):
         if host in self and self[host][1].get('healthcheck', Proxy.default_healthcheck):
             self._retire_backends_of(host)
         super(ManagedHostDict, self).__delitem__(host)
+        self.dirty.add(host)
+        self.routes.update(host)
+        if self.on_change is not None:
+            self.on_change(host)
+
+    def update_many(self, sets, deletes):
+        """
+        Sets and deletes many hostnames at once, telling on_change about
+        them together as a list. Entries the same as the current ones are
+        left alone, so their backends aren't retired. Returns the
+        hostnames that changed.
+        """
+        on_change, self.on_change = self.on_change, None
+        changed = []
+        try:
+            for host in deletes:
+                if host in self:
+                    del self[host]
+                    changed.append(host)
+            for host, settings in sets.items():
+                if host in self and mantrid.json.dumps(self[host], sort_keys=True) == mantrid.json.dumps(settings, sort_keys=True):
+                    continue
+                self[host] = settings
+                changed.append(host)
+        finally:
+            self.on_change = on_change
+        if changed and self.on_change is not None:
+            self.on_change(changed)
+        return changed
 
     def _retire_backends_of(self, host):
         for backend in self[host][1].get("backends", []):
-            backend.retired = True
+            backend.retire()
 
 class Balancer(object):
     """
@@ -45,8 +101,13 @@ class Balancer(object):
 
     nofile = 102400
     save_interval = 10
+    stats_save_interval = 60
+    # Management work on fewer host entries than this isn't worth a thread
+    offload_min_size = 1000
     action_mapping = {
         "proxy": Proxy,
+        "cache": Cache,
+        "mirror": Mirror,
         "empty": Empty,
         "static": Static,
         "redirect": Redirect,
@@ -56,7 +117,7 @@ class Balancer(object):
         "no_hosts": NoHosts,
     }
 
-    def __init__(self, external_addresses, internal_addresses, management_addresses, state_file, uid=None, gid=65535, static_dir="/etc/mantrid/static/"):
+    def __init__(self, external_addresses, internal_addresses, management_addresses, state_file, uid=None, gid=65535, static_dir="/etc/mantrid/static/", splice=False, backend_pool_size=0, backend_pool_idle_timeout=30, keepalive_timeout=0, workers=0, healthcheck_interval=0, healthcheck_timeout=1, healthcheck_rise=2, healthcheck_fall=3, state_journal=False, state_journal_compact=10000, state_snapshot=False, hot_restart_timeout=30, drain_timeout=60, access_log=None, access_log_sample=1.0, access_log_max_bytes=0, access_log_backups=5, relay_buffer_size=32768, relay_idle_timeout=30, relay_rate_limit=0, relay_high_watermark=0, relay_low_watermark=0, management_offload=True):
         """
         Constructor.
 
@@ -65,6 +126,47 @@ class Balancer(object):
         is if it's an internal endpoint or not.
         Internal endpoints do not have X-Forwarded-* stripped;
         other ones do, and have X-Forwarded-For added.
+
+        If splice is True, proxied connections are relayed with
+        splice() where the platform supports it.
+
+        If backend_pool_size is non-zero, up to that many idle keep-alive
+        connections are kept open to each backend, for at most
+        backend_pool_idle_timeout seconds.
+
+        If keepalive_timeout is non-zero, client connections are kept
+        open between requests for up to that many seconds.
+
+        If workers is non-zero, that many worker processes are forked to
+        serve requests, and this process only does management.
+
+        If healthcheck_interval is non-zero, the backends of every host are
+        actively probed that often; see HealthChecker.
+
+        If state_journal is True, host changes are appended to a journal
+        next to the state file rather than rewriting all of it, until
+        the journal has state_journal_compact entries.
+
+        If state_snapshot is True, a binary snapshot is saved alongside the
+        state file to load from on startup.
+
+        On SIGUSR2, a new copy of the process is started on the same
+        listening sockets; once it is serving (within hot_restart_timeout
+        seconds) this one stops accepting and exits when its open
+        connections finish, or after drain_timeout seconds.
+
+        If access_log is set, a line is written to that file for each
+        request (or a sample of access_log_sample of them), rotating it
+        once it is bigger than access_log_max_bytes, if non-zero, and
+        keeping access_log_backups old files.
+
+        Proxied data is relayed relay_buffer_size bytes at a time, and
+        given up on once it has made no progress for relay_idle_timeout
+        seconds; see SocketMelder for relay_rate_limit and the watermarks.
+
+        If management_offload is True, state file writes, and encoding,
+        decoding and validating big host tables for the management API,
+        are done in threads rather than holding up proxying.
         """
         self.external_addresses = external_addresses
         self.internal_addresses = internal_addresses
@@ -73,6 +175,56 @@ class Balancer(object):
         self.uid = uid
         self.gid = gid
         self.static_dir = static_dir
+        self.splice = splice
+        self.backend_pool_size = backend_pool_size
+        self.backend_pool_idle_timeout = backend_pool_idle_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.workers = workers
+        self.healthcheck_interval = healthcheck_interval
+        self.healthcheck_timeout = healthcheck_timeout
+        self.healthcheck_rise = healthcheck_rise
+        self.healthcheck_fall = healthcheck_fall
+        self.state = StateFile(state_file, state_snapshot)
+        self.state_journal = state_journal
+        self.state_journal_compact = state_journal_compact
+        self.stats_dirty = False
+        self.last_stats_save = time.time()
+        self.worker_manager = None
+        self.health_checker = None
+        self.hot_restart_timeout = hot_restart_timeout
+        self.drain_timeout = drain_timeout
+        self.restarting = False
+        self.drained = None
+        self.open_connections = 0
+        self.listeners = []
+        self.management_listeners = []
+        self.listen_threads = []
+        # (host, port) of backends that get no new connections
+        self.draining_backends = set()
+        self.metrics = Metrics()
+        # Request counts not yet folded into self.stats, by hostname
+        self.counters = {}
+        # ResponseCaches of hosts using the cache action, by hostname
+        self.response_caches = {}
+        # MirrorTargets of the mirror action, by (host, port)
+        self.mirror_targets = {}
+        self.relay_buffer_size = relay_buffer_size
+        self.relay_idle_timeout = relay_idle_timeout
+        self.relay_rate_limit = relay_rate_limit
+        self.relay_high_watermark = relay_high_watermark
+        self.relay_low_watermark = relay_low_watermark
+        self.management_offload = management_offload
+        # Held while saving, so a save in a thread can't overlap another
+        self.save_lock = Semaphore()
+        # SocketMelders currently relaying
+        self.sessions = set()
+        # Host table and blacklist changes, served at /changes/
+        self.changes = ChangeFeed()
+        # Number of blacklisted, unretired Backends for each (host, port)
+        self.blacklisted_counts = {}
+        self.access_log = None
+        if access_log:
+            self.access_log = AccessLog(access_log, access_log_sample, access_log_max_bytes, access_log_backups, metrics=self.metrics)
         self.hosts = ManagedHostDict()
 
     @classmethod
@@ -117,6 +269,30 @@ class Balancer(object):
             config.get_int("uid", 4321),
             config.get_int("gid", 4321),
             config.get("static_dir", "/etc/mantrid/static/"),
+            config.get_bool("splice", False),
+            config.get_int("backend_pool_size", 0),
+            config.get_int("backend_pool_idle_timeout", 30),
+            config.get_int("keepalive_timeout", 0),
+            config.get_int("workers", 0),
+            config.get_int("healthcheck_interval", 0),
+            config.get_int("healthcheck_timeout", 1),
+            config.get_int("healthcheck_rise", 2),
+            config.get_int("healthcheck_fall", 3),
+            config.get_bool("state_journal", False),
+            config.get_int("state_journal_compact", 10000),
+            config.get_bool("state_snapshot", False),
+            config.get_int("hot_restart_timeout", 30),
+            config.get_int("drain_timeout", 60),
+            config.get("access_log", None),
+            config.get_float("access_log_sample", 1.0),
+            config.get_int("access_log_max_bytes", 0),
+            config.get_int("access_log_backups", 5),
+            config.get_int("relay_buffer_size", 32768),
+            config.get_int("relay_idle_timeout", 30),
+            config.get_int("relay_rate_limit", 0),
+            config.get_int("relay_high_watermark", 0),
+            config.get_int("relay_low_watermark", 0),
+            config.get_bool("management_offload", True),
         )
         balancer.run()
 
@@ -132,32 +308,96 @@ class Balancer(object):
 
     def load(self):
         "Loads the state from the state file"
+        # Loading makes lots of objects and no garbage; don't keep
+        # running the cyclic garbage collector while it happens.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
         try:
-            if os.path.getsize(self.state_file) <= 1:
-                raise IOError("File is empty.")
-            with open(self.state_file) as fh:
-                state = self._converted_from_old_format(mantrid.json.load(fh))
-                assert isinstance(state, dict)
-                self.hosts = state['hosts']
-                self.stats = state['stats']
+            state = self._converted_from_old_format(self.state.load())
+            self.hosts = state['hosts']
+            self.stats = state['stats']
             for key in self.stats:
                 self.stats[key]['open_requests'] = 0
         except (IOError, OSError):
             # There is no state file; start empty.
             self.hosts = ManagedHostDict()
             self.stats = {}
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        # Fold any journal into the state file at the next save
+        self.hosts_replaced = bool(self.state.journal_entries)
 
     def save(self):
-        "Saves the state to the state file"
-        with open(self.state_file, "w") as fh:
-            mantrid.json.dump({
-                "hosts": self.hosts,
-                "stats": self.stats,
-            }, fh)
+        "Atomically saves the whole state to the state file"
+        with self.save_lock:
+            self._save()
+
+    def _save(self):
+        # Anything that changes from here on needs saving again
+        self.hosts_replaced = False
+        self.hosts.dirty = set()
+        self.stats_dirty = False
+        self.last_stats_save = time.time()
+        # Copies, as it may be written out while they change
+        hosts = dict(self.hosts)
+        stats = dict((host, dict(values)) for host, values in self.collect_stats().items())
+        try:
+            self.offload(None, self.state.save, hosts, stats)
+        except:
+            self.hosts_replaced = True
+            raise
+
+    def save_changes(self):
+        """
+        Saves whatever has changed since the last save. Host changes are
+        appended to the journal if it's enabled, and otherwise cause a
+        full save; changed stats alone are saved every stats_save_interval.
+        """
+        with self.save_lock:
+            changed = self.hosts.dirty
+            if self.hosts_replaced or (changed and not self.state_journal):
+                self._save()
+            elif changed:
+                if self.state.journal_entries + len(changed) > self.state_journal_compact:
+                    self._save()
+                else:
+                    self.hosts.dirty = set()
+                    hosts = dict((host, self.hosts[host]) for host in changed if host in self.hosts)
+                    try:
+                        self.offload(None, self.state.append, hosts, changed)
+                    except:
+                        self.hosts.dirty.update(changed)
+                        raise
+            elif self.stats_dirty or self.worker_manager is not None:
+                if time.time() - self.last_stats_save >= self.stats_save_interval:
+                    self._save()
+
+    def offload(self, size, function, *args):
+        """
+        Returns function(*args), run in one of eventlet's tpool threads so
+        that proxying carries on meanwhile, if management_offload is on and
+        size (the host entries it works on) is at least offload_min_size,
+        or None for work that waits on the disk. Anything function uses
+        must not be changed by other greenthreads while it runs.
+        """
+        if self.management_offload and (size is None or size >= self.offload_min_size):
+            return tpool.execute(function, *args)
+        return function(*args)
 
     def run(self):
+        # Open the listening sockets while we can still bind low ports,
+        # or take them over from the process we're replacing.
+        self.open_all_listeners()
+        # Fork off any worker processes first; they only share the
+        # listening sockets with us.
+        if self.workers:
+            self.worker_manager = WorkerManager(self)
+            self.worker_manager.spawn(self.workers, self.listeners)
         # First, initialise the process
         self.load()
+        static_responses.preload(self.static_dir)
+        mantrid.backend.blacklist_listener = self.backend_blacklist_changed
         self.running = True
         # Try to ensure the state file is readable
         state_dir = os.path.dirname(self.state_file)
@@ -172,23 +412,220 @@ class Balancer(object):
                 os.chown(self.state_file, self.uid, -1)
             except OSError:
                 pass
+        self.drop_privileges()
         # Then, launch the socket loops
         pool = GreenBody(
-            len(self.external_addresses) +
-            len(self.internal_addresses) +
-            len(self.management_addresses) +
-            1
+            len(self.listeners) +
+            len(self.management_listeners) +
+            4
         )
         pool.spawn(self.save_loop)
-        for address, family in self.external_addresses:
-            pool.spawn(self.listen_loop, address, family, internal=False)
-        for address, family in self.internal_addresses:
-            pool.spawn(self.listen_loop, address, family, internal=True)
+        if self.access_log is not None:
+            pool.spawn(self.access_log.run)
+        if self.healthcheck_interval:
+            self.health_checker = HealthChecker(
+                self,
+                self.healthcheck_interval,
+                self.healthcheck_timeout,
+                self.healthcheck_rise,
+                self.healthcheck_fall,
+            )
+            pool.spawn(self.health_checker.run)
+        if self.worker_manager is None:
+            self.spawn_listen_loops(pool, self.listeners)
+        else:
+            pool.spawn(self.worker_manager.run)
+        for sock in self.management_listeners:
+            self.listen_threads.append((
+                pool.spawn(self.management_loop, sock.getsockname(), sock.family, sock=sock),
+                SystemExit,
+            ))
+        # Ensure we can save to the state file, or die hard.
+        try:
+            open(self.state_file, "a").close()
+        except (OSError, IOError):
+            logging.critical("Cannot write to state file %s" % self.state_file)
+            sys.exit(1)
+        # If we're replacing an old process, it can stop accepting now
+        restart.signal_ready()
+        signal.signal(signal.SIGUSR2, lambda signum, frame: eventlet.spawn_n(self.hot_restart))
+        # Wait for one to exit, or for a clean/forced shutdown
+        try:
+            pool.wait()
+            # Let open connections finish if we're being replaced
+            if self.drained is not None:
+                self.drained.wait()
+        except (KeyboardInterrupt, StopIteration, SystemExit):
+            pass
+        except Exception, e:
+            logging.error("Unhandled Exception %s" % e)
+        # We're done
+        self.running = False
+        self.flush_access_log()
+        logging.info("Exiting")
+
+    def run_worker(self, channel, listeners):
+        """
+        Runs as one of several worker processes, serving requests from
+        listening sockets opened by the master, with host table changes
+        sent over channel.
+        """
+        self.running = True
+        self.worker_manager = None
+        self.stats = {}
+        self.counters = {}
+        # Threads don't survive the fork, and only the master needs them
+        self.management_offload = False
+        # The master serves management, and so the change feed, not us
+        self.changes = None
+        mantrid.backend.blacklist_listener = None
+        for sock in self.management_listeners:
+            sock.close()
+        self.management_listeners = []
+        static_responses.preload(self.static_dir)
+        pool = GreenBody(len(listeners) + 2)
+        pool.spawn(Worker(self, channel).run)
+        if self.access_log is not None:
+            # Only the master rotates; we follow it onto the new file
+            self.access_log.rotate = False
+            pool.spawn(self.access_log.run)
+        self.spawn_listen_loops(pool, listeners)
+        self.drop_privileges()
+        try:
+            pool.wait()
+            if self.drained is not None:
+                self.drained.wait()
+        except (KeyboardInterrupt, StopIteration, SystemExit):
+            pass
+        self.running = False
+        self.flush_access_log()
+
+    def flush_access_log(self):
+        "Writes out any access log entries still buffered"
+        if self.access_log is None:
+            return
+        try:
+            self.access_log.flush()
+        except (IOError, OSError), e:
+            logging.error("Cannot write access log %s: %s", self.access_log.path, e)
+        self.access_log.close()
+
+    def spawn_listen_loops(self, pool, listeners):
+        "Starts accepting requests on the given (socket, internal) listeners"
+        for sock, internal in listeners:
+            self.listen_threads.append((
+                pool.spawn(self.listen_loop, sock.getsockname(), sock.family, internal=internal, sock=sock),
+                StopServe,
+            ))
+
+    def open_all_listeners(self):
+        """
+        Sets self.listeners and self.management_listeners, either by
+        opening the configured addresses or, on a hot restart, from the
+        sockets passed on by the old process.
+        """
+        inherited = restart.inherited_listeners()
+        if inherited is None:
+            self.listeners = self.open_listeners()
+            self.management_listeners = self.open_management_listeners()
+        else:
+            logging.info("Taking over %i listening sockets from the old process", len(inherited))
+            self.listeners = [(sock, kind == "internal") for sock, kind in inherited if kind != "management"]
+            self.management_listeners = [sock for sock, kind in inherited if kind == "management"]
+
+    def hot_restart(self):
+        """
+        Starts a new copy of this process that takes over our listening
+        sockets, then once it is serving, stops accepting and exits when
+        our open connections have finished (or drain_timeout has passed).
+        If the new process doesn't start, we carry on as before.
+        """
+        if self.restarting:
+            return
+        self.restarting = True
+        logging.info("Hot restart requested; starting a new process")
+        try:
+            # The new process needs to load the latest state
+            self.save()
+            ready_read, ready_write = os.pipe()
+            listeners = [
+                (sock, "internal" if internal else "external")
+                for sock, internal in self.listeners
+            ] + [(sock, "management") for sock in self.management_listeners]
+            pid = os.fork()
+            if pid == 0:
+                restart.exec_replacement(listeners, ready_write)
+            os.close(ready_write)
+            if not restart.wait_until_ready(ready_read, self.hot_restart_timeout):
+                logging.error("New process %i did not start serving; not restarting", pid)
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+                self.restarting = False
+                return
+        except Exception:
+            logging.error("Hot restart failed", exc_info=True)
+            self.restarting = False
+            return
+        logging.info("New process %i is serving; draining connections", pid)
+        self.drain(self.drain_timeout)
+
+    def drain(self, timeout):
+        """
+        Stops accepting connections and saving state, and waits up to
+        timeout seconds for open connections (including those of any
+        workers) to finish.
+        """
+        self.drained = Event()
+        self.running = False
+        for thread, stop in self.listen_threads:
+            thread.kill(stop)
+        deadline = time.time() + timeout
+        if self.worker_manager is not None:
+            self.worker_manager.broadcast({"type": "drain", "timeout": timeout})
+            while self.worker_manager.channels and time.time() < deadline:
+                eventlet.sleep(0.1)
+        while self.open_connections and time.time() < deadline:
+            eventlet.sleep(0.1)
+        if self.open_connections:
+            logging.warn("Drain timed out; closing %i open connections", self.open_connections)
+        self.drained.send()
+
+    def open_listeners(self):
+        """
+        Opens the external and internal listening sockets up front, so
+        they can be shared by worker processes and handed on by a hot restart.
+        Returns a list of (socket, internal) pairs.
+        """
+        listeners = []
+        for addresses, internal in [(self.external_addresses, False), (self.internal_addresses, True)]:
+            for address, family in addresses:
+                try:
+                    listeners.append((eventlet.listen(address, family), internal))
+                except socket.error, e:
+                    if e.errno == errno.EACCES and address[1] <= 1024:
+                        logging.critical("Cannot listen on (%s, %s) (you might need to launch as root)" % (address, family))
+                        continue
+                    logging.critical("Cannot listen on (%s, %s): %s" % (address, family, e))
+                    raise
+        return listeners
+
+    def open_management_listeners(self):
+        "Opens the management listening sockets; returns a list of them"
+        listeners = []
         for address, family in self.management_addresses:
-            pool.spawn(self.management_loop, address, family)
-        # Give the other threads a chance to open their listening sockets
-        eventlet.sleep(0.5)
-        # Drop to the lesser UID/GIDs, if supplied
+            try:
+                listeners.append(eventlet.listen(address, family))
+            except socket.error, e:
+                logging.critical("Cannot listen on (%s, %s): %s" % (address, family, e))
+        return listeners
+
+    def drop_privileges(self):
+        "Drops to the lesser UID/GIDs, if supplied"
+        if self.uid and os.getuid() == self.uid:
+            # Already dropped (we were started by a hot restart)
+            return
         if self.gid:
             try:
                 os.setegid(self.gid)
@@ -206,22 +643,194 @@ class Balancer(object):
                 logging.error("Cannot change to UID %i (probably not running as root)" % self.uid)
             else:
                 logging.info("Dropped to UID %i" % self.uid)
-        # Ensure we can save to the state file, or die hard.
-        try:
-            open(self.state_file, "a").close()
-        except (OSError, IOError):
-            logging.critical("Cannot write to state file %s" % self.state_file)
-            sys.exit(1)
-        # Wait for one to exit, or for a clean/forced shutdown
-        try:
-            pool.wait()
-        except (KeyboardInterrupt, StopIteration, SystemExit):
-            pass
-        except Exception, e:
-            logging.error("Unhandled Exception %s" % e)
-        # We're done
-        self.running = False
-        logging.info("Exiting")
+
+    def hosts_changed(self, host):
+        """
+        Called whenever the host table changes; host is the hostname that
+        was set or deleted, a list of them for a batch of changes, or None
+        if the whole table was replaced.
+        """
+        changed = None
+        if isinstance(host, list):
+            changed = set(host)
+        elif host is not None:
+            changed = set([host])
+        if self.health_checker is not None:
+            self.health_checker.hosts_changed()
+        # Drop the caches of hosts no longer using them
+        for cached_host in self.response_caches.keys():
+            if changed is None or cached_host in changed:
+                if self.hosts.get(cached_host, [None])[0] not in ("cache", "alias"):
+                    self.response_caches.pop(cached_host).clear()
+        # New backend objects start out draining if their address is
+        if self.draining_backends:
+            if changed is None:
+                self.apply_draining()
+            else:
+                self.apply_draining([self.hosts[name] for name in changed if name in self.hosts])
+        if self.changes is not None:
+            if changed is None:
+                self.changes.record({"type": "replace"})
+            else:
+                for name in sorted(changed):
+                    if name in self.hosts:
+                        self.changes.record({"type": "set", "host": name, "settings": self.hosts[name]})
+                    else:
+                        self.changes.record({"type": "delete", "host": name})
+        if self.worker_manager is None:
+            return
+        if host is None:
+            self.worker_manager.broadcast({"type": "replace", "hosts": dict(self.hosts)}, len(self.hosts))
+        elif isinstance(host, list):
+            self.worker_manager.broadcast({
+                "type": "batch",
+                "set": dict((name, self.hosts[name]) for name in host if name in self.hosts),
+                "delete": [name for name in host if name not in self.hosts],
+            }, len(host))
+        elif host in self.hosts:
+            self.worker_manager.broadcast({"type": "set", "host": host, "settings": self.hosts[host]})
+        else:
+            self.worker_manager.broadcast({"type": "delete", "host": host})
+
+    def backend_blacklist_changed(self, backend):
+        """
+        Records a backend address going in or out of the blacklist in the
+        change feed; an address is blacklisted while any Backend for it is.
+        Called once each time a Backend is blacklisted, and once when it
+        stops being so (by being unblacklisted or retired).
+        """
+        address = (backend.host, backend.port)
+        count = self.blacklisted_counts.get(address, 0)
+        if backend.blacklisted and not backend.retired:
+            self.blacklisted_counts[address] = count + 1
+            if count:
+                return
+        else:
+            if count > 1:
+                self.blacklisted_counts[address] = count - 1
+                return
+            self.blacklisted_counts.pop(address, None)
+            if not count:
+                return
+        self.changes.record({
+            "type": "blacklist" if self.blacklisted_counts.get(address) else "unblacklist",
+            "backend": "%s:%s" % address,
+        })
+
+    def response_cache(self, host, max_bytes, max_object_bytes, disk_dir=None, disk_max_bytes=0):
+        """
+        Returns the ResponseCache of a hostname, making it if there is none
+        or its settings have changed.
+        """
+        cache = self.response_caches.get(host)
+        if cache is None or cache.settings() != (max_bytes, max_object_bytes, disk_dir, disk_max_bytes):
+            if cache is not None:
+                cache.clear()
+            cache = self.response_caches[host] = ResponseCache(max_bytes, max_object_bytes, disk_dir, disk_max_bytes)
+        return cache
+
+    def mirror_target(self, address, max_queued, concurrency, timeout):
+        """
+        Returns the MirrorTarget for a (host, port) mirror address, making
+        it if there is none, with the given limits.
+        """
+        target = self.mirror_targets.get(address)
+        if target is None:
+            target = self.mirror_targets[address] = MirrorTarget(address, max_queued, concurrency, timeout, self.metrics)
+        else:
+            target.configure(max_queued, concurrency, timeout)
+        return target
+
+    def snapshot_stats(self):
+        "Folds the request counters into self.stats, and returns it"
+        for host, counters in self.counters.items():
+            counters.fold_into(self.stats.setdefault(host, {}))
+            if not counters.open_requests:
+                # Nothing still holds it; a new one is made when needed
+                del self.counters[host]
+        return self.stats
+
+    def reset_stats(self, host):
+        "Starts the stats of a hostname again from nothing"
+        self.stats[host] = {}
+        self.counters.pop(host, None)
+
+    def remove_stats(self, host):
+        "Forgets the stats of a hostname"
+        self.stats.pop(host, None)
+        self.counters.pop(host, None)
+
+    def collect_stats(self):
+        "Returns the stats for every host, including any worker processes'"
+        self.snapshot_stats()
+        if self.worker_manager is None:
+            return self.stats
+        stats = {}
+        for source in [self.stats] + self.worker_manager.stats():
+            for host, values in source.items():
+                merged = stats.setdefault(host, {})
+                for key, value in values.items():
+                    merged[key] = merged.get(key, 0) + value
+        return stats
+
+    def collect_sessions(self):
+        "Returns the stats of every relay in progress, including any worker processes'"
+        now = time.time()
+        sessions = [melder.stats(now) for melder in self.sessions]
+        if self.worker_manager is not None:
+            for worker_sessions in self.worker_manager.sessions():
+                sessions.extend(worker_sessions)
+        return sessions
+
+    def collect_metrics(self):
+        "Returns the Metrics of this process merged with any worker processes'"
+        if self.worker_manager is None:
+            return self.metrics
+        metrics = Metrics()
+        metrics.merge(self.metrics.dump())
+        for dumped in self.worker_manager.metrics():
+            metrics.merge(dumped)
+        return metrics
+
+    def backends(self, entries=None):
+        "Yields the Backend objects of the given host entries (default all)"
+        if entries is None:
+            entries = self.hosts.values()
+        for action, kwargs, allow_subs in entries:
+            backends = kwargs.get("backends")
+            if isinstance(backends, list):
+                for backend in backends:
+                    if isinstance(backend, mantrid.backend.Backend):
+                        yield backend
+
+    def apply_draining(self, entries=None):
+        "Sets the draining flag of backends to match draining_backends"
+        for backend in self.backends(entries):
+            draining = (backend.host, backend.port) in self.draining_backends
+            if backend.draining != draining:
+                backend.draining = draining
+
+    def set_backend_draining(self, address, draining):
+        """
+        Starts or stops draining every backend at address (a (host, port)
+        tuple), under any hostname.
+        """
+        if draining:
+            self.draining_backends.add(address)
+        else:
+            self.draining_backends.discard(address)
+        self.apply_draining()
+        if self.worker_manager is not None:
+            self.worker_manager.broadcast({"type": "draining", "addresses": sorted(self.draining_backends)})
+
+    def backend_connections(self):
+        "Returns the open connections to each backend address, including any worker processes'"
+        connections = dict(mantrid.backend.address_connections)
+        if self.worker_manager is not None:
+            for worker_connections in self.worker_manager.backend_connections():
+                for host, port, count in worker_connections:
+                    connections[(host, port)] = connections.get((host, port), 0) + count
+        return connections
 
     ### Management ###
 
@@ -229,30 +838,30 @@ class Balancer(object):
         """
         Saves the state if it has changed.
         """
-        last_hash = hash(repr(self.hosts))
         while self.running:
             try:
                 eventlet.sleep(self.save_interval)
-                next_hash = hash(repr(self.hosts))
-                if next_hash != last_hash:
-                    self.save()
-                    last_hash = next_hash
+                # Once draining, the new process owns the state file
+                if not self.running:
+                    break
+                self.save_changes()
             except:
               logging.error("Failed to save state", exc_info=True)
 
-    def management_loop(self, address, family):
+    def management_loop(self, address, family, sock=None):
         """
         Accepts management requests.
         """
         while True:
             try:
-                try:
-                    sock = eventlet.listen(address, family)
-                except socket.error, e:
-                    logging.critical("Cannot listen on (%s, %s): %s" % (address, family, e))
-                    return
-                # Sleep to ensure we've dropped privileges by the time we start serving
-                eventlet.sleep(0.5)
+                if sock is None:
+                    try:
+                        sock = eventlet.listen(address, family)
+                    except socket.error, e:
+                        logging.critical("Cannot listen on (%s, %s): %s" % (address, family, e))
+                        return
+                    # Sleep to ensure we've dropped privileges by the time we start serving
+                    eventlet.sleep(0.5)
                 # Actually serve management
                 logging.info("Listening for management on %s" % (address, ))
                 management_app = ManagementApp(self)
@@ -265,30 +874,37 @@ class Balancer(object):
                         )
                 finally:
                     sock.close()
+                    sock = None
+            except SystemExit:
+                # Killed by drain(); the new process serves management now
+                return
             except:
                 logging.error("Management loop failed with exception", exc_info=True)
                 # don't let it spin too fast
                 eventlet.sleep(1)
+            if self.drained is not None:
+                return
 
     ### Client handling ###
 
-    def listen_loop(self, address, family, internal=False):
+    def listen_loop(self, address, family, internal=False, sock=None):
         """
-        Accepts incoming connections.
+        Accepts incoming connections, on sock if it is already listening.
         """
-        try:
-            sock = eventlet.listen(address, family)
-        except socket.error, e:
-            if e.errno == errno.EADDRINUSE:
-                logging.critical("Cannot listen on (%s, %s): already in use" % (address, family))
-                raise
-            elif e.errno == errno.EACCES and address[1] <= 1024:
-                logging.critical("Cannot listen on (%s, %s) (you might need to launch as root)" % (address, family))
+        if sock is None:
+            try:
+                sock = eventlet.listen(address, family)
+            except socket.error, e:
+                if e.errno == errno.EADDRINUSE:
+                    logging.critical("Cannot listen on (%s, %s): already in use" % (address, family))
+                    raise
+                elif e.errno == errno.EACCES and address[1] <= 1024:
+                    logging.critical("Cannot listen on (%s, %s) (you might need to launch as root)" % (address, family))
+                    return
+                logging.critical("Cannot listen on (%s, %s): %s" % (address, family, e))
                 return
-            logging.critical("Cannot listen on (%s, %s): %s" % (address, family, e))
-            return
-        # Sleep to ensure we've dropped privileges by the time we start serving
-        eventlet.sleep(0.5)
+            # Sleep to ensure we've dropped privileges by the time we start serving
+            eventlet.sleep(0.5)
         # Start serving
         logging.info("Listening for requests on %s" % (address, ))
         try:
@@ -304,82 +920,134 @@ class Balancer(object):
         # Special case for empty hosts dict
         if not self.hosts:
             return NoHosts(self, host, "unknown")
+        # Reuse the action if we've seen this host since the last change
+        routes = self.hosts.routes
+        action = routes.cached_action(host, protocol)
+        if action is not None:
+            return action
         # Check for an exact or any subdomain matches
-        bits = host.split(".")
-        for i in range(len(bits)):
-            for prefix in ["%s://" % protocol, ""]:
-                subhost = prefix + (".".join(bits[i:]))
-                if subhost in self.hosts:
-                    action, kwargs, allow_subs = self.hosts[subhost]
-                    if allow_subs or i == 0:
-                        action_class = self.action_mapping[action]
-                        return action_class(
-                            balancer = self,
-                            host = host,
-                            matched_host = subhost,
-                            **kwargs
-                        )
-        return Unknown(self, host, "unknown")
+        entry = routes.lookup(host, protocol)
+        if entry is None:
+            return Unknown(self, host, "unknown")
+        matched_host, (action, kwargs, allow_subs) = entry
+        action_class = self.action_mapping[action]
+        action = action_class(
+            balancer = self,
+            host = host,
+            matched_host = matched_host,
+            **kwargs
+        )
+        routes.remember_action(host, protocol, action)
+        return action
 
     def handle(self, sock, address, internal=False):
         """
         Handles an incoming HTTP connection.
         """
+        sock = StatsSocket(sock)
+        client = BufferedSocket(sock)
+        self.open_connections += 1
         try:
-            sock = StatsSocket(sock)
-            rfile = sock.makefile('rb', 4096)
-            # Read the first line
-            first = rfile.readline().strip("\r\n")
-            words = first.split()
+            while self.handle_request(client, sock, address, internal):
+                # Wait a bounded time for another request on this connection
+                if not client.buffer:
+                    with Timeout(self.keepalive_timeout, False):
+                        client.fill()
+                    if not client.buffer:
+                        break
+        except socket.error, e:
+            if e.errno not in (errno.EPIPE, errno.ETIMEDOUT, errno.ECONNRESET):
+                logging.error("Loadbalancer socket error, error: %s", e)
+        finally:
+            self.open_connections -= 1
+            try:
+                sock.close()
+            except Exception, e:
+                logging.error("Unhandled Exception %s" % e)
+
+    def handle_request(self, client, sock, address, internal=False):
+        """
+        Handles a single request read from the client connection.
+        Returns True if the connection can be used for another request.
+        """
+        request_id = "-"
+        host = "unknown"
+        matched_host = "unknown"
+        headers = None
+        start = time.time()
+        try:
+            # Read the request head
+            try:
+                headers = read_request_head(client)
+            except FramingError:
+                headers = None
             # Ensure it looks kind of like HTTP
-            if not (2 <= len(words) <= 3):
+            if headers is None:
                 sock.sendall("HTTP/1.0 400 Bad Request\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
-                return
-            path = words[1]
-            # Read the headers
-            headers = mimetools.Message(rfile, 0)
+                return False
+            path = headers.path
             # Work out the host
-            try:
-                host = headers['X-Loadbalance-To'] if 'X-Loadbalance-To' in headers else headers['LoadBalanceTo']
-            except KeyError:
-                host = "unknown"
+            host = headers.get('X-Loadbalance-To') or headers.get('LoadBalanceTo') or "unknown"
             request_id = headers.get("X-Request-Id", "-")
-            headers['Connection'] = "close\r"
+            # See if the client wants to send more requests after this one
+            keepalive = False
+            if self.keepalive_timeout:
+                connection = [token.strip() for token in headers.get("Connection", "").lower().split(",")]
+                if headers.version == "HTTP/1.1":
+                    keepalive = "close" not in connection
+                else:
+                    keepalive = "keep-alive" in connection
+            headers.set('Connection', "close")
             if not internal:
-                headers['X-Forwarded-For'] = address[0]
-                headers['X-Forwarded-Protocol'] = ""
-                headers['X-Forwarded-Proto'] = ""
-            # Make sure they're not using odd encodings
+                headers.set('X-Forwarded-For', address[0])
+                headers.set('X-Forwarded-Protocol', "")
+                headers.set('X-Forwarded-Proto', "")
+            # Make sure they're not using odd encodings; chunked bodies are
+            # streamed through, but we can't find the end of anything else.
             if "Transfer-Encoding" in headers:
-                sock.sendall("HTTP/1.0 411 Length Required\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
-                return
+                if headers['Transfer-Encoding'].split(",")[-1].strip().lower() != "chunked":
+                    sock.sendall("HTTP/1.0 411 Length Required\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+                    return False
+                # Transfer-Encoding wins; don't let the backend see both
+                headers.remove('Content-Length')
             # Match the host to an action
             protocol = "http"
             if headers.get('X-Forwarded-Protocol', headers.get('X-Forwarded-Proto', "")).lower() in ("ssl", "https"):
                 protocol = "https"
             action = self.resolve_host(host, protocol)
+            matched_host = action.matched_host
+            # Only actions that understand response framing can keep it open
+            kwargs = {}
+            if keepalive and action.supports_keepalive:
+                kwargs['keepalive'] = True
             # Record us as an open connection
-            stats_dict = self.stats.setdefault(action.matched_host, {})
-            stats_dict['open_requests'] = stats_dict.get('open_requests', 0) + 1
-            # Run the action
+            counters = self.counters.get(matched_host)
+            if counters is None:
+                counters = self.counters[matched_host] = HostCounters()
+            counters.open_requests += 1
+            # Run the action. Anything the client sent after the headers is
+            # left buffered in the client socket for the action to read.
             try:
-                rfile._rbuf.seek(0)
-                action.handle(
-                    sock = sock,
-                    read_data = first + "\r\n" + str(headers) + "\r\n" + rfile._rbuf.read(),
+                reusable = action.handle(
+                    sock = client,
+                    read_data = str(headers),
                     path = path,
                     headers = headers,
+                    **kwargs
                 )
             finally:
-                stats_dict['open_requests'] -= 1
-                stats_dict['completed_requests'] = stats_dict.get('completed_requests', 0) + 1
-                stats_dict['bytes_sent'] = stats_dict.get('bytes_sent', 0) + sock.bytes_sent
-                stats_dict['bytes_received'] = stats_dict.get('bytes_received', 0) + sock.bytes_received
+                counters.open_requests -= 1
+                counters.completed_requests += 1
+                counters.bytes_sent += sock.bytes_sent
+                counters.bytes_received += sock.bytes_received
+                self.stats_dirty = True
+            return bool(kwargs and reusable)
         except socket.error, e:
             if e.errno not in (errno.EPIPE, errno.ETIMEDOUT, errno.ECONNRESET):
                 logging.error("[%s] Loadbalancer socket error, error: %s", request_id, e)
         except NoHealthyBackends, e:
             logging.error("[%s] No healthy backends available for host '%s'", request_id, host)
+            self.metrics.increment("mantrid_responses_total", (("host", matched_host), ("code", "597")))
             try:
                 sock.sendall("HTTP/1.0 597 No Healthy Backends\r\n\r\nNo healthy backends available.")
             except socket.error, e:
@@ -393,14 +1061,36 @@ class Balancer(object):
                 if e.errno != errno.EPIPE:
                     raise
         finally:
-            try:
-                sock.close()
-                rfile.close()
-            except Exception, e:
-                logging.error("Unhandled Exception %s" % e)
+            # Connections closed before sending anything aren't requests
+            if self.access_log is not None and (headers is not None or sock.bytes_received):
+                self.access_log.record((
+                    start,
+                    time.time() - start,
+                    request_id,
+                    address[0],
+                    headers.method if headers is not None else "-",
+                    headers.path if headers is not None else "-",
+                    host,
+                    matched_host,
+                    headers.backend if headers is not None else None,
+                    sock.response_start,
+                    sock.bytes_sent,
+                    sock.bytes_received,
+                    headers.first_byte if headers is not None else None,
+                ))
+            sock.bytes_sent = sock.bytes_received = 0
+            sock.response_start = None
+        return False
 
     def _set_hosts(self, hosts):
-        self.__dict__['hosts'] = ManagedHostDict(hosts)
+        # A ManagedHostDict nothing else uses yet (one made in a thread
+        # by the management API) is used as it is, so the swap is quick
+        if not isinstance(hosts, ManagedHostDict) or hosts.on_change is not None:
+            hosts = ManagedHostDict(hosts)
+        self.__dict__['hosts'] = hosts
+        self.hosts_replaced = True
+        self.hosts.on_change = self.hosts_changed
+        self.hosts_changed(None)
 
     def _get_hosts(self):
         return self.__dict__['hosts']
@@ -1,6 +1,13 @@
+import hashlib
 import re
+import time
+import urlparse
+
+import eventlet
+from eventlet.semaphore import Semaphore
 
 import mantrid.json
+from mantrid.backend import Backend
 
 
 class HttpNotFound(Exception):
@@ -18,6 +25,28 @@ class HttpBadRequest(Exception):
     pass
 
 
+class TextResponse(object):
+    """
+    A handler result that is sent as it is, rather than as JSON. If it
+    has an etag, requests that already have it get a 304 instead.
+    The body may be a function returning it, which is then only called
+    if the body is going to be sent.
+    """
+
+    def __init__(self, content_type, body, etag=None):
+        self.content_type = content_type
+        self.body = body
+        self.etag = etag
+
+
+class StreamResponse(object):
+    "A handler result whose body is sent, chunk by chunk, as it is made."
+
+    def __init__(self, content_type, chunks):
+        self.content_type = content_type
+        self.chunks = chunks
+
+
 class ManagementApp(object):
     """
     Management WSGI app for the Mantrid loadbalancer.
@@ -27,9 +56,24 @@ class ManagementApp(object):
 
     host_regex = re.compile(r"^/hostname/([^/]+)/?$")
     stats_host_regex = re.compile(r"^/stats/([^/]+)/?$")
+    backend_regex = re.compile(r"^/backend/([^/]+):(\d+)/?$")
+
+    # How often a drain request checks if the backend has finished
+    drain_poll_interval = 0.25
+    # The longest a /changes/ request may wait for a change
+    changes_max_wait = 300
+    # How often a streamed /changes/ sends a blank line when nothing happens
+    changes_heartbeat = 15
+    # Request bodies at least this big are decoded in a thread
+    offload_body_size = 65536
 
     def __init__(self, balancer):
         self.balancer = balancer
+        # Kept between requests so only changed entries are encoded again
+        self.hosts_json = mantrid.json.EncodedItems()
+        self.stats_json = mantrid.json.EncodedItems(by_value=True)
+        # EncodedItems aren't safe to use from two threads at once
+        self.encode_lock = Semaphore()
 
     def handle(self, environ, start_response):
         "Main entry point"
@@ -48,15 +92,44 @@ class ManagementApp(object):
         except HttpMethodNotAllowed:
             start_response('405 Method Not Allowed', [('Content-Type', 'application/json')])
             return [mantrid.json.dumps({"error": "method_not_allowed"})]
+        # A hot restart has saved the state for the new process to load,
+        # so changes made now would be lost
+        if self.balancer.restarting and environ['REQUEST_METHOD'].lower() != "get":
+            start_response('503 Service Unavailable', [('Content-Type', 'application/json')])
+            return [mantrid.json.dumps({"error": "restarting"})]
         # Dispatch to the named method
         body = environ['wsgi.input'].read()
-        if body:
+        if len(body) >= self.offload_body_size:
+            body = self.balancer.offload(None, mantrid.json.loads, body)
+        elif body:
             body = mantrid.json.loads(body)
-        response = handler(
-            environ['PATH_INFO'].lower(),
-            body,
-        )
+        if not body and environ['REQUEST_METHOD'].lower() == "get":
+            # GETs take their parameters from the query string instead
+            body = dict(urlparse.parse_qsl(environ.get('QUERY_STRING', '')))
+        try:
+            response = handler(
+                environ['PATH_INFO'].lower(),
+                body,
+            )
+        except HttpBadRequest, e:
+            start_response('400 Bad Request', [('Content-Type', 'application/json')])
+            return [mantrid.json.dumps({"error": str(e)})]
         # Send the response
+        if isinstance(response, TextResponse):
+            headers = [('Content-Type', response.content_type)]
+            if response.etag is not None:
+                headers.append(('ETag', response.etag))
+                if etag_matches(response.etag, environ.get('HTTP_IF_NONE_MATCH')):
+                    start_response('304 Not Modified', headers)
+                    return []
+            body = response.body() if callable(response.body) else response.body
+            start_response('200 OK', headers)
+            return [body]
+        if isinstance(response, StreamResponse):
+            # Send each chunk as soon as it's made, rather than in 4KB lots
+            environ['eventlet.minimum_write_chunk_size'] = 0
+            start_response('200 OK', [('Content-Type', response.content_type)])
+            return response.chunks
         start_response('200 OK', [('Content-Type', 'application/json')])
         return [mantrid.json.dumps(response)]
 
@@ -74,11 +147,40 @@ class ManagementApp(object):
                 return self.get_single_stats
             else:
                 raise HttpMethodNotAllowed()
+        elif path in ("/metrics", "/metrics/"):
+            if method == "get":
+                return self.get_metrics
+            else:
+                raise HttpMethodNotAllowed()
+        elif path == "/sessions/":
+            if method == "get":
+                return self.get_sessions
+            else:
+                raise HttpMethodNotAllowed()
+        elif path == "/changes/":
+            if method == "get":
+                return self.get_changes
+            else:
+                raise HttpMethodNotAllowed()
+        elif path == "/backend/":
+            if method == "get":
+                return self.get_all_backends
+            else:
+                raise HttpMethodNotAllowed()
+        elif self.backend_regex.match(path):
+            if method == "get":
+                return self.get_backend
+            elif method == "put":
+                return self.set_backend
+            else:
+                raise HttpMethodNotAllowed()
         elif path == "/hostname/":
             if method == "get":
                 return self.get_all
             elif method == "put":
                 return self.set_all
+            elif method == "patch":
+                return self.update_many
             else:
                 raise HttpMethodNotAllowed()
         elif self.host_regex.match(path):
@@ -112,34 +214,117 @@ class ManagementApp(object):
             return "host_kwargs_not_dict"
         if not isinstance(details[2], bool):
             return "host_match_subdomains_not_bool"
+        # Actions can check their own options
+        options_errors = getattr(self.balancer.action_mapping[details[0]], "options_errors", None)
+        if options_errors is not None:
+            error = options_errors(details[1])
+            if error:
+                return error
+        # Actions that pick between backends must use a known algorithm
+        algorithm_mapping = getattr(self.balancer.action_mapping[details[0]], "algorithm_mapping", None)
+        if algorithm_mapping is not None:
+            algorithm = details[1].get("algorithm", self.balancer.action_mapping[details[0]].default_algorithm)
+            if algorithm not in algorithm_mapping:
+                return "host_algorithm_invalid:%s" % algorithm
+            error = algorithm_mapping[algorithm].options_errors(details[1])
+            if error:
+                return error
+            for backend in details[1].get("backends", []):
+                if isinstance(backend, Backend) and not (isinstance(backend.weight, int) and 1 <= backend.weight <= Backend.max_weight):
+                    return "host_backend_weight_invalid"
+            # The health checker probes with these, and can't skip a bad one
+            status = details[1].get("healthcheck_status")
+            if status is not None and not (isinstance(status, int) and not isinstance(status, bool) and 100 <= status <= 599):
+                return "host_healthcheck_status_invalid"
+            path = details[1].get("healthcheck_path")
+            if path is not None and not (isinstance(path, basestring) and path.startswith("/") and "\r" not in path and "\n" not in path):
+                return "host_healthcheck_path_invalid"
         return None
 
+    def validate_hosts(self, hosts):
+        "Raises HttpBadRequest if any entry of a hostname: rule dict is invalid"
+        for hostname, details in hosts.items():
+            error = self.host_errors(hostname, details)
+            if error:
+                raise HttpBadRequest("%s:%s" % (hostname, error))
+
+    def prepare_hosts(self, hosts):
+        "Validates a new host table, and returns it ready to swap in"
+        # Imported here, as the loadbalancer module imports this one
+        from mantrid.loadbalancer import ManagedHostDict
+        self.validate_hosts(hosts)
+        return ManagedHostDict(hosts)
+
+    def encode(self, items, mapping):
+        """
+        Returns mapping encoded as JSON by an EncodedItems. The values must
+        not change while it is encoded, which may be in a thread; the
+        mapping itself is copied here.
+        """
+        with self.encode_lock:
+            return self.balancer.offload(len(mapping), items.encode, dict(mapping))
+
     def get_all(self, path, body):
-        return self.balancer.hosts
+        changes = self.balancer.changes
+        hosts = self.balancer.hosts
+        return TextResponse(
+            "application/json",
+            # Not encoded at all for a 304
+            lambda: self.encode(self.hosts_json, hosts),
+            # Every change to the table gets a new revision
+            '"%s-%i"' % (changes.epoch, changes.revision),
+        )
 
     def set_all(self, path, body):
         "Replaces the hosts list with the provided input"
         # Do some error checking
         if not isinstance(body, dict):
             raise HttpBadRequest("body_not_a_dict")
-        for hostname, details in body.items():
-            error = self.host_errors(hostname, details)
-            if error:
-                raise HttpBadRequest("%s:%s" % (hostname, error))
+        # Validating and indexing a big table is done in a thread, so
+        # only the swap itself happens here
+        hosts = self.balancer.offload(len(body), self.prepare_hosts, body)
         # Replace
         old_hostnames = set(self.balancer.hosts.keys())
         new_hostnames = set(body.keys())
-        self.balancer.hosts = body
+        self.balancer.hosts = hosts
         # Clean up stats dict
         for hostname in new_hostnames - old_hostnames:
-            self.balancer.stats[hostname] = {}
+            self.balancer.reset_stats(hostname)
         for hostname in old_hostnames - new_hostnames:
-            try:
-                del self.balancer.stats[hostname]
-            except KeyError:
-                pass
+            self.balancer.remove_stats(hostname)
         return {"ok": True}
 
+    def update_many(self, path, body):
+        """
+        Sets and deletes many hostnames in one go; body is a dict with a
+        "set" dict (hostname: rule) and a "delete" list of hostnames.
+        Nothing is changed unless every rule is valid.
+        """
+        if not isinstance(body, dict):
+            raise HttpBadRequest("body_not_a_dict")
+        for key in body:
+            if key not in ("set", "delete"):
+                raise HttpBadRequest("batch_key_invalid:%s" % key)
+        sets = body.get("set", {})
+        deletes = body.get("delete", [])
+        if not isinstance(sets, dict):
+            raise HttpBadRequest("batch_set_not_dict")
+        if not isinstance(deletes, list):
+            raise HttpBadRequest("batch_delete_not_list")
+        self.balancer.offload(len(sets), self.validate_hosts, sets)
+        for hostname in deletes:
+            if not isinstance(hostname, basestring):
+                raise HttpBadRequest("batch_delete_not_hostname")
+            if hostname in sets:
+                raise HttpBadRequest("%s:batch_set_and_delete" % hostname)
+        changed = self.balancer.hosts.update_many(sets, deletes)
+        for hostname in changed:
+            if hostname in sets:
+                self.balancer.reset_stats(hostname)
+            else:
+                self.balancer.remove_stats(hostname)
+        return {"ok": True, "changed": sorted(changed)}
+
     def get_single(self, path, body):
         host = self.host_regex.match(path).group(1)
         if host in self.balancer.hosts:
@@ -153,7 +338,7 @@ class ManagementApp(object):
         if error:
             raise HttpBadRequest("%s:%s" % (host, error))
         self.balancer.hosts[host] = body
-        self.balancer.stats[host] = {}
+        self.balancer.reset_stats(host)
         return {"ok": True}
 
     def delete_single(self, path, body):
@@ -162,15 +347,113 @@ class ManagementApp(object):
             del self.balancer.hosts[host]
         except KeyError:
             pass
-        try:
-            del self.balancer.stats[host]
-        except KeyError:
-            pass
+        self.balancer.remove_stats(host)
         return {"ok": True}
 
     def get_all_stats(self, path, body):
-        return self.balancer.stats
+        # Copies, as the stats are updated in place while requests run
+        stats = dict((host, dict(values)) for host, values in self.balancer.collect_stats().items())
+        encoded = self.encode(self.stats_json, stats)
+        return TextResponse("application/json", encoded, '"%s"' % hashlib.md5(encoded).hexdigest())
 
     def get_single_stats(self, path, body):
         host = self.stats_host_regex.match(path).group(1)
-        return self.balancer.stats.get(host, {})
+        return self.balancer.collect_stats().get(host, {})
+
+    def get_metrics(self, path, body):
+        return TextResponse(
+            "text/plain; version=0.0.4",
+            self.balancer.collect_metrics().render(self.balancer.collect_stats()),
+        )
+
+    def get_sessions(self, path, body):
+        return self.balancer.collect_sessions()
+
+    def get_changes(self, path, body):
+        """
+        Returns the changes after the "since" revision (default 0), waiting
+        up to "wait" seconds for one if there are none yet. If "stream" is
+        set, keeps sending each batch of changes as a line of JSON instead.
+        """
+        if not isinstance(body, dict):
+            raise HttpBadRequest("body_not_a_dict")
+        try:
+            since = int(body.get("since", 0))
+        except (TypeError, ValueError):
+            raise HttpBadRequest("changes_since_invalid")
+        try:
+            wait = float(body.get("wait", 0))
+        except (TypeError, ValueError):
+            raise HttpBadRequest("changes_wait_invalid")
+        if since < 0:
+            raise HttpBadRequest("changes_since_invalid")
+        if not 0 <= wait <= self.changes_max_wait:
+            raise HttpBadRequest("changes_wait_invalid")
+        epoch = body.get("epoch") or None
+        if body.get("stream") in (None, "", "0", "false", False, 0):
+            return self.balancer.changes.response(since, wait, epoch)
+        replies = self.balancer.changes.stream(
+            since,
+            self.changes_heartbeat,
+            epoch,
+            lambda: self.balancer.running,
+        )
+        return StreamResponse("application/x-ndjson", (
+            "\n" if reply is None else mantrid.json.dumps(reply) + "\n"
+            for reply in replies
+        ))
+
+    def backend_status(self, address, connections):
+        return {
+            "connections": connections.get(address, 0),
+            "draining": address in self.balancer.draining_backends,
+        }
+
+    def get_all_backends(self, path, body):
+        connections = self.balancer.backend_connections()
+        addresses = set(connections) | self.balancer.draining_backends
+        addresses.update((backend.host, backend.port) for backend in self.balancer.backends())
+        return dict(
+            ("%s:%s" % address, self.backend_status(address, connections))
+            for address in addresses
+        )
+
+    def get_backend(self, path, body):
+        match = self.backend_regex.match(path)
+        address = (match.group(1), int(match.group(2)))
+        return self.backend_status(address, self.balancer.backend_connections())
+
+    def set_backend(self, path, body):
+        """
+        Starts or stops draining a backend. If the body has a "wait" number
+        of seconds, waits up to that long for its connections to finish.
+        """
+        match = self.backend_regex.match(path)
+        address = (match.group(1), int(match.group(2)))
+        if not isinstance(body, dict):
+            raise HttpBadRequest("body_not_a_dict")
+        if not isinstance(body.get("draining"), bool):
+            raise HttpBadRequest("backend_draining_not_bool")
+        wait = body.get("wait", 0)
+        if isinstance(wait, bool) or not isinstance(wait, (int, long, float)) or wait < 0:
+            raise HttpBadRequest("backend_wait_invalid")
+        self.balancer.set_backend_draining(address, body["draining"])
+        deadline = time.time() + wait
+        status = self.backend_status(address, self.balancer.backend_connections())
+        while status["draining"] and status["connections"] and time.time() < deadline:
+            eventlet.sleep(min(self.drain_poll_interval, max(0, deadline - time.time())))
+            status = self.backend_status(address, self.balancer.backend_connections())
+        return status
+
+
+def etag_matches(etag, if_none_match):
+    "Returns True if an If-None-Match header value matches etag"
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag or tag == "*":
+            return True
+    return False
@@ -0,0 +1,147 @@
+"""
+Counters and latency histograms recorded while proxying, exported in the
+Prometheus text format at /metrics on the management port.
+
+Histograms have fixed buckets, so recording a value is a bisect and a
+couple of additions. Series are keyed by (name, labels), where labels is
+a tuple of (name, value) pairs; callers on the request path keep hold of
+the Histogram objects they use rather than looking them up every time.
+"""
+
+import bisect
+
+# Upper bounds, in seconds, of the latency histogram buckets
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Name: (type, help) for every metric we record
+descriptions = {
+    "mantrid_backend_connect_seconds": ("histogram", "Time taken to open a connection to a backend."),
+    "mantrid_backend_first_byte_seconds": ("histogram", "Time from sending a request to a backend until the first byte of its response."),
+    "mantrid_backend_request_seconds": ("histogram", "Time from sending a request to a backend until the exchange finished."),
+    "mantrid_backend_retries_total": ("counter", "Connection attempts that were retries of a failed one."),
+    "mantrid_backend_blacklists_total": ("counter", "Times a backend was blacklisted after a failed request."),
+    "mantrid_backend_timeouts_total": ("counter", "Backend connections or transfers that timed out."),
+    "mantrid_access_log_dropped_total": ("counter", "Access log entries dropped because too many were waiting to be written."),
+    "mantrid_mirror_requests_total": ("counter", "Copies of requests for mirrors, by whether they were sent, dropped or failed."),
+    "mantrid_responses_total": ("counter", "Error responses generated by the balancer itself, by status code."),
+    "mantrid_open_requests": ("gauge", "Requests currently being handled."),
+    "mantrid_requests_total": ("counter", "Requests handled."),
+    "mantrid_bytes_sent_total": ("counter", "Bytes sent to clients."),
+    "mantrid_bytes_received_total": ("counter", "Bytes received from clients."),
+}
+
+# Per-host /stats/ values, and the metric each is exported as
+stats_metrics = [
+    ("open_requests", "mantrid_open_requests"),
+    ("completed_requests", "mantrid_requests_total"),
+    ("bytes_sent", "mantrid_bytes_sent_total"),
+    ("bytes_received", "mantrid_bytes_received_total"),
+]
+
+
+class Histogram(object):
+    "Counts of observed values in fixed buckets, plus their sum."
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        # The last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """
+    All the counters and histograms of one process.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, labels, amount=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def histogram(self, name, labels):
+        "Returns the histogram for a series, making it if needed"
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[name, labels] = Histogram()
+        return histogram
+
+    def observe(self, name, labels, value):
+        self.histogram(name, labels).observe(value)
+
+    def dump(self):
+        "Returns the metrics as plain lists, to send between processes"
+        return {
+            "counters": [
+                [name, labels, value]
+                for (name, labels), value in self.counters.items()
+            ],
+            "histograms": [
+                [name, labels, histogram.counts, histogram.sum]
+                for (name, labels), histogram in self.histograms.items()
+            ],
+        }
+
+    def merge(self, dumped):
+        "Adds in metrics from another process's dump()"
+        for name, labels, value in dumped["counters"]:
+            self.increment(name, tuple(tuple(label) for label in labels), value)
+        for name, labels, counts, total in dumped["histograms"]:
+            histogram = self.histogram(name, tuple(tuple(label) for label in labels))
+            histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+            histogram.sum += total
+
+    def render(self, stats=None):
+        """
+        Returns the metrics in the Prometheus text exposition format,
+        along with the per-host values of a /stats/ dict if given.
+        """
+        # Name: [(labels, [(series line without its name, value)])]
+        series = {}
+        for (name, labels), value in self.counters.items():
+            series.setdefault(name, []).append((labels, [(format_labels(labels), value)]))
+        for (name, labels), histogram in self.histograms.items():
+            lines = []
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf", ), histogram.counts):
+                cumulative += count
+                lines.append((format_labels(labels + (("le", format_value(bound)), ), "_bucket"), cumulative))
+            lines.append((format_labels(labels, "_sum"), histogram.sum))
+            lines.append((format_labels(labels, "_count"), cumulative))
+            series.setdefault(name, []).append((labels, lines))
+        for host, values in (stats or {}).items():
+            labels = (("host", host), )
+            for key, name in stats_metrics:
+                series.setdefault(name, []).append((labels, [(format_labels(labels), values.get(key, 0))]))
+        output = []
+        for name in sorted(series):
+            kind, description = descriptions.get(name, ("untyped", name))
+            output.append("# HELP %s %s\n" % (name, description))
+            output.append("# TYPE %s %s\n" % (name, kind))
+            for labels, lines in sorted(series[name]):
+                for suffix_and_labels, value in lines:
+                    output.append("%s%s %s\n" % (name, suffix_and_labels, format_value(value)))
+        return "".join(output)
+
+
+def format_labels(labels, suffix=""):
+    """Returns the name suffix and {label="value"} part of a series line"""
+    if not labels:
+        return suffix
+    return "%s{%s}" % (suffix, ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    ))
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,113 @@
+"""
+Copies of requests sent to shadow backends by the mirror action.
+
+Each mirror address has a bounded queue of copies waiting to be sent, and
+at most concurrency greenthreads sending them, which read and throw away
+the responses. Copies that arrive while the queue is full are dropped,
+so a slow or dead mirror never holds up the requests being copied.
+"""
+
+import eventlet
+from eventlet.green import socket
+from eventlet.queue import Empty, Full, Queue
+from eventlet.timeout import Timeout
+
+
+class MirrorTarget(object):
+    """
+    One mirror address, shared by every host entry that mirrors to it;
+    the balancer keeps these so they outlive the action objects.
+    """
+
+    # Senders with nothing to send for this long exit
+    idle_timeout = 30
+
+    def __init__(self, address, max_queued, concurrency, timeout, metrics):
+        self.address = address
+        self.queue = Queue(max_queued)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.metrics = metrics
+        self.labels = (("mirror", "%s:%s" % address), )
+        self.senders = 0
+
+    def configure(self, max_queued, concurrency, timeout):
+        "Changes the limits, keeping anything already queued"
+        if self.queue.maxsize != max_queued:
+            self.queue.resize(max_queued)
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def put(self, data):
+        "Queues a request to send, or drops it if the queue is full"
+        try:
+            self.queue.put_nowait(data)
+        except Full:
+            self.count("dropped")
+            return False
+        if self.senders < self.concurrency:
+            self.senders += 1
+            eventlet.spawn_n(self.run)
+        return True
+
+    def run(self):
+        "Sends queued requests until there are none for idle_timeout"
+        try:
+            while self.senders <= self.concurrency:
+                try:
+                    data = self.queue.get(timeout=self.idle_timeout)
+                except Empty:
+                    return
+                self.send(data)
+        finally:
+            self.senders -= 1
+
+    def send(self, data):
+        "Sends one request, and reads the response until the mirror closes"
+        try:
+            with Timeout(self.timeout):
+                sock = eventlet.connect(self.address)
+                try:
+                    sock.sendall(data)
+                    while sock.recv(65536):
+                        pass
+                finally:
+                    sock.close()
+        except (socket.error, Timeout):
+            self.count("failed")
+        else:
+            self.count("sent")
+
+    def count(self, result):
+        self.metrics.increment("mantrid_mirror_requests_total", self.labels + (("result", result), ))
+
+
+class RecordingSocket(object):
+    """
+    Wrapper around a client socket that keeps a copy of the first limit
+    bytes received on it: the rest of a request body, as it is relayed.
+    """
+
+    def __init__(self, sock, limit):
+        self.sock = sock
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.sock, attr)
+
+    def recv(self, length):
+        data = self.sock.recv(length)
+        if self.size < self.limit:
+            self.chunks.append(data[:self.limit - self.size])
+            self.size += len(self.chunks[-1])
+        return data
+
+    @property
+    def complete(self):
+        return self.size >= self.limit
+
+    @property
+    def data(self):
+        return "".join(self.chunks)
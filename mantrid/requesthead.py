@@ -0,0 +1,209 @@
+"""
+Incremental parser for incoming request heads.
+
+The head is read into the client socket's buffer and its end found with
+plain string searches; only the header lines the balancer cares about
+are then parsed. Every other header is left as it arrived and passed on
+to the backend byte for byte.
+"""
+
+import re
+
+from mantrid.framing import FramingError
+
+# Headers that are parsed as the head is read; anything else is only
+# looked at if an action asks for it.
+parsed_headers = frozenset([
+    "x-loadbalance-to",
+    "loadbalanceto",
+    "x-request-id",
+    "connection",
+    "content-length",
+    "transfer-encoding",
+    "upgrade",
+    "x-forwarded-for",
+    "x-forwarded-protocol",
+    "x-forwarded-proto",
+])
+
+
+def header_regex(name):
+    "Returns a regex matching whole header lines called name, with any continuations"
+    return re.compile(r"(?im)^%s[ \t]*:(.*(?:\n[ \t].*)*)\n?" % re.escape(name))
+
+
+class RequestHead(object):
+    """
+    A request head, held as the raw bytes the client sent plus the values
+    of the headers in parsed_headers.
+
+    Behaves like a (read-only, case-insensitive) headers dict for actions.
+    Headers changed with set() or remove() have their original lines
+    dropped when the head is turned back into bytes, and the new values
+    appended; the rest of the head is copied through unchanged.
+
+    Actions that pass the request on set backend, and first_byte (how
+    long the backend took to start responding), for the access log.
+    """
+
+    backend = None
+    first_byte = None
+
+    def __init__(self, raw):
+        # raw is the head including the line break of its last line, but
+        # not the blank line that ends it.
+        self.raw = raw
+        end = raw.find("\n")
+        if end == -1:
+            end = len(raw)
+        self.first = raw[:end].rstrip("\r")
+        words = self.first.split()
+        if not (2 <= len(words) <= 3):
+            raise FramingError("bad_request_line")
+        self.method = words[0]
+        self.path = words[1]
+        self.version = words[2].upper() if len(words) == 3 else "HTTP/1.0"
+        self.headers_start = end + 1
+        self.values = {}
+        self.spans = {}
+        self.changes = {}
+        self.changed = []
+        self._parse()
+
+    def _parse(self):
+        "Records the values and positions of the headers we care about"
+        raw = self.raw
+        pos = self.headers_start
+        length = len(raw)
+        last = None
+        while pos < length:
+            end = raw.find("\n", pos)
+            if end == -1:
+                end = length
+            if raw[pos] in " \t":
+                # Folded continuation of the previous header
+                if last is not None:
+                    self.values[last] += " " + raw[pos:end].strip()
+                    start = self.spans[last][-1][0]
+                    self.spans[last][-1] = (start, end + 1)
+                pos = end + 1
+                continue
+            colon = raw.find(":", pos, end)
+            if colon == -1:
+                raise FramingError("bad_header_line")
+            name = raw[pos:colon].strip().lower()
+            if name in parsed_headers:
+                self.values[name] = raw[colon + 1:end].strip()
+                self.spans.setdefault(name, []).append((pos, end + 1))
+                last = name
+            else:
+                last = None
+            pos = end + 1
+        self._check_content_length()
+
+    def _check_content_length(self):
+        """
+        Rejects heads with differing Content-Lengths, which the backend
+        might frame differently from us (RFC 7230 section 3.3.3), and
+        merges repeats of the same one into a single header.
+        """
+        spans = self.spans.get("content-length", ())
+        lines = [self.raw[start:end] for start, end in spans]
+        lengths = set(
+            length.strip()
+            for line in lines
+            for length in line.split(":", 1)[1].split(",")
+        )
+        if len(lengths) > 1:
+            raise FramingError("conflicting_content_length")
+        if len(spans) > 1 or "," in self.values.get("content-length", ""):
+            self.values["content-length"] = lengths.pop()
+            self.set("Content-Length", self.values["content-length"])
+
+    def get(self, name, default=None):
+        "Returns the value of the last header called name."
+        name = name.lower()
+        if name in self.changes:
+            change = self.changes[name]
+            return default if change is None else change[1]
+        if name in parsed_headers:
+            return self.values.get(name, default)
+        # Not parsed up front; find it in the raw head
+        matches = header_regex(name).findall(self.raw, self.headers_start)
+        if not matches:
+            return default
+        return " ".join(line.strip() for line in matches[-1].split("\n")).strip()
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def set(self, name, value):
+        "Replaces any headers called name with a single new one."
+        self._change(name.lower(), (name, value))
+
+    def remove(self, name):
+        "Removes all headers called name."
+        self._change(name.lower(), None)
+
+    def _change(self, name, change):
+        if name not in self.changes:
+            self.changed.append(name)
+        self.changes[name] = change
+
+    def __str__(self):
+        "Returns the head as bytes to send on, ending with the blank line."
+        raw = self.raw
+        dropped = []
+        for name in self.changes:
+            if name in parsed_headers:
+                dropped.extend(self.spans.get(name, ()))
+            else:
+                dropped.extend(
+                    match.span()
+                    for match in header_regex(name).finditer(raw, self.headers_start)
+                )
+        parts = [self.first, "\r\n"]
+        pos = self.headers_start
+        for start, end in sorted(dropped):
+            parts.append(raw[pos:start])
+            pos = end
+        parts.append(raw[pos:])
+        for name in self.changed:
+            change = self.changes[name]
+            if change is not None:
+                parts.append("%s: %s\r\n" % change)
+        parts.append("\r\n")
+        return "".join(parts)
+
+
+def read_request_head(sock, limit=65536):
+    """
+    Reads a request head from a BufferedSocket, leaving anything after it
+    in the socket's buffer. Returns None if the connection closed before
+    a head arrived, and raises FramingError if it isn't a valid head.
+    """
+    start = 0
+    while True:
+        # The head ends at the first empty line, CRLF or bare LF
+        buffer = sock.buffer
+        end = buffer.find("\n\r\n", start)
+        bare_end = buffer.find("\n\n", start, None if end == -1 else end)
+        if bare_end != -1:
+            sock.buffer = buffer[bare_end + 2:]
+            return RequestHead(buffer[:bare_end + 1])
+        if end != -1:
+            sock.buffer = buffer[end + 3:]
+            return RequestHead(buffer[:end + 1])
+        if len(buffer) > limit:
+            raise FramingError("head_too_long")
+        start = max(0, len(buffer) - 2)
+        if not sock.fill():
+            if sock.buffer.strip():
+                raise FramingError("closed_in_head")
+            return None
@@ -0,0 +1,107 @@
+"""
+Hot restarts: starting a new copy of the balancer that inherits our
+listening sockets, so it can start serving before we stop.
+
+The listening sockets are passed on as inherited file descriptors, listed
+in an environment variable, and the new process writes to a pipe once it
+is accepting connections.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import resource
+import sys
+import time
+
+import eventlet
+from eventlet.green import socket
+
+LISTEN_FDS_VARIABLE = "MANTRID_LISTEN_FDS"
+READY_FD_VARIABLE = "MANTRID_READY_FD"
+
+
+def inherited_listeners():
+    """
+    Returns the listening sockets passed on by the process we are
+    replacing, as a list of (socket, kind) pairs where kind is one of
+    "external", "internal" or "management"; or None if this isn't a
+    hot restart.
+    """
+    spec = os.environ.pop(LISTEN_FDS_VARIABLE, None)
+    if not spec:
+        return None
+    listeners = []
+    for item in spec.split(","):
+        kind, fd, family = item.split(":")
+        sock = socket.fromfd(int(fd), int(family), socket.SOCK_STREAM)
+        # fromfd() duplicates the descriptor
+        os.close(int(fd))
+        listeners.append((sock, kind))
+    return listeners
+
+
+def signal_ready():
+    "Tells the process we are replacing that we're now serving"
+    fd = os.environ.pop(READY_FD_VARIABLE, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), "1")
+    except OSError, e:
+        logging.error("Cannot tell the old process we're ready: %s", e)
+    finally:
+        os.close(int(fd))
+
+
+def exec_replacement(listeners, ready_fd):
+    """
+    Replaces the current (freshly forked) process with a new copy of the
+    balancer, started with the same command line, which inherits the
+    given (socket, kind) listeners. Never returns.
+    """
+    try:
+        env = dict(os.environ)
+        env[LISTEN_FDS_VARIABLE] = ",".join(
+            "%s:%i:%i" % (kind, sock.fileno(), sock.family)
+            for sock, kind in listeners
+        )
+        env[READY_FD_VARIABLE] = str(ready_fd)
+        keep = set([0, 1, 2, ready_fd] + [sock.fileno() for sock, kind in listeners])
+        for fd in keep:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        # Don't pass on client connections, or they would never close
+        max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if max_fd == resource.RLIM_INFINITY:
+            max_fd = 65536
+        start = 0
+        for fd in sorted(keep) + [max_fd]:
+            if fd > start:
+                os.closerange(start, fd)
+            start = fd + 1
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
+    finally:
+        os._exit(1)
+
+
+def wait_until_ready(ready_fd, timeout):
+    "Returns True if the new process says it is ready within timeout seconds"
+    # Polled rather than waited on with the hub, which can be left watching
+    # a stale descriptor if the fd number is reused by a later restart.
+    deadline = time.time() + timeout
+    flags = fcntl.fcntl(ready_fd, fcntl.F_GETFL)
+    fcntl.fcntl(ready_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    try:
+        while time.time() < deadline:
+            try:
+                # An empty read means it exited without getting there
+                return os.read(ready_fd, 1) == "1"
+            except OSError, e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+            eventlet.sleep(0.1)
+        return False
+    finally:
+        os.close(ready_fd)
@@ -0,0 +1,167 @@
+"""
+Precompiled host routing index used by Balancer.resolve_host.
+"""
+
+import collections
+
+from mantrid.actions import Alias
+
+
+class RouteTable(object):
+    """
+    Index of a host dict that resolves hostnames without splitting or
+    formatting strings on every request.
+
+    For each protocol there is a dict of domain suffix -> (exact, subdomain),
+    where "exact" is the entry to use when the requested host is that suffix,
+    and "subdomain" is the entry to use when the requested host is a
+    subdomain of it (or None if nothing there allows subdomain matches).
+    Entries are (matched_host, settings) pairs.
+
+    The index is updated one key at a time as the host dict changes, and
+    also holds the action instances built for recently-seen hostnames.
+    A change to a key only drops the actions built from it (or aliasing
+    it), and those of hostnames it might now match instead.
+    """
+
+    protocols = ("http", "https")
+    max_cached_actions = 10000
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.tables = {}
+        # Per protocol: hostname -> action, oldest first, and
+        # key -> hostnames whose action was built from that key
+        self.actions = {}
+        self.dependents = {}
+        for protocol in self.protocols:
+            self._compile(protocol)
+
+    def _compile(self, protocol):
+        "Builds the suffix table for a protocol from scratch"
+        prefix = "%s://" % protocol
+        table = {}
+        for key in self.hosts:
+            suffix = self._suffix(prefix, key)
+            if suffix is not None:
+                table[suffix] = self._route(prefix, suffix)
+        self.tables[protocol] = table
+        self.actions[protocol] = collections.OrderedDict()
+        self.dependents[protocol] = {}
+        return table
+
+    def _suffix(self, prefix, key):
+        "Returns the bare hostname a key applies to under prefix, if any"
+        if key.startswith(prefix):
+            return key[len(prefix):]
+        elif "://" in key:
+            return None
+        return key
+
+    def _route(self, prefix, suffix):
+        "Works out the (exact, subdomain) entries for a single suffix"
+        specific = self.hosts.get(prefix + suffix)
+        generic = self.hosts.get(suffix)
+        if specific is None and generic is None:
+            return None
+        if specific is not None:
+            exact = (prefix + suffix, specific)
+        else:
+            exact = (suffix, generic)
+        if specific is not None and specific[2]:
+            subdomain = (prefix + suffix, specific)
+        elif generic is not None and generic[2]:
+            subdomain = (suffix, generic)
+        else:
+            subdomain = None
+        return (exact, subdomain)
+
+    def update(self, key):
+        "Recomputes the routes affected by a change to a single key"
+        for protocol, table in self.tables.items():
+            prefix = "%s://" % protocol
+            suffix = self._suffix(prefix, key)
+            dependents = self.dependents[protocol]
+            stale = set(dependents.get(key, ()))
+            if suffix is not None:
+                # Hostnames at or under suffix that matched a parent
+                # entry might match this key now, or stop matching it
+                name = suffix
+                while True:
+                    for candidate in (name, prefix + name):
+                        for host in dependents.get(candidate, ()):
+                            if host == suffix or host.endswith("." + suffix):
+                                stale.add(host)
+                    dot = name.find(".")
+                    if dot == -1:
+                        break
+                    name = name[dot + 1:]
+            for host in stale:
+                self._forget(protocol, host)
+            if suffix is None:
+                continue
+            route = self._route(prefix, suffix)
+            if route is None:
+                table.pop(suffix, None)
+            else:
+                table[suffix] = route
+
+    def lookup(self, host, protocol):
+        """
+        Returns the (matched_host, settings) entry for host, or None.
+        Tries an exact match first, then each parent domain in turn.
+        """
+        table = self.tables.get(protocol)
+        if table is None:
+            table = self._compile(protocol)
+        route = table.get(host)
+        if route is not None:
+            return route[0]
+        index = host.find(".")
+        while index != -1:
+            route = table.get(host[index + 1:])
+            if route is not None and route[1] is not None:
+                return route[1]
+            index = host.find(".", index + 1)
+        return None
+
+    def cached_action(self, host, protocol):
+        "Returns a previously-built action for this host, if any"
+        actions = self.actions.get(protocol)
+        if actions is None:
+            return None
+        return actions.get(host)
+
+    def remember_action(self, host, protocol, action):
+        "Stores a built action for reuse until the entries it uses change"
+        if protocol not in self.tables:
+            self._compile(protocol)
+        actions = self.actions[protocol]
+        if host in actions:
+            self._forget(protocol, host)
+        while len(actions) >= self.max_cached_actions:
+            self._forget(protocol, next(iter(actions)))
+        actions[host] = action
+        dependents = self.dependents[protocol]
+        for key in self._keys_used(action):
+            dependents.setdefault(key, set()).add(host)
+
+    def _keys_used(self, action):
+        "Returns the host keys an action was built from"
+        keys = [action.matched_host]
+        # Aliases are built from their target's entry as well
+        while isinstance(action, Alias):
+            keys.append(action.hostname)
+            action = action.aliased
+        return keys
+
+    def _forget(self, protocol, host):
+        "Drops the action built for host"
+        action = self.actions[protocol].pop(host)
+        dependents = self.dependents[protocol]
+        for key in self._keys_used(action):
+            hosts = dependents.get(key)
+            if hosts is not None:
+                hosts.discard(host)
+                if not hosts:
+                    del dependents[key]
@@ -1,59 +1,323 @@
+import errno
 import logging
+import os
+import time
 
 import eventlet
 import greenlet
 
+from eventlet.event import Event
 from eventlet.green import socket
-from eventlet.timeout import Timeout
+from eventlet.hubs import trampoline
+from eventlet.queue import LightQueue
+
+from mantrid.framing import BufferedSocket
+
+# Try to get splice() using ctypes; otherwise, we always copy through Python
+try:
+    import ctypes
+    _splice = ctypes.CDLL("libc.so.6", use_errno=True).splice
+    _splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    _splice.restype = ctypes.c_ssize_t
+except Exception:
+    _splice = None
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+
 
 class SocketMelder(object):
     """
     Takes two sockets and directly connects them together.
+
+    If splice is True (and we're on Linux), data is moved between the
+    sockets through a pipe with splice() so it never enters userspace;
+    sockets that can't be spliced fall back to recv()/sendall(), reading
+    buffer_size bytes at a time.
+
+    The relay is abandoned once nothing has moved in either direction
+    for idle_timeout seconds, or a write has been stuck that long; long
+    transfers that keep moving aren't cut off. If rate_limit is set, each
+    direction moves at most that many bytes a second. If high_watermark
+    is bigger than buffer_size, each direction reads ahead of a slow
+    receiver until that much is buffered, and then waits for it to fall
+    to low_watermark; otherwise each chunk is written before the next is
+    read.
+
+    While running, the melder is in sessions (if given), and stats()
+    describes its progress.
     """
 
-    transmission_timeout_seconds = 30
+    buffer_size = 32768
+    idle_timeout = 30
+    splice_chunk = 65536
 
-    def __init__(self, client, server, backend, host):
+    def __init__(self, client, server, backend, host, splice=False, buffer_size=None, idle_timeout=None, rate_limit=0, high_watermark=0, low_watermark=0, sessions=None):
         self.client = client
         self.server = server
         self.backend = backend
         self.host = host
+        self.splice = splice and _splice is not None
+        if buffer_size:
+            self.buffer_size = buffer_size
+        if idle_timeout:
+            self.idle_timeout = idle_timeout
+        self.rate_limit = rate_limit
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.sessions = sessions
         self.data_handled = 0
+        # Bytes moved each way, bytes read but not yet written, and how
+        # often reading had to wait at the high watermark
+        self.bytes_to_backend = 0
+        self.bytes_to_client = 0
+        self.buffered = 0
+        self.stalls = 0
+        self.started = self.last_activity = time.time()
+        # When the backend's first data arrived, and if anything timed out
+        self.first_byte_time = None
+        self.timed_out = False
+        self.timeout_response_sent = False
+
+    def stats(self, now=None):
+        "Returns the progress of the relay so far"
+        duration = max((now or time.time()) - self.started, 0.001)
+        return {
+            "host": self.host,
+            "backend": "%s:%s" % (self.backend.host, self.backend.port),
+            "duration": round(duration, 3),
+            "idle": round(max((now or time.time()) - self.last_activity, 0), 3),
+            "bytes_to_backend": self.bytes_to_backend,
+            "bytes_to_client": self.bytes_to_client,
+            "rate_to_backend": int(self.bytes_to_backend / duration),
+            "rate_to_client": int(self.bytes_to_client / duration),
+            "buffered": self.buffered,
+            "stalls": self.stalls,
+            "splice": self.splice,
+        }
+
+    def moved(self, from_server, length):
+        "Records length bytes written out, pausing if that is too fast"
+        self.data_handled += length
+        self.last_activity = time.time()
+        if from_server:
+            self.bytes_to_client += length
+            total = self.bytes_to_client
+        else:
+            self.bytes_to_backend += length
+            total = self.bytes_to_backend
+        if self.rate_limit:
+            delay = total / float(self.rate_limit) - (self.last_activity - self.started)
+            if delay > 0:
+                eventlet.sleep(delay)
+
+    def recv(self, sock, length):
+        """
+        Reads from a socket, only giving up when the whole relay has been
+        idle; one direction is usually quiet while the other is busy.
+        """
+        while True:
+            try:
+                return sock.recv(length)
+            except socket.timeout:
+                if time.time() - self.last_activity >= self.idle_timeout:
+                    raise
 
     def piper(self, in_sock, out_sock, out_addr, onkill):
         "Worker thread for data reading"
         try:
-            timeout = Timeout(self.transmission_timeout_seconds)
-            try:
-                while True:
-                    written = in_sock.recv(32768)
-                    if not written:
-                        try:
-                            out_sock.shutdown(socket.SHUT_WR)
-                        except socket.error:
-                            self.threads[onkill].kill()
-                        break
-                    try:
-                        out_sock.sendall(written)
-                    except socket.error:
-                        pass
-                    self.data_handled += len(written)
-            finally:
-                timeout.cancel()
+            if not (self.splice and self.splice_pipe(in_sock, out_sock, onkill)):
+                if self.high_watermark > self.buffer_size:
+                    self.buffered_pipe(in_sock, out_sock, onkill)
+                else:
+                    self.copy_pipe(in_sock, out_sock, onkill)
         except greenlet.GreenletExit:
             return
-        except Timeout:
+        except socket.timeout:
             # This one prevents only from closing connection without any data nor status code returned
             # from mantrid when no data was received from backend.
             # When it happens, nginx reports 'upstream prematurely closed connection' and returns 500,
-            # and want to have our custom error page to know when it happens. 
+            # and want to have our custom error page to know when it happens.
 
             if onkill == "stoc" and self.data_handled == 0:
                 out_sock.sendall("HTTP/1.0 594 Backend timeout\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+                self.timeout_response_sent = True
             logging.warn("Timeout serving request to backend %s of %s", self.backend, self.host)
+            self.timed_out = True
             return
 
+    def finish_pipe(self, out_sock, onkill):
+        "Passes on the end of the stream once the input side closes"
+        try:
+            out_sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            self.threads[onkill].kill()
+
+    def copy_pipe(self, in_sock, out_sock, onkill):
+        "Moves data by reading it into Python and writing it out again"
+        from_server = in_sock is self.server
+        while True:
+            written = self.recv(in_sock, self.buffer_size)
+            if not written:
+                self.finish_pipe(out_sock, onkill)
+                break
+            if self.first_byte_time is None and from_server:
+                self.first_byte_time = time.time()
+            try:
+                out_sock.sendall(written)
+            except socket.timeout:
+                raise
+            except socket.error:
+                pass
+            self.moved(from_server, len(written))
+
+    def buffered_pipe(self, in_sock, out_sock, onkill):
+        """
+        Moves data like copy_pipe, but reads ahead of the writing, up to
+        high_watermark bytes, in a separate greenthread.
+        """
+        from_server = in_sock is self.server
+        chunks = LightQueue()
+        # Bytes buffered in this direction, and an Event set while
+        # reading waits for them to drain
+        buffered = [0]
+        resume = [None]
+
+        def writer():
+            try:
+                while True:
+                    data = chunks.get()
+                    if data is None:
+                        self.finish_pipe(out_sock, onkill)
+                        return
+                    try:
+                        out_sock.sendall(data)
+                    except socket.timeout:
+                        raise
+                    except socket.error:
+                        pass
+                    buffered[0] -= len(data)
+                    self.buffered -= len(data)
+                    if resume[0] is not None and buffered[0] <= self.low_watermark:
+                        resume[0].send()
+                        resume[0] = None
+                    self.moved(from_server, len(data))
+            finally:
+                if resume[0] is not None:
+                    resume[0].send()
+                    resume[0] = None
+
+        writer_thread = eventlet.spawn(writer)
+        try:
+            while not writer_thread.dead:
+                if buffered[0] >= self.high_watermark:
+                    self.stalls += 1
+                    resume[0] = Event()
+                    resume[0].wait()
+                    continue
+                data = self.recv(in_sock, self.buffer_size)
+                if self.first_byte_time is None and from_server and data:
+                    self.first_byte_time = time.time()
+                chunks.put(data or None)
+                if not data:
+                    break
+                buffered[0] += len(data)
+                self.buffered += len(data)
+            # Passes on any timeout from writing
+            writer_thread.wait()
+        finally:
+            writer_thread.kill()
+
+    def splice_pipe(self, in_sock, out_sock, onkill):
+        """
+        Moves data from in_sock to out_sock through a pipe using splice().
+        Returns False, having moved nothing, if the sockets don't support it.
+        """
+        try:
+            in_fd = in_sock.fileno()
+            out_fd = out_sock.fileno()
+        except (AttributeError, TypeError):
+            return False
+        # Splice bypasses StatsSocket's send/recv, so tell it what moved
+        record_received = getattr(in_sock, "record_received", None)
+        record_sent = getattr(out_sock, "record_sent", None)
+        from_server = in_sock is self.server
+        # Anything already read off the socket has to go the slow way
+        if isinstance(in_sock, BufferedSocket) and in_sock.buffer:
+            pending, in_sock.buffer = in_sock.buffer, ""
+            out_sock.sendall(pending)
+            self.moved(from_server, len(pending))
+        pipe_read, pipe_write = os.pipe()
+        try:
+            first = True
+            while True:
+                try:
+                    pending = self._splice(in_fd, pipe_write, self.splice_chunk, in_fd, False)
+                except socket.error, e:
+                    if first and e.errno in (errno.EINVAL, errno.ENOSYS):
+                        return False
+                    raise
+                first = False
+                if not pending:
+                    self.finish_pipe(out_sock, onkill)
+                    break
+                if self.first_byte_time is None and from_server:
+                    self.first_byte_time = time.time()
+                if record_received is not None:
+                    record_received(pending)
+                moved = pending
+                try:
+                    while pending:
+                        pending -= self._splice(pipe_read, out_fd, pending, out_fd, True)
+                except socket.timeout:
+                    raise
+                except socket.error:
+                    # Same as a failed sendall(); throw the data away
+                    os.read(pipe_read, pending)
+                    moved -= pending
+                if record_sent is not None:
+                    record_sent(moved)
+                self.moved(from_server, moved)
+            return True
+        finally:
+            os.close(pipe_read)
+            os.close(pipe_write)
+
+    def _splice(self, fd_in, fd_out, length, wait_fd, wait_write):
+        """
+        Calls splice(), waiting on the hub whenever it would block, for
+        as long as the relay as a whole isn't idle.
+        """
+        while True:
+            moved = _splice(fd_in, None, fd_out, None, length, SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+            if moved >= 0:
+                return moved
+            error = ctypes.get_errno()
+            if error == errno.EAGAIN:
+                try:
+                    if wait_write:
+                        trampoline(wait_fd, write=True, timeout=self.idle_timeout, timeout_exc=socket.timeout("timed out"))
+                    else:
+                        trampoline(wait_fd, read=True, timeout=self.idle_timeout, timeout_exc=socket.timeout("timed out"))
+                except socket.timeout:
+                    if wait_write or time.time() - self.last_activity >= self.idle_timeout:
+                        raise
+            elif error != errno.EINTR:
+                raise socket.error(error, os.strerror(error))
+
     def run(self):
+        # Every wait on either socket is bounded by the idle timeout
+        for sock in (self.client, self.server):
+            sock.settimeout(self.idle_timeout)
+        if self.sessions is not None:
+            self.sessions.add(self)
+        try:
+            return self.relay()
+        finally:
+            if self.sessions is not None:
+                self.sessions.discard(self)
+
+    def relay(self):
         # Two pipers == repeated logging of timeouts
         self.threads = {
             "ctos": eventlet.spawn(self.piper, self.server, self.client, "client", "stoc"),
@@ -0,0 +1,231 @@
+"""
+Reading and writing the balancer's state file.
+
+The state file is always rewritten atomically (written to a temporary
+file, synced, then renamed over the old one). Host table changes can
+also be appended to a journal next to it, so that small changes don't
+need the whole table to be written out; the journal is folded back into
+the state file whenever it is rewritten.
+
+Optionally, a binary snapshot of the same state is written next to the
+state file, which loads much faster than the JSON. The JSON stays the
+authoritative copy: the snapshot is only used if it was written from
+the state file that is there now.
+
+Every full save gets the next generation number, which is written into
+the state file and at the top of the journal started after it, so that
+a journal left behind by a crash part-way through a save is never
+replayed over the newer state file.
+"""
+
+import errno
+import logging
+import marshal
+import os
+
+import mantrid.json
+from mantrid.backend import Backend
+
+SNAPSHOT_VERSION = 2
+
+# Action options that hold lists of Backends, which marshal can't write
+BACKEND_LISTS = ("backends", "mirrors")
+
+
+class StateFile(object):
+    """
+    The state file at path, its journal at path + ".journal", and if
+    snapshot is True its binary snapshot at path + ".snapshot".
+    """
+
+    def __init__(self, path, snapshot=False):
+        self.path = path
+        self.journal_path = "%s.journal" % path
+        self.snapshot_path = "%s.snapshot" % path
+        self.snapshot = snapshot
+        self.journal_entries = 0
+        # Generation of the state file, and whether the journal has been
+        # started for it
+        self.generation = None
+        self.journal_started = False
+
+    def load(self):
+        """
+        Returns the saved state dict, with any journalled changes to its
+        hosts applied. Raises IOError or OSError if there is no state.
+        """
+        if os.path.getsize(self.path) <= 1:
+            raise IOError("File is empty.")
+        state = None
+        if self.snapshot:
+            state = self.load_snapshot()
+        if state is None:
+            with open(self.path) as fh:
+                state = mantrid.json.load(fh)
+        assert isinstance(state, dict)
+        self.generation = state.get('generation')
+        self.journal_entries = self.replay(state['hosts'])
+        return state
+
+    def state_file_id(self):
+        "Identifies the current contents of the state file"
+        stat = os.stat(self.path)
+        return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+    def load_snapshot(self):
+        """
+        Returns the state from the snapshot, or None if there isn't a
+        usable snapshot of the current state file.
+        """
+        try:
+            with open(self.snapshot_path, "rb") as fh:
+                data = fh.read()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                logging.warn("Cannot read state snapshot %s: %s", self.snapshot_path, e)
+            return None
+        try:
+            version, marshal_version, file_id, generation, hosts, stats = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            logging.warn("Ignoring unreadable state snapshot %s", self.snapshot_path)
+            return None
+        if version != SNAPSHOT_VERSION or marshal_version != marshal.version:
+            return None
+        if file_id != self.state_file_id():
+            logging.info("State snapshot %s is out of date; loading %s", self.snapshot_path, self.path)
+            return None
+        for action, kwargs, allow_subs in hosts.values():
+            for name in BACKEND_LISTS:
+                if name in kwargs:
+                    kwargs[name] = [Backend(backend[:2], backend[2]) for backend in kwargs[name]]
+        return {"generation": generation, "hosts": hosts, "stats": stats}
+
+    def save_snapshot(self, hosts, stats):
+        "Writes a snapshot of the state file that has just been saved"
+        plain_hosts = {}
+        for host, (action, kwargs, allow_subs) in hosts.items():
+            plain_kwargs = dict(kwargs)
+            for name in BACKEND_LISTS:
+                if name in kwargs:
+                    plain_kwargs[name] = [(backend.host, backend.port, backend.weight) for backend in kwargs[name]]
+            plain_hosts[host] = [action, plain_kwargs, allow_subs]
+        self.write_atomically(self.snapshot_path, marshal.dumps((
+            SNAPSHOT_VERSION,
+            marshal.version,
+            self.state_file_id(),
+            self.generation,
+            plain_hosts,
+            stats,
+        )))
+
+    def replay(self, hosts):
+        "Applies the journal to a hosts dict; returns how many entries it had"
+        entries = 0
+        complete = 0
+        try:
+            fh = open(self.journal_path)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return 0
+            raise
+        with fh:
+            # State files from before generations were recorded have
+            # journals without a header
+            if self.generation is not None:
+                header = fh.readline()
+                try:
+                    generation = mantrid.json.loads(header)['generation']
+                except (ValueError, TypeError, KeyError):
+                    generation = None
+                if not header.endswith("\n") or generation != self.generation:
+                    logging.warn("Ignoring %s, which isn't for the current state file", self.journal_path)
+                    return 0
+                complete = len(header)
+            self.journal_started = True
+            for line in fh:
+                # A crash part-way through an append leaves a partial line
+                if not line.endswith("\n"):
+                    logging.warn("Ignoring incomplete last entry in %s", self.journal_path)
+                    self.truncate_journal(complete)
+                    break
+                # Anything else unreadable (a bad disk, a stray edit) ends
+                # the journal there too, rather than stopping us starting
+                try:
+                    entry = mantrid.json.loads(line)
+                    host, settings = entry['host'], entry['settings']
+                except (ValueError, TypeError, KeyError):
+                    logging.warn("Ignoring corrupt entry %i and everything after it in %s", entries + 1, self.journal_path)
+                    self.truncate_journal(complete)
+                    break
+                if settings is None:
+                    hosts.pop(host, None)
+                else:
+                    hosts[host] = settings
+                entries += 1
+                complete += len(line)
+        return entries
+
+    def truncate_journal(self, length):
+        "Cuts the journal off after length bytes, so new entries follow good ones"
+        with open(self.journal_path, "r+") as journal:
+            journal.truncate(length)
+
+    def save(self, hosts, stats):
+        "Atomically writes the whole state, and empties the journal"
+        self.generation = (self.generation or 0) + 1
+        self.journal_started = False
+        self.write_atomically(self.path, mantrid.json.dumps({
+            "generation": self.generation,
+            "hosts": hosts,
+            "stats": stats,
+        }))
+        if self.snapshot:
+            try:
+                self.save_snapshot(hosts, stats)
+            except (AttributeError, ValueError, TypeError):
+                # Something in the state marshal can't handle; JSON will do
+                logging.warn("Cannot write state snapshot", exc_info=True)
+        try:
+            os.unlink(self.journal_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.journal_entries = 0
+
+    def append(self, hosts, changed):
+        "Appends the current settings of the changed hostnames to the journal"
+        lines = "".join(
+            mantrid.json.dumps({"host": host, "settings": hosts.get(host)}) + "\n"
+            for host in changed
+        )
+        mode = "a"
+        if not self.journal_started:
+            # Replaces any journal left over from an older generation
+            mode = "w"
+            lines = mantrid.json.dumps({"generation": self.generation}) + "\n" + lines
+        with open(self.journal_path, mode) as fh:
+            fh.write(lines)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.journal_started = True
+        self.journal_entries += len(changed)
+
+    def write_atomically(self, path, data):
+        "Replaces the file at path with data, so it is never seen half-written"
+        temp_path = "%s.tmp" % path
+        with open(temp_path, "w") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(temp_path, path)
+        # Make sure the rename itself is on disk
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
@@ -0,0 +1,86 @@
+"""
+The .http files sent by the static action, kept in memory.
+
+Files are read when the balancer starts, or the first time they are
+asked for, and checked for changes at most every check_interval seconds,
+so sending one is normally a dict lookup and a single sendall() rather
+than an open(), fstat() and sendfile() per request. Files too big to
+keep are remembered by path and still sent with sendfile().
+"""
+
+import errno
+import os
+import time
+
+package_dir = os.path.join(os.path.dirname(__file__), "static")
+
+
+class StaticResponse(object):
+    "One static response file; data is None if it is too big to keep"
+
+    __slots__ = ("path", "mtime", "size", "data", "checked")
+
+    def __init__(self, path, mtime, size, data, checked):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.data = data
+        self.checked = checked
+
+
+class StaticResponses(object):
+    """
+    The static responses of every static_dir used, by (static_dir, type).
+    A file in static_dir takes precedence over the one shipped with
+    Mantrid of the same name.
+    """
+
+    check_interval = 1
+    max_cached_bytes = 256 * 1024
+
+    def __init__(self):
+        self.responses = {}
+
+    def get(self, static_dir, type, now=None):
+        "Returns the StaticResponse for a type, reloading it if it has changed"
+        now = now or time.time()
+        response = self.responses.get((static_dir, type))
+        if response is not None and now - response.checked < self.check_interval:
+            return response
+        return self.load(static_dir, type, now, response)
+
+    def load(self, static_dir, type, now, previous=None):
+        for path in (os.path.join(static_dir, "%s.http" % type), os.path.join(package_dir, "%s.http" % type)):
+            try:
+                stat = os.stat(path)
+            except OSError, e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            if previous is not None and (previous.path, previous.mtime, previous.size) == (path, stat.st_mtime, stat.st_size):
+                previous.checked = now
+                return previous
+            data = None
+            if stat.st_size <= self.max_cached_bytes:
+                with open(path) as fh:
+                    data = fh.read()
+            response = self.responses[static_dir, type] = StaticResponse(path, stat.st_mtime, stat.st_size, data, now)
+            return response
+        self.responses.pop((static_dir, type), None)
+        raise IOError(errno.ENOENT, "No static response called %s" % type)
+
+    def preload(self, static_dir):
+        "Loads every static response available from static_dir"
+        types = set()
+        for directory in (static_dir, package_dir):
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            types.update(name[:-5] for name in names if name.endswith(".http"))
+        for type in types:
+            self.get(static_dir, type)
+
+
+# Shared by every Static action, which are made afresh for each hostname
+static_responses = StaticResponses()
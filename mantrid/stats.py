@@ -0,0 +1,37 @@
+"""
+Per-hostname request counters.
+
+Requests bump the attributes of a HostCounters object rather than the
+values of the stats dicts that /stats/ returns and the state file saves;
+the counters are folded into those dicts only when they are read.
+"""
+
+
+class HostCounters(object):
+    "The counters of one hostname since they were last folded into its stats"
+
+    __slots__ = ("open_requests", "completed_requests", "bytes_sent", "bytes_received", "cache_hits", "cache_misses")
+
+    def __init__(self):
+        self.open_requests = 0
+        self.completed_requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # Only hosts using the cache action count these
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def fold_into(self, stats_dict):
+        """
+        Adds the counts to a /stats/ dict and starts counting again from
+        zero; open_requests is how many there are now, so it is copied.
+        """
+        stats_dict['open_requests'] = self.open_requests
+        stats_dict['completed_requests'] = stats_dict.get('completed_requests', 0) + self.completed_requests
+        stats_dict['bytes_sent'] = stats_dict.get('bytes_sent', 0) + self.bytes_sent
+        stats_dict['bytes_received'] = stats_dict.get('bytes_received', 0) + self.bytes_received
+        self.completed_requests = self.bytes_sent = self.bytes_received = 0
+        if self.cache_hits or self.cache_misses:
+            stats_dict['cache_hits'] = stats_dict.get('cache_hits', 0) + self.cache_hits
+            stats_dict['cache_misses'] = stats_dict.get('cache_misses', 0) + self.cache_misses
+            self.cache_hits = self.cache_misses = 0
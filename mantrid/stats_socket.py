@@ -4,28 +4,54 @@ class StatsSocket(object):
     have been sent and received.
     """
 
+    __slots__ = ("sock", "bytes_sent", "bytes_received", "response_start", "_sendall", "_send", "_recv")
+
     def __init__(self, sock):
         self.sock = sock
         self.bytes_sent = 0
         self.bytes_received = 0
+        # The start of the first data sent, for the access log's status
+        self.response_start = None
+        # Looked up once, rather than on every call
+        self._sendall = sock.sendall
+        self._send = sock.send
+        self._recv = sock.recv
 
     def __getattr__(self, attr):
         return getattr(self.sock, attr)
     
     def sendall(self, data):
+        if self.response_start is None:
+            self.response_start = data[:16]
         self.bytes_sent += len(data)
-        self.sock.sendall(data)
+        self._sendall(data)
     
     def send(self, data):
-        sent = self.sock.send(data)
+        if self.response_start is None:
+            self.response_start = data[:16]
+        sent = self._send(data)
         self.bytes_sent += sent
         return sent
     
     def recv(self, length):
-        recvd = self.sock.recv(length)
+        recvd = self._recv(length)
         self.bytes_received += len(recvd)
         return recvd
 
+    def record_sent(self, length):
+        "Counts data sent without going through this wrapper"
+        self.bytes_sent += length
+
+    def record_received(self, length):
+        "Counts data received without going through this wrapper"
+        self.bytes_received += length
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
     def makefile(self, *args, **kwargs):
         fh = self.sock.makefile(*args, **kwargs)
         fh._sock = self
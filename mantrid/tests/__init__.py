@@ -1,3 +1,15 @@
 from .actions import ActionTests, LiveActionTests
 from .loadbalancer import BalancerTests
 from .client import ClientTests
+from .socketmeld import SocketMelderTests
+from .workers import WorkerTests
+from .requesthead import RequestHeadTests
+from .healthcheck import HealthCheckTests
+from .algorithms import AlgorithmTests
+from .backend import BackendGroupTests
+from .state import StateTests
+from .restart import RestartTests
+from .metrics import MetricsTests
+from .accesslog import AccessLogTests
+from .cache import CacheTests
+from .changes import ChangeFeedTests
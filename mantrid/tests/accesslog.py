@@ -0,0 +1,162 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import eventlet
+from eventlet.green import socket
+from ..accesslog import AccessLog, format_entry
+from ..backend import Backend
+from ..loadbalancer import Balancer
+from ..metrics import Metrics
+
+
+class AccessLogTests(unittest.TestCase):
+    "Tests the buffered access log"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "access.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def entry(self, **kwargs):
+        values = {
+            "time": 1300000000.25,
+            "duration": 0.0123456789,
+            "request_id": "-",
+            "client": "127.0.0.1",
+            "method": "GET",
+            "path": "/",
+            "host": "www.example.com",
+            "matched_host": "*.example.com",
+            "backend": None,
+            "response_start": None,
+            "bytes_sent": 0,
+            "bytes_received": 0,
+            "first_byte": None,
+        }
+        values.update(kwargs)
+        return tuple(values[field] for field in (
+            "time", "duration", "request_id", "client", "method", "path", "host",
+            "matched_host", "backend", "response_start", "bytes_sent", "bytes_received", "first_byte",
+        ))
+
+    def test_format(self):
+        line = format_entry(self.entry(
+            backend = Backend(("10.0.0.1", 8000)),
+            response_start = "HTTP/1.1 404 Not",
+            bytes_sent = 100,
+            first_byte = 0.005,
+        ))
+        self.assertTrue(line.endswith("\n"))
+        values = json.loads(line)
+        self.assertEqual("2011-03-13T07:06:40.250Z", values["time"])
+        self.assertEqual(0.012346, values["duration"])
+        self.assertEqual("10.0.0.1:8000", values["backend"])
+        self.assertEqual(404, values["status"])
+        self.assertEqual("*.example.com", values["matched_host"])
+        self.assertEqual(100, values["bytes_sent"])
+        self.assertEqual(0.005, values["first_byte"])
+        # Unknown status, as when splicing
+        self.assertEqual(None, json.loads(format_entry(self.entry()))["status"])
+
+    def test_buffering(self):
+        log = AccessLog(self.path)
+        log.record(self.entry())
+        log.record(self.entry(path="/two"))
+        self.assertFalse(os.path.exists(self.path))
+        log.flush()
+        lines = open(self.path).readlines()
+        self.assertEqual(["/", "/two"], [json.loads(line)["path"] for line in lines])
+        # Full buffers drop entries rather than grow
+        log.max_buffered = 1
+        log.record(self.entry())
+        log.record(self.entry())
+        self.assertEqual(1, log.dropped)
+        log.close()
+
+    def test_slow_disk(self):
+        "Tests that writing the log doesn't hold up everything else"
+        metrics = Metrics()
+        log = AccessLog(self.path, metrics=metrics)
+        log.record(self.entry(path="/one"))
+        log.reopen_if_moved()
+        real_fh = log.fh
+        class SlowFile(object):
+            def write(self, data):
+                # Blocks whichever thread is writing
+                time.sleep(0.3)
+                real_fh.write(data)
+            def __getattr__(self, name):
+                return getattr(real_fh, name)
+        log.fh = SlowFile()
+        start = time.time()
+        flusher = eventlet.spawn(log.flush)
+        eventlet.sleep(0.1)
+        self.assert_(time.time() - start < 0.25)
+        # Requests go on being logged while the last lot is written, up
+        # to a limit
+        log.max_buffered = 2
+        for path in ("/two", "/three", "/four"):
+            log.record(self.entry(path=path))
+        self.assertEqual(1, log.dropped)
+        self.assertEqual(1, metrics.counters[("mantrid_access_log_dropped_total", ())])
+        # A flush while another is writing waits its turn
+        eventlet.spawn(log.flush).wait()
+        flusher.wait()
+        lines = open(self.path).readlines()
+        self.assertEqual(["/one", "/two", "/three"], [json.loads(line)["path"] for line in lines])
+        log.close()
+
+    def test_sampling(self):
+        log = AccessLog(self.path, sample=0)
+        log.record(self.entry())
+        self.assertEqual([], log.buffer)
+        log = AccessLog(self.path, sample=0.5)
+        for i in range(1000):
+            log.record(self.entry())
+        self.assertTrue(300 < len(log.buffer) < 700)
+
+    def test_rotation(self):
+        log = AccessLog(self.path, max_bytes=1, backups=2)
+        follower = AccessLog(self.path, rotate=False)
+        for path in ("/one", "/two", "/three"):
+            log.record(self.entry(path=path))
+            log.flush()
+        self.assertEqual("/three", json.loads(open(self.path).read())["path"])
+        self.assertEqual("/two", json.loads(open(self.path + ".1").read())["path"])
+        self.assertEqual("/one", json.loads(open(self.path + ".2").read())["path"])
+        # Another process writing to the same log follows it to the new file
+        follower.record(self.entry(path="/four"))
+        follower.flush()
+        log.record(self.entry(path="/five"))
+        log.flush()
+        follower.record(self.entry(path="/six"))
+        follower.flush()
+        self.assertEqual(["/five", "/six"], [json.loads(line)["path"] for line in open(self.path)])
+        self.assertFalse(os.path.exists(self.path + ".3"))
+        log.close()
+        follower.close()
+
+    def test_request_logged(self):
+        "Tests that requests handled by the balancer are logged"
+        balancer = Balancer(None, None, None, None, access_log=self.path)
+        balancer.hosts = {"test-host.com": ["empty", {"code": 204}, True]}
+        ours, theirs = socket.socketpair()
+        thread = eventlet.spawn(balancer.handle, theirs, ("127.0.0.1", 1234))
+        ours.sendall("GET /path HTTP/1.0\r\nX-Loadbalance-To: test-host.com\r\nX-Request-Id: abc\r\n\r\n")
+        response = ours.recv(1024)
+        self.assertTrue(response.startswith("HTTP/1.0 204"))
+        thread.wait()
+        ours.close()
+        balancer.flush_access_log()
+        [values] = [json.loads(line) for line in open(self.path)]
+        self.assertEqual("/path", values["path"])
+        self.assertEqual("abc", values["request_id"])
+        self.assertEqual("127.0.0.1", values["client"])
+        self.assertEqual("test-host.com", values["matched_host"])
+        self.assertEqual(204, values["status"])
+        self.assertEqual(len(response), values["bytes_sent"])
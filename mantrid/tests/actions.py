@@ -1,5 +1,7 @@
 import os
 import errno
+import shutil
+import tempfile
 import socket
 import time
 import eventlet
@@ -8,6 +10,9 @@ httplib2 = eventlet.import_patched("httplib2")
 from eventlet.timeout import Timeout
 from ..loadbalancer import Balancer
 from ..actions import Empty, Static, Unknown, NoHosts, Redirect, Proxy, Spin
+from ..backend import Backend
+from ..framing import BufferedSocket, MessageHead, read_head, relay_chunked
+from ..static_responses import StaticResponses, static_responses
 
 
 class MockBalancer(object):
@@ -72,6 +77,38 @@ class ActionTests(unittest.TestCase):
             sock.data,
         )
 
+    def test_static_reload(self):
+        "Tests that static responses are kept in memory until their file changes"
+        balancer = MockBalancer()
+        balancer.static_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(balancer.static_dir, "custom.http")
+            with open(path, "w") as fh:
+                fh.write("HTTP/1.0 200 OK\r\n\r\nfirst")
+            responses = StaticResponses()
+            self.assertEqual("HTTP/1.0 200 OK\r\n\r\nfirst", responses.get(balancer.static_dir, "custom", now=1000).data)
+            with open(path, "w") as fh:
+                fh.write("HTTP/1.0 200 OK\r\n\r\nsecond!")
+            # Not looked at again until check_interval has passed
+            self.assertEqual("HTTP/1.0 200 OK\r\n\r\nfirst", responses.get(balancer.static_dir, "custom", now=1000.5).data)
+            self.assertEqual("HTTP/1.0 200 OK\r\n\r\nsecond!", responses.get(balancer.static_dir, "custom", now=1002).data)
+            # Shipped responses are used when static_dir has no such file
+            self.assertEqual(
+                os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "static", "timeout.http")),
+                os.path.abspath(responses.get(balancer.static_dir, "timeout").path),
+            )
+            # Big files are only sent from disk
+            static_responses.max_cached_bytes = 10
+            try:
+                self.assertEqual(None, static_responses.get(balancer.static_dir, "custom").data)
+                sock = MockSocket()
+                Static(balancer, "kittens.net", "kittens.net", type="custom").handle(sock, "", "/", {})
+                self.assertEqual("HTTP/1.0 200 OK\r\n\r\nsecond!", sock.data)
+            finally:
+                del static_responses.max_cached_bytes
+        finally:
+            shutil.rmtree(balancer.static_dir)
+
     def test_unknown(self):
         "Tests the Unknown action"
         action = Unknown(MockBalancer(), "firefly.org", "firefly.org")
@@ -239,3 +276,481 @@ class LiveActionTests(unittest.TestCase):
             expected_content,
             content,
         )
+
+    def test_proxy_pooled(self):
+        "Tests that pooled proxying reuses backend connections"
+        listener = eventlet.listen(("127.0.0.1", 0))
+        connections = []
+        def serve(sock, address):
+            connections.append(address)
+            sock = BufferedSocket(sock)
+            while read_head(sock) is not None:
+                sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello")
+        server_thread = eventlet.spawn(eventlet.serve, listener, serve)
+        try:
+            self.balancer.backend_pool_size = 2
+            self.balancer.hosts["pooled.com"] = [
+                "proxy",
+                {"backends": [Backend(listener.getsockname())]},
+                False,
+            ]
+            for i in range(3):
+                resp, content = httplib2.Http().request(
+                    "http://127.0.0.1:%i" % self.next_port,
+                    "GET",
+                    headers = {"X-Loadbalance-To": "pooled.com"},
+                )
+                self.assertEqual('200', resp['status'])
+                self.assertEqual('close', resp['connection'])
+                self.assertEqual("hello", content)
+            self.assertEqual(1, len(connections))
+        finally:
+            server_thread.kill()
+            listener.close()
+
+    def test_proxy_pooled_timeout(self):
+        "Tests that a backend that never answers gets a 594, even on a pooled connection"
+        listener = eventlet.listen(("127.0.0.1", 0))
+        requests = []
+        def serve(sock, address):
+            sock = BufferedSocket(sock)
+            while read_head(sock) is not None:
+                requests.append(address)
+                if len(requests) == 1:
+                    sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello")
+        server_thread = eventlet.spawn(eventlet.serve, listener, serve)
+        try:
+            self.balancer.backend_pool_size = 2
+            self.balancer.relay_idle_timeout = 0.2
+            self.balancer.hosts["slow.com"] = [
+                "proxy",
+                {"backends": [Backend(listener.getsockname())]},
+                False,
+            ]
+            statuses = []
+            for i in range(2):
+                with Timeout(5):
+                    resp, content = httplib2.Http().request(
+                        "http://127.0.0.1:%i" % self.next_port,
+                        "GET",
+                        headers = {"X-Loadbalance-To": "slow.com"},
+                    )
+                statuses.append(resp['status'])
+            self.assertEqual(['200', '594'], statuses)
+            # The timed-out request wasn't sent again on a new connection
+            self.assertEqual(2, len(requests))
+            self.assertEqual(1, len(set(requests)))
+        finally:
+            server_thread.kill()
+            listener.close()
+
+    def test_proxy_pooled_closed(self):
+        "Tests that a backend closing without a response gets a 502, after one retry"
+        listener = eventlet.listen(("127.0.0.1", 0))
+        requests = []
+        def serve(sock, address):
+            sock = BufferedSocket(sock)
+            while read_head(sock) is not None:
+                requests.append(address)
+                if len(requests) > 1:
+                    return
+                sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello")
+        server_thread = eventlet.spawn(eventlet.serve, listener, serve)
+        try:
+            self.balancer.backend_pool_size = 2
+            self.balancer.hosts["closing.com"] = [
+                "proxy",
+                {"backends": [Backend(listener.getsockname())]},
+                False,
+            ]
+            statuses = []
+            for i in range(2):
+                with Timeout(5):
+                    resp, content = httplib2.Http().request(
+                        "http://127.0.0.1:%i" % self.next_port,
+                        "GET",
+                        headers = {"X-Loadbalance-To": "closing.com"},
+                    )
+                statuses.append(resp['status'])
+            self.assertEqual(['200', '502'], statuses)
+            # Tried on the pooled connection, then on a fresh one
+            self.assertEqual(3, len(requests))
+            self.assertEqual(2, len(set(requests)))
+        finally:
+            server_thread.kill()
+            listener.close()
+
+    def test_proxy_pooled_limits(self):
+        "Tests that pooled requests are rate limited and listed as sessions"
+        listener = eventlet.listen(("127.0.0.1", 0))
+        def serve(sock, address):
+            sock = BufferedSocket(sock)
+            while read_head(sock) is not None:
+                eventlet.sleep(0.2)
+                sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: 40000\r\n\r\n" + "x" * 40000)
+        server_thread = eventlet.spawn(eventlet.serve, listener, serve)
+        try:
+            self.balancer.backend_pool_size = 2
+            self.balancer.relay_rate_limit = 50000
+            self.balancer.relay_buffer_size = 4096
+            self.balancer.hosts["limited.com"] = [
+                "proxy",
+                {"backends": [Backend(listener.getsockname())]},
+                False,
+            ]
+            start = time.time()
+            request = eventlet.spawn(
+                httplib2.Http().request,
+                "http://127.0.0.1:%i" % self.next_port,
+                "GET",
+                headers = {"X-Loadbalance-To": "limited.com"},
+            )
+            eventlet.sleep(0.1)
+            sessions = self.balancer.collect_sessions()
+            self.assertEqual(1, len(sessions))
+            self.assertEqual("limited.com", sessions[0]["host"])
+            with Timeout(5):
+                resp, content = request.wait()
+            self.assertEqual(40000, len(content))
+            # 40KB at 50KB a second, averaged from when the request started
+            self.assert_(time.time() - start >= 0.6)
+            # Gone once the balancer has finished with the request
+            eventlet.sleep(0.2)
+            self.assertEqual([], self.balancer.collect_sessions())
+        finally:
+            server_thread.kill()
+            listener.close()
+
+    def test_keepalive_pipelined(self):
+        "Tests several pipelined requests served over one client connection"
+        listener = eventlet.listen(("127.0.0.1", 0))
+        def serve(sock, address):
+            sock = BufferedSocket(sock)
+            head = read_head(sock)
+            sock.sendall("HTTP/1.0 200 OK\r\nContent-Length: %i\r\n\r\n%s" % (len(head), head))
+        server_thread = eventlet.spawn(eventlet.serve, listener, serve)
+        try:
+            self.balancer.keepalive_timeout = 1
+            self.balancer.hosts["empty.com"] = ["empty", {"code": 204}, False]
+            self.balancer.hosts["proxied.com"] = [
+                "proxy",
+                {"backends": [Backend(listener.getsockname())]},
+                False,
+            ]
+            client = eventlet.connect(("127.0.0.1", self.next_port))
+            client.sendall(
+                "GET /one HTTP/1.1\r\nX-Loadbalance-To: empty.com\r\n\r\n"
+                "GET /two HTTP/1.1\r\nX-Loadbalance-To: proxied.com\r\n\r\n"
+                "GET /three HTTP/1.1\r\nX-Loadbalance-To: empty.com\r\nConnection: close\r\n\r\n"
+            )
+            received = ""
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    break
+                received += data
+            client.close()
+            self.assertEqual(3, received.count("HTTP/1.0 "))
+            self.assertEqual(2, received.count("204 No Content"))
+            self.assertEqual(2, received.count("Connection: keep-alive"))
+            self.assertEqual(1, received.count("Connection: close\r\nContent-length: 0"))
+            self.assert_("GET /two HTTP/1.1" in received)
+            self.assert_("/three" not in received)
+        finally:
+            server_thread.kill()
+            listener.close()
+
+    def test_keepalive_request_body(self):
+        "Tests a body sent to an action that doesn't read it isn't taken as the next request"
+        self.balancer.keepalive_timeout = 1
+        self.balancer.hosts["empty.com"] = ["empty", {"code": 204}, False]
+        self.balancer.hosts["internal.com"] = ["empty", {"code": 418}, False]
+        smuggled = "GET /admin HTTP/1.1\r\nX-Loadbalance-To: internal.com\r\n\r\n"
+        client = eventlet.connect(("127.0.0.1", self.next_port))
+        client.sendall(
+            "POST / HTTP/1.1\r\nX-Loadbalance-To: empty.com\r\nContent-Length: %i\r\n\r\n%s" % (len(smuggled), smuggled)
+        )
+        received = ""
+        with Timeout(5):
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    break
+                received += data
+        client.close()
+        self.assertEqual(1, received.count("HTTP/1.0 "))
+        self.assert_("204 No Content" in received)
+        self.assert_("Connection: close" in received)
+        self.assert_("418" not in received)
+
+    def test_proxy_chunked_request(self):
+        "Tests that chunked request bodies are streamed to the backend"
+        listener = eventlet.listen(("127.0.0.1", 0))
+        def serve(sock, address):
+            sock = BufferedSocket(sock)
+            while True:
+                head = read_head(sock)
+                if head is None:
+                    return
+                body = MockSocket()
+                relay_chunked(sock, body)
+                sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: %i\r\n\r\n%s" % (len(body.data), body.data))
+        server_thread = eventlet.spawn(eventlet.serve, listener, serve)
+        try:
+            self.balancer.hosts["chunked.com"] = [
+                "proxy",
+                {"backends": [Backend(listener.getsockname())]},
+                False,
+            ]
+            request = (
+                "POST / HTTP/1.1\r\nX-Loadbalance-To: chunked.com\r\n"
+                "Transfer-Encoding: chunked\r\nContent-Length: 3\r\n\r\n"
+            )
+            body = "5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\n\r\n"
+            for keepalive_timeout in (0, 1):
+                self.balancer.keepalive_timeout = keepalive_timeout
+                client = eventlet.connect(("127.0.0.1", self.next_port))
+                client.sendall(request)
+                eventlet.sleep(0.05)
+                client.sendall(body)
+                if not keepalive_timeout:
+                    client.shutdown(socket.SHUT_WR)
+                received = ""
+                while not received.endswith(body):
+                    data = client.recv(4096)
+                    if not data:
+                        break
+                    received += data
+                client.close()
+                self.assert_(received.startswith("HTTP/1.1 200 OK"))
+                self.assert_(received.endswith("\r\n\r\n" + body))
+        finally:
+            server_thread.kill()
+            listener.close()
+
+
+    def test_proxy_metrics(self):
+        "Tests that proxied requests record latency metrics"
+        listener = eventlet.listen(("127.0.0.1", 0))
+        def serve(sock, address):
+            sock = BufferedSocket(sock)
+            while read_head(sock) is not None:
+                sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        server_thread = eventlet.spawn(eventlet.serve, listener, serve)
+        try:
+            self.balancer.hosts["metrics.com"] = [
+                "proxy",
+                {"backends": [Backend(listener.getsockname())]},
+                True,
+            ]
+            # Both the plain relay and the framed, keep-alive one
+            for keepalive_timeout in (0, 1):
+                self.balancer.keepalive_timeout = keepalive_timeout
+                resp, content = httplib2.Http().request(
+                    "http://127.0.0.1:%i" % self.next_port,
+                    "GET",
+                    headers = {"X-Loadbalance-To": "www.metrics.com"},
+                )
+                self.assertEqual("ok", content)
+            labels = (("host", "metrics.com"), ("backend", "%s:%s" % listener.getsockname()))
+            histograms = self.balancer.metrics.histograms
+            self.assertEqual(2, sum(histograms["mantrid_backend_request_seconds", labels].counts))
+            self.assertEqual(2, sum(histograms["mantrid_backend_first_byte_seconds", labels].counts))
+            self.assertEqual(2, sum(histograms["mantrid_backend_connect_seconds", labels].counts))
+            text = httplib2.Http().request("http://127.0.0.1:%i/metrics" % (self.next_port + 2))[1]
+            self.assert_('mantrid_backend_request_seconds_count{host="metrics.com",backend="%s:%s"} 2\n' % listener.getsockname() in text)
+            self.assert_('mantrid_requests_total{host="metrics.com"} 2\n' in text)
+        finally:
+            server_thread.kill()
+            listener.close()
+
+    def test_cache(self):
+        "Tests that the cache action serves repeat and concurrent GETs itself"
+        listener = eventlet.listen(("127.0.0.1", 0))
+        requests = []
+        def serve(sock, address):
+            sock = BufferedSocket(sock)
+            while True:
+                head = read_head(sock)
+                if head is None:
+                    break
+                requests.append(head.split("\r\n")[0])
+                # Slow enough for concurrent requests to arrive meanwhile
+                eventlet.sleep(0.1)
+                if " /private " in head:
+                    sock.sendall("HTTP/1.1 200 OK\r\nCache-Control: no-store\r\nContent-Length: 7\r\n\r\nprivate")
+                else:
+                    sock.sendall("HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 2\r\n\r\nok")
+        server_thread = eventlet.spawn(eventlet.serve, listener, serve)
+        try:
+            self.balancer.hosts["cache.com"] = [
+                "cache",
+                {"backends": [Backend(listener.getsockname())]},
+                True,
+            ]
+            def get(path):
+                return httplib2.Http().request(
+                    "http://127.0.0.1:%i%s" % (self.next_port, path),
+                    "GET",
+                    headers = {"X-Loadbalance-To": "www.cache.com"},
+                )
+            pool = eventlet.GreenPool()
+            results = list(pool.imap(get, ["/page"] * 5))
+            self.assertEqual(["ok"] * 5, [content for resp, content in results])
+            self.assertEqual(["GET /page HTTP/1.1"], requests)
+            resp, content = get("/page")
+            self.assertEqual("ok", content)
+            self.assertEqual("HIT", resp["x-cache"])
+            self.assertEqual(1, len(requests))
+            # Responses that say not to be stored aren't
+            get("/private")
+            self.assertEqual("private", get("/private")[1])
+            self.assertEqual(3, len(requests))
+            stats = self.balancer.snapshot_stats()["cache.com"]
+            self.assertEqual(5, stats["cache_hits"])
+            self.assertEqual(3, stats["cache_misses"])
+            # HTTPS requests (from a terminator on the internal port)
+            # don't share responses with HTTP ones
+            def get_https(path):
+                return httplib2.Http().request(
+                    "http://127.0.0.1:%i%s" % (self.next_port + 1, path),
+                    "GET",
+                    headers = {"X-Loadbalance-To": "www.cache.com", "X-Forwarded-Proto": "https"},
+                )
+            self.assertEqual("ok", get_https("/page")[1])
+            self.assertEqual(4, len(requests))
+            resp, content = get_https("/page")
+            self.assertEqual("HIT", resp["x-cache"])
+            self.assertEqual(4, len(requests))
+            # Sizes and lifetimes must be non-negative whole numbers
+            from ..management import ManagementApp
+            for name, value in [
+                ("max_bytes", -1),
+                ("max_object_bytes", "big"),
+                ("ttl", None),
+                ("disk_max_bytes", -1024),
+                ("disk_dir", 5),
+            ]:
+                self.assertEqual(
+                    "host_%s_invalid" % name,
+                    ManagementApp(self.balancer).host_errors("cache.com", ["cache", {
+                        "backends": [Backend(listener.getsockname())],
+                        name: value,
+                    }, False]),
+                )
+            self.assertEqual(
+                None,
+                ManagementApp(self.balancer).host_errors("cache.com", ["cache", {
+                    "backends": [Backend(listener.getsockname())],
+                    "max_bytes": "1048576",
+                    "ttl": 0,
+                }, False]),
+            )
+        finally:
+            server_thread.kill()
+            listener.close()
+
+    def test_mirror(self):
+        "Tests that the mirror action copies requests without waiting for the mirrors"
+        def listen(handler):
+            listener = eventlet.listen(("127.0.0.1", 0))
+            return listener, eventlet.spawn(eventlet.serve, listener, handler)
+        def primary(sock, address):
+            sock = BufferedSocket(sock)
+            while True:
+                head = read_head(sock)
+                if head is None:
+                    break
+                body = ""
+                while len(body) < int(MessageHead(head).get("Content-Length", 0)):
+                    body += sock.recv(4096)
+                sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: 7\r\n\r\nprimary")
+        copies = []
+        def mirror(sock, address):
+            data = ""
+            while "\r\n\r\n" not in data or not data.endswith("hello"):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            copies.append(data)
+            sock.sendall("HTTP/1.1 500 Ignored\r\nContent-Length: 0\r\n\r\n")
+            sock.close()
+        def slow_mirror(sock, address):
+            eventlet.sleep(1)
+            sock.close()
+        primary_listener, primary_thread = listen(primary)
+        mirror_listener, mirror_thread = listen(mirror)
+        slow_listener, slow_thread = listen(slow_mirror)
+        try:
+            self.balancer.hosts["mirror.com"] = [
+                "mirror",
+                {
+                    "backends": [Backend(primary_listener.getsockname())],
+                    "mirrors": [Backend(mirror_listener.getsockname()), Backend(slow_listener.getsockname())],
+                    "max_queued": 1,
+                    "concurrency": 1,
+                },
+                False,
+            ]
+            def post():
+                return httplib2.Http().request(
+                    "http://127.0.0.1:%i/submit" % self.next_port,
+                    "POST",
+                    body = "hello",
+                    headers = {"X-Loadbalance-To": "mirror.com"},
+                )
+            start = time.time()
+            results = [post() for i in range(4)]
+            # The slow mirror doesn't hold up the real requests
+            self.assert_(time.time() - start < 0.8)
+            self.assertEqual(["primary"] * 4, [content for resp, content in results])
+            eventlet.sleep(0.2)
+            self.assert_(copies)
+            self.assert_(copies[0].startswith("POST /submit HTTP/1.1\r\n"))
+            self.assert_("\r\nConnection: close\r\n" in copies[0])
+            self.assert_(copies[0].endswith("\r\n\r\nhello"))
+            # One copy is being sent to the slow mirror and one is queued;
+            # the others were dropped
+            counters = self.balancer.metrics.counters
+            slow_label = ("mirror", "%s:%s" % slow_listener.getsockname())
+            self.assertEqual(2, counters[("mantrid_mirror_requests_total", (slow_label, ("result", "dropped")))])
+            self.assertEqual(4, counters[("mantrid_mirror_requests_total", (("mirror", "%s:%s" % mirror_listener.getsockname()), ("result", "sent")))])
+            # Mirrors must be given
+            from ..management import ManagementApp
+            self.assertEqual(
+                "host_mirrors_invalid",
+                ManagementApp(self.balancer).host_errors("mirror.com", ["mirror", {"backends": [Backend(primary_listener.getsockname())]}, False]),
+            )
+            # And the sampling and limits must make sense
+            for name, value in [
+                ("sample", 1.5),
+                ("sample", -0.1),
+                ("sample", "half"),
+                ("timeout", 0),
+                ("timeout", None),
+                ("max_body_bytes", -1),
+                ("max_body_bytes", "lots"),
+            ]:
+                self.assertEqual(
+                    "host_%s_invalid" % name,
+                    ManagementApp(self.balancer).host_errors("mirror.com", ["mirror", {
+                        "backends": [Backend(primary_listener.getsockname())],
+                        "mirrors": [Backend(mirror_listener.getsockname())],
+                        name: value,
+                    }, False]),
+                )
+            self.assertEqual(
+                None,
+                ManagementApp(self.balancer).host_errors("mirror.com", ["mirror", {
+                    "backends": [Backend(primary_listener.getsockname())],
+                    "mirrors": [Backend(mirror_listener.getsockname())],
+                    "sample": "0.25",
+                    "timeout": 2,
+                    "max_body_bytes": 0,
+                }, False]),
+            )
+        finally:
+            for listener, thread in [(primary_listener, primary_thread), (mirror_listener, mirror_thread), (slow_listener, slow_thread)]:
+                thread.kill()
+                listener.close()
@@ -0,0 +1,101 @@
+import collections
+import time
+import unittest
+import mantrid.json
+from ..actions import NoHealthyBackends, Proxy
+from ..algorithms import algorithm_mapping
+from ..backend import Backend
+from ..loadbalancer import Balancer
+from ..management import ManagementApp
+
+
+class AlgorithmTests(unittest.TestCase):
+    "Tests the backend selection algorithms"
+
+    def proxy(self, backends, **kwargs):
+        return Proxy(Balancer(None, None, None, None), "test.com", "test.com", backends, **kwargs)
+
+    def test_weighted_round_robin(self):
+        "Tests that backends get turns in proportion to their weight, spread out"
+        backends = [Backend(("127.0.0.1", 1), 3), Backend(("127.0.0.1", 2)), Backend(("127.0.0.1", 3), 2)]
+        proxy = self.proxy(backends, algorithm="weighted_round_robin")
+        picks = [proxy.select_backend({}) for i in range(60)]
+        counts = collections.Counter(backend.port for backend in picks)
+        self.assertEqual({1: 30, 2: 10, 3: 20}, counts)
+        # The heaviest backend never gets more than two turns in a row
+        self.assert_(all(picks[i:i + 3] != [backends[0]] * 3 for i in range(58)))
+        # Blacklisted backends are skipped
+        backends[0].checker = self
+        backends[0].blacklisted = True
+        self.assert_(backends[0] not in [proxy.select_backend({}) for i in range(10)])
+
+    def test_consistent_hash(self):
+        "Tests that keys stick to a backend, and mostly stay there when one goes"
+        backends = [Backend(("127.0.0.1", port)) for port in range(1, 6)]
+        proxy = self.proxy(backends, algorithm="consistent_hash", hash_header="X-Session")
+        picks = dict(
+            (key, proxy.select_backend({"X-Session": key}))
+            for key in ("session%i" % i for i in range(500))
+        )
+        for key, backend in picks.items()[:50]:
+            self.assertEqual(backend, proxy.select_backend({"X-Session": key}))
+        # Each backend gets a fair share
+        counts = collections.Counter(picks.values())
+        self.assert_(min(counts.values()) > 50)
+        # Only keys on a removed backend move
+        backends[0].checker = self
+        backends[0].blacklisted = True
+        for key, backend in picks.items():
+            if backend is not backends[0]:
+                self.assertEqual(backend, proxy.select_backend({"X-Session": key}))
+        # Without the header, the client address is used
+        proxy = self.proxy(backends, algorithm="consistent_hash")
+        self.assertEqual(
+            proxy.select_backend({"X-Forwarded-For": "10.0.0.1"}),
+            proxy.select_backend({"X-Forwarded-For": "10.0.0.1, 10.0.0.2"}),
+        )
+
+    def test_power_of_two(self):
+        "Tests that the less loaded of two backends is picked"
+        backends = [Backend(("127.0.0.1", 1)), Backend(("127.0.0.1", 2))]
+        backends[0].add_connection()
+        proxy = self.proxy(backends, algorithm="power_of_two")
+        picks = [proxy.select_backend({}) for i in range(50)]
+        self.assert_(picks.count(backends[1]) > picks.count(backends[0]))
+        for backend in backends:
+            backend.checker = self
+            backend.blacklisted = True
+        self.assertRaises(NoHealthyBackends, proxy.select_backend, {})
+
+    def test_weights_and_validation(self):
+        "Tests that weights survive JSON and bad options are refused"
+        backend = mantrid.json.loads(mantrid.json.dumps(Backend(("127.0.0.1", 80), 5)))
+        self.assertEqual(5, backend.weight)
+        self.assertEqual('{"__backend__": ["127.0.0.1", 80]}', mantrid.json.dumps(Backend(("127.0.0.1", 80))))
+        app = ManagementApp(Balancer(None, None, None, None))
+        self.assertEqual(None, app.host_errors("test.com", ["proxy", {"backends": [backend], "algorithm": "consistent_hash", "hash_header": "Cookie"}, False]))
+        self.assertEqual("host_algorithm_invalid:fastest", app.host_errors("test.com", ["proxy", {"backends": [backend], "algorithm": "fastest"}, False]))
+        self.assertEqual("host_hash_header_invalid", app.host_errors("test.com", ["proxy", {"backends": [backend], "algorithm": "consistent_hash", "hash_header": 4}, False]))
+        backend.weight = 0
+        self.assertEqual("host_backend_weight_invalid", app.host_errors("test.com", ["proxy", {"backends": [backend]}, False]))
+        backend.weight = Backend.max_weight + 1
+        self.assertEqual("host_backend_weight_invalid", app.host_errors("test.com", ["proxy", {"backends": [backend]}, False]))
+
+    def test_unknown_algorithm(self):
+        "Tests that an unknown algorithm from a state file falls back to the default"
+        backends = [Backend(("127.0.0.1", 1))]
+        proxy = self.proxy(backends, algorithm="fastest")
+        self.assertEqual(backends[0], proxy.select_backend({}))
+        self.assert_(isinstance(proxy.selector, algorithm_mapping[Proxy.default_algorithm]))
+
+    def test_big_weights(self):
+        "Tests that big weights don't make selectors slow to build"
+        backends = [Backend(("127.0.0.1", port), Backend.max_weight - port) for port in range(1, 21)]
+        start = time.time()
+        for algorithm in ("weighted_round_robin", "consistent_hash"):
+            self.proxy(backends, algorithm=algorithm).select_backend({"X-Forwarded-For": "10.0.0.1"})
+        self.assert_(time.time() - start < 1)
+        # Turns still follow the weights
+        proxy = self.proxy(backends[:2], algorithm="weighted_round_robin")
+        picks = [proxy.select_backend({}) for i in range(sum(backend.weight for backend in backends[:2]))]
+        self.assertEqual([backend.weight for backend in backends[:2]], [picks.count(backend) for backend in backends[:2]])
@@ -0,0 +1,53 @@
+import random
+import unittest
+from ..backend import Backend, BackendGroup
+
+
+class BackendGroupTests(unittest.TestCase):
+    "Tests the incrementally-maintained sets of usable backends"
+
+    def test_least_connected(self):
+        "Tests the group against a full scan through random changes"
+        backends = [Backend(("127.0.0.1", port)) for port in range(1, 21)]
+        for backend in backends:
+            backend.checker = self
+        group = BackendGroup.of(backends)
+        self.assert_(BackendGroup.of(backends) is group)
+        for i in range(2000):
+            backend = random.choice(backends)
+            change = random.random()
+            if change < 0.1:
+                backend.blacklisted = not backend.blacklisted
+            elif change < 0.55 or not backend.connections:
+                backend.add_connection()
+            else:
+                backend.drop_connection()
+            usable = [b for b in backends if not b.blacklisted]
+            self.assertEqual(set(usable), set(group.healthy))
+            if usable:
+                self.assertEqual(
+                    min(b.connections for b in usable),
+                    group.least_connected().connections,
+                )
+            else:
+                self.assertEqual(None, group.least_connected())
+
+    def test_no_healthcheck(self):
+        "Tests that blacklisting doesn't matter to groups without health checks"
+        backends = [Backend(("127.0.0.1", 1))]
+        backends[0].checker = self
+        group = BackendGroup.of(backends, healthcheck=False)
+        backends[0].blacklisted = True
+        self.assertEqual(backends[0], group.any())
+
+    def test_draining(self):
+        "Tests that draining backends are never picked, health checked or not"
+        backends = [Backend(("127.0.0.1", 1)), Backend(("127.0.0.1", 2))]
+        checked = BackendGroup.of(backends)
+        unchecked = BackendGroup.of(backends, healthcheck=False)
+        backends[0].draining = True
+        for i in range(20):
+            self.assertEqual(backends[1], checked.any())
+            self.assertEqual(backends[1], unchecked.least_connected())
+        backends[0].draining = False
+        self.assertEqual(2, len(checked.healthy))
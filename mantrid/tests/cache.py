@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from ..cache import CachedResponse, ResponseCache, cacheable_response, freshness
+from ..framing import MessageHead
+
+
+class CacheTests(unittest.TestCase):
+    "Tests the response cache and its freshness rules"
+
+    def entry(self, body="x" * 100, expires=2000):
+        return CachedResponse("HTTP/1.1 200 OK\r\n", body, 1000, expires)
+
+    def test_freshness(self):
+        def lifetime(head, default_ttl=0):
+            return freshness(MessageHead("HTTP/1.1 200 OK\r\n" + head), 1300000000, default_ttl)
+        self.assertEqual(60, lifetime("Cache-Control: public, max-age=60"))
+        self.assertEqual(10, lifetime("Cache-Control: max-age=60, s-maxage=10"))
+        self.assertEqual(50, lifetime("Cache-Control: max-age=60\r\nAge: 10"))
+        self.assertEqual(0, lifetime("Cache-Control: max-age=60, private"))
+        self.assertEqual(0, lifetime("Cache-Control: no-cache"))
+        self.assertEqual(0, lifetime("Cache-Control: max-age=60\r\nSet-Cookie: a=b"))
+        self.assertEqual(0, lifetime("Cache-Control: max-age=60\r\nVary: Cookie"))
+        self.assertEqual(60, lifetime("Cache-Control: max-age=60\r\nVary: Accept-Encoding"))
+        self.assertEqual(3600, lifetime("Date: Sun, 13 Mar 2011 07:06:40 GMT\r\nExpires: Sun, 13 Mar 2011 08:06:40 GMT"))
+        self.assertEqual(0, lifetime("Expires: 0"))
+        self.assertEqual(0, lifetime(""))
+        self.assertEqual(30, lifetime("", default_ttl=30))
+
+    def test_cacheable_response(self):
+        entry = cacheable_response("HTTP/1.1 200 OK\r\nConnection: close\r\nCache-Control: max-age=60\r\nContent-Length: 2\r\n\r\nok", 1000)
+        self.assertEqual("HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 2\r\n", entry.head)
+        self.assertEqual(1060, entry.expires)
+        self.assertEqual(
+            "HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 2\r\nAge: 5\r\nX-Cache: HIT\r\nConnection: keep-alive\r\n\r\nok",
+            entry.render(1005, True),
+        )
+        # Incomplete bodies, bodies not delimited by length, and errors aren't
+        self.assertEqual(None, cacheable_response("HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 3\r\n\r\nok", 1000))
+        self.assertEqual(None, cacheable_response("HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n\r\nok", 1000))
+        self.assertEqual(None, cacheable_response("HTTP/1.1 500 Oops\r\nCache-Control: max-age=60\r\nContent-Length: 2\r\n\r\nok", 1000))
+
+    def test_lru(self):
+        cache = ResponseCache(max_bytes=400, max_object_bytes=200)
+        for key in "abc":
+            cache.put(key, self.entry())
+        self.assertEqual(351, cache.size)
+        # Using a makes b the least recently used
+        self.assertNotEqual(None, cache.get("a", now=1500))
+        cache.put("d", self.entry())
+        self.assertEqual(["c", "a", "d"], list(cache.entries))
+        # Too big, and expired
+        cache.put("e", self.entry(body="x" * 300))
+        self.assertEqual(None, cache.get("e", now=1500))
+        self.assertEqual(None, cache.get("a", now=2500))
+        self.assertEqual(["c", "d"], list(cache.entries))
+        self.assertEqual(234, cache.size)
+
+    def test_disk_spill(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # A directory left by a process that has exited
+            os.mkdir(os.path.join(directory, "mantrid-cache-999999999"))
+            cache = ResponseCache(max_bytes=200, max_object_bytes=200, disk_dir=directory, disk_max_bytes=1000)
+            expires = time.time() + 60
+            cache.put("a", self.entry(body="a" * 100, expires=expires))
+            cache.put("b", self.entry(body="b" * 100, expires=expires))
+            self.assertEqual(["b"], list(cache.entries))
+            self.assertEqual(["mantrid-cache-%i" % os.getpid()], os.listdir(directory))
+            # It comes back from disk, and pushes b out there
+            entry = cache.get("a")
+            self.assertEqual("a" * 100, entry.body)
+            self.assertEqual("HTTP/1.1 200 OK\r\n", entry.head)
+            self.assertEqual(["a"], list(cache.entries))
+            self.assertEqual(["b"], list(cache.disk.entries))
+            cache.clear()
+            self.assertEqual([], os.listdir(os.path.join(directory, "mantrid-cache-%i" % os.getpid())))
+        finally:
+            shutil.rmtree(directory)
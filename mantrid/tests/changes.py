@@ -0,0 +1,62 @@
+import time
+import unittest
+
+import eventlet
+from ..changes import ChangeFeed
+
+
+class ChangeFeedTests(unittest.TestCase):
+    "Tests the change feed's revisions and window"
+
+    def test_since(self):
+        "Tests changes after a revision are returned, in order"
+        feed = ChangeFeed()
+        self.assertEqual([], feed.since(0))
+        feed.record({"type": "set", "host": "ep.io"})
+        feed.record({"type": "delete", "host": "ep.io"})
+        self.assertEqual(2, feed.revision)
+        self.assertEqual(
+            [{"type": "set", "host": "ep.io", "revision": 1}, {"type": "delete", "host": "ep.io", "revision": 2}],
+            feed.since(0),
+        )
+        self.assertEqual([{"type": "delete", "host": "ep.io", "revision": 2}], feed.since(1))
+        self.assertEqual([], feed.since(2))
+        # Revisions we've not got to, or from another process, can't be caught up from
+        self.assertEqual(None, feed.since(3))
+        self.assertEqual(None, feed.since(1, "some-other-epoch"))
+        self.assertEqual([], feed.since(2, feed.epoch))
+
+    def test_window(self):
+        "Tests only the last max_changes are kept"
+        feed = ChangeFeed(max_changes=3)
+        for i in range(20):
+            feed.record({"type": "replace"})
+        self.assert_(len(feed.changes) <= 6)
+        self.assertEqual([18, 19, 20], [change["revision"] for change in feed.since(17)])
+        self.assertEqual(None, feed.since(16))
+        self.assertEqual({"epoch": feed.epoch, "revision": 20, "reset": True, "changes": []}, feed.response(0, 0))
+
+    def test_wait(self):
+        "Tests waiting for a change"
+        feed = ChangeFeed()
+        start = time.time()
+        self.assertEqual([], feed.wait(0, 0.1))
+        self.assert_(time.time() - start >= 0.1)
+        eventlet.spawn_after(0.1, feed.record, {"type": "replace"})
+        start = time.time()
+        self.assertEqual([{"type": "replace", "revision": 1}], feed.wait(0, 5))
+        self.assert_(time.time() - start < 1)
+
+    def test_stream(self):
+        "Tests streaming batches of changes and heartbeats"
+        feed = ChangeFeed()
+        feed.record({"type": "replace"})
+        stream = feed.stream(0, 0.05)
+        self.assertEqual({"epoch": feed.epoch, "revision": 1, "changes": [{"type": "replace", "revision": 1}]}, stream.next())
+        self.assertEqual(None, stream.next())
+        eventlet.spawn_after(0.01, feed.record, {"type": "delete", "host": "ep.io"})
+        self.assertEqual([2], [change["revision"] for change in stream.next()["changes"]])
+        self.assertEqual(
+            {"epoch": feed.epoch, "revision": 2, "reset": True, "changes": []},
+            feed.stream(5, 0.05).next(),
+        )
@@ -1,8 +1,13 @@
+import json
+import time
 import unittest
 import eventlet
 import socket
+from eventlet import tpool
+from ..backend import Backend
 from ..loadbalancer import Balancer
-from ..client import MantridClient
+from ..management import ManagementApp
+from ..client import MantridClient, httplib2
 
 
 class MockSocket(object):
@@ -79,6 +84,21 @@ class ClientTests(unittest.TestCase):
             IOError,
             self.client.set, "test-host.com", ["do-da-be-dee", {}, "bruce"],
         )
+        # Health check settings the checker couldn't use are refused
+        backends = [Backend(("127.0.0.1", 8000))]
+        for options in (
+            {"healthcheck_status": "ok"},
+            {"healthcheck_status": 1000},
+            {"healthcheck_path": "status"},
+            {"healthcheck_path": "/status\r\nX-Injected: 1"},
+        ):
+            options["backends"] = backends
+            self.assertRaisesRegexp(
+                IOError, "Got 400",
+                self.client.set, "test-host.com", ["proxy", options, False],
+            )
+        self.client.set("test-host.com", ["proxy", {"backends": backends, "healthcheck_status": 204, "healthcheck_path": "/status"}, False])
+        self.client.set("test-host.com", ["unknown", {}, True])
         # Delete it
         self.client.delete("test-host.com")
         self.assertEqual(
@@ -129,3 +149,208 @@ class ClientTests(unittest.TestCase):
             {"ceilingcat.net": {}, "khaaaaaaaaaan.com": {}},
             self.balancer.stats,
         )
+
+    def test_update_many(self):
+        "Sets and deletes several hosts in one request"
+        self.client.set_all({
+            "kittens.com": ["spin", {}, False],
+            "ep.io": ["proxy", {"backends": [Backend(("127.0.0.1", 8000))]}, False],
+        })
+        backend = self.balancer.hosts["ep.io"][1]["backends"][0]
+        changed = self.client.update_many(
+            {
+                "ep.io": ["proxy", {"backends": [Backend(("127.0.0.1", 8000))]}, False],
+                "lions.net": ["empty", {"code": 404}, True],
+            },
+            ["kittens.com", "never-there.com"],
+        )
+        self.assertEqual(["kittens.com", "lions.net"], changed)
+        self.assertEqual(["ep.io", "lions.net"], sorted(self.balancer.hosts))
+        # ep.io was unchanged, so keeps its backend objects
+        self.assertTrue(self.balancer.hosts["ep.io"][1]["backends"][0] is backend)
+        self.assertFalse(backend.retired)
+        self.assertEqual({"ep.io": {}, "lions.net": {}}, self.balancer.stats)
+        # Nothing is applied if any of it is invalid
+        self.assertRaises(
+            IOError,
+            self.client.update_many,
+            {"tigers.net": ["empty", {"code": 404}, True], "bad.com": ["nonexistent", {}, True]},
+        )
+        self.assertRaises(IOError, self.client.update_many, {"ep.io": ["spin", {}, False]}, ["ep.io"])
+        self.assertEqual(["ep.io", "lions.net"], sorted(self.balancer.hosts))
+
+    def test_changes(self):
+        "Follows the change feed"
+        self.client.set_all({"kittens.com": ["spin", {}, False]})
+        start = self.client.changes()
+        self.assertEqual("replace", start["changes"][-1]["type"])
+        self.client.set("ep.io", ["proxy", {"backends": [Backend(("127.0.0.1", 8000))]}, False])
+        self.client.delete("kittens.com")
+        reply = self.client.changes(start["revision"], epoch=start["epoch"])
+        self.assertEqual(start["revision"] + 2, reply["revision"])
+        self.assertEqual(
+            [("set", "ep.io"), ("delete", "kittens.com")],
+            [(change["type"], change["host"]) for change in reply["changes"]],
+        )
+        self.assertEqual(["127.0.0.1", 8000], list(reply["changes"][0]["settings"][1]["backends"][0].address))
+        # Waits for the next change, which is a backend being blacklisted
+        backend = self.balancer.hosts["ep.io"][1]["backends"][0]
+        backend.checker = self
+        eventlet.spawn_after(0.2, setattr, backend, "blacklisted", True)
+        waited = time.time()
+        changes = self.client.changes(reply["revision"], 5, reply["epoch"])["changes"]
+        self.assert_(0.1 < time.time() - waited < 4)
+        self.assertEqual([{"type": "blacklist", "backend": "127.0.0.1:8000", "revision": reply["revision"] + 1}], changes)
+        backend.blacklisted = False
+        self.assertEqual("unblacklist", self.client.changes(reply["revision"] + 1)["changes"][0]["type"])
+        # An address stays blacklisted while any of its backends is, and
+        # working that out doesn't mean looking through every host
+        self.client.set("ep2.io", ["proxy", {"backends": [Backend(("127.0.0.1", 8000))]}, False])
+        other = self.balancer.hosts["ep2.io"][1]["backends"][0]
+        other.checker = self
+        def no_scanning():
+            raise AssertionError("Looked through every backend")
+        self.balancer.backends = no_scanning
+        revision = self.client.changes()["revision"]
+        backend.blacklisted = True
+        other.blacklisted = True
+        backend.blacklisted = False
+        self.assertEqual(
+            [("blacklist", "127.0.0.1:8000")],
+            [(change["type"], change["backend"]) for change in self.client.changes(revision)["changes"]],
+        )
+        # Removing the last blacklisted one unblacklists the address
+        self.client.delete("ep2.io")
+        self.assertEqual(
+            [("blacklist", "127.0.0.1:8000"), ("unblacklist", "127.0.0.1:8000")],
+            [(change["type"], change.get("backend")) for change in self.client.changes(revision)["changes"] if change["type"] != "delete"],
+        )
+        del self.balancer.backends
+        # Another process's revisions mean starting again
+        self.assert_(self.client.changes(1, epoch="other")["reset"])
+        self.assertRaises(IOError, self.client.changes, -1)
+        self.assertRaises(IOError, self.client.changes, 0, 100000)
+
+    def test_etags(self):
+        "Tests unchanged host tables and stats get a 304"
+        self.client.set_all({
+            "kittens.com": ["spin", {}, False],
+            "ep.io": ["proxy", {"backends": [Backend(("127.0.0.1", 8000), 2)]}, False],
+        })
+        http = httplib2.Http()
+        url = "http://127.0.0.1:%i/hostname/" % (self.next_port + 2)
+        resp, content = http.request(url, "GET")
+        self.assertEqual(200, resp.status)
+        self.assertEqual(
+            {
+                "kittens.com": ["spin", {}, False],
+                "ep.io": ["proxy", {"backends": [{"__backend__": ["127.0.0.1", 8000], "weight": 2}]}, False],
+            },
+            json.loads(content),
+        )
+        etag = resp["etag"]
+        # A 304 doesn't encode the table first
+        encoded = []
+        def encode(app, items, mapping):
+            encoded.append(mapping)
+            return original_encode(app, items, mapping)
+        original_encode = ManagementApp.encode.im_func
+        ManagementApp.encode = encode
+        try:
+            resp, content = http.request(url, "GET", headers={"If-None-Match": etag})
+        finally:
+            ManagementApp.encode = original_encode
+        self.assertEqual(304, resp.status)
+        self.assertEqual([], encoded)
+        self.client.delete("kittens.com")
+        resp, content = http.request(url, "GET", headers={"If-None-Match": etag})
+        self.assertEqual(200, resp.status)
+        self.assertEqual(["ep.io"], json.loads(content).keys())
+        # Stats are the same until a request changes them
+        url = "http://127.0.0.1:%i/stats/" % (self.next_port + 2)
+        resp, content = http.request(url, "GET")
+        self.assertEqual({"ep.io": {}}, json.loads(content))
+        resp, content = http.request(url, "GET", headers={"If-None-Match": resp["etag"]})
+        self.assertEqual(304, resp.status)
+        self.balancer.stats["ep.io"]["completed_requests"] = 5
+        resp, content = http.request(url, "GET", headers={"If-None-Match": resp["etag"]})
+        self.assertEqual(200, resp.status)
+        self.assertEqual(5, json.loads(content)["ep.io"]["completed_requests"])
+
+    def test_offload(self):
+        "Tests big host tables are validated in a thread"
+        self.balancer.offload_min_size = 2
+        used = []
+        execute = tpool.execute
+        def recording_execute(function, *args):
+            used.append(function.__name__)
+            return execute(function, *args)
+        tpool.execute = recording_execute
+        try:
+            self.client.set_all({
+                "kittens.com": ["spin", {}, False],
+                "ep.io": ["proxy", {"backends": [Backend(("127.0.0.1", 8000))]}, False],
+            })
+            self.assertRaises(IOError, self.client.set_all, {"a.com": ["spin", {}, False], "b.com": ["nonexistent", {}, False]})
+        finally:
+            tpool.execute = execute
+        self.assertEqual(["ep.io", "kittens.com"], sorted(self.balancer.hosts))
+        self.assertEqual("ep.io", self.balancer.resolve_host("ep.io").host)
+        self.assertEqual(["prepare_hosts", "prepare_hosts"], used)
+        self.assertEqual(["ep.io", "kittens.com"], sorted(self.client.get_all()))
+
+    def test_offload_encode(self):
+        "Tests offloaded encodes of the host table and stats run one at a time"
+        self.balancer.offload_min_size = 1
+        self.client.set("ep.io", ["proxy", {"backends": [Backend(("127.0.0.1", 8000))]}, False])
+        running = []
+        overlaps = []
+        execute = tpool.execute
+        def recording_execute(function, *args):
+            if function.__name__ != "encode":
+                return execute(function, *args)
+            running.append(function)
+            overlaps.append(len(running))
+            try:
+                eventlet.sleep(0.05)
+                return execute(function, *args)
+            finally:
+                running.remove(function)
+        tpool.execute = recording_execute
+        try:
+            pool = eventlet.GreenPool()
+            for i in range(3):
+                pool.spawn(self.client.get_all)
+                pool.spawn(self.client.stats)
+            pool.waitall()
+        finally:
+            tpool.execute = execute
+        self.assertEqual([1] * 6, overlaps)
+
+    def test_drain(self):
+        "Drains a backend"
+        self.client.set("ep.io", ["proxy", {"backends": [Backend(("127.0.0.1", 8000))]}, False])
+        backend = self.balancer.hosts["ep.io"][1]["backends"][0]
+        self.assertEqual(
+            {"connections": 0, "draining": False},
+            self.client.backends()["127.0.0.1:8000"],
+        )
+        backend.add_connection()
+        # Times out with the connection still open
+        self.assertEqual(
+            {"connections": 1, "draining": True},
+            self.client.drain("127.0.0.1:8000", 0.2),
+        )
+        self.assert_(backend.draining)
+        # Returns as soon as the connection finishes
+        eventlet.spawn_after(0.3, backend.drop_connection)
+        self.assertEqual(
+            {"connections": 0, "draining": True},
+            self.client.drain("127.0.0.1:8000", 5),
+        )
+        self.client.undrain("127.0.0.1:8000")
+        self.assertEqual(
+            {"connections": 0, "draining": False},
+            self.client.backend("127.0.0.1:8000"),
+        )
+        self.assertFalse(backend.draining)
@@ -0,0 +1,103 @@
+import unittest
+import eventlet
+from ..backend import Backend
+from ..framing import BufferedSocket, read_head
+from ..healthcheck import HealthChecker
+from ..loadbalancer import Balancer
+
+
+class HealthCheckTests(unittest.TestCase):
+    "Tests the active health checker"
+
+    def setUp(self):
+        self.status = "200 OK"
+        self.requests = []
+        self.server = eventlet.listen(("127.0.0.1", 0))
+        self.server_thread = eventlet.spawn(self.serve)
+        self.address = self.server.getsockname()
+        self.balancer = Balancer(None, None, None, None)
+        self.checker = HealthChecker(self.balancer, 1, timeout=1, rise=2, fall=2)
+
+    def tearDown(self):
+        self.server_thread.kill()
+        self.server.close()
+
+    def serve(self):
+        "Answers every request with self.status"
+        while True:
+            sock, address = self.server.accept()
+            head = read_head(BufferedSocket(sock))
+            if head is not None:
+                self.requests.append(head.split("\r\n")[0])
+                sock.sendall("HTTP/1.0 %s\r\nContent-length: 0\r\n\r\n" % self.status)
+            sock.close()
+
+    def test_deduplication(self):
+        "Tests that a backend shared by several hosts is probed once"
+        self.balancer.hosts = {
+            "kittens.com": ["proxy", {"backends": [Backend(self.address)]}, True],
+            "lions.net": ["proxy", {"backends": [Backend(self.address), Backend(("127.0.0.1", 1))]}, False],
+            "tigers.org": ["proxy", {"backends": [Backend(("127.0.0.1", 2))], "healthcheck": False}, False],
+            "bears.com": ["empty", {"code": 200}, False],
+        }
+        self.checker.refresh()
+        self.assertEqual(2, len(self.checker.targets))
+        target = self.checker.targets[(self.address, None, 200)]
+        self.assertEqual(2, len(target.backends))
+
+    def test_rise_fall(self):
+        "Tests that backends need several probes in a row to change state"
+        backend = Backend(("127.0.0.1", 1))
+        self.balancer.hosts = {"kittens.com": ["proxy", {"backends": [backend]}, True]}
+        self.checker.refresh()
+        target = self.checker.targets.values()[0]
+        self.checker.check(target)
+        self.assertFalse(backend.blacklisted)
+        self.checker.check(target)
+        self.assertTrue(backend.blacklisted)
+        # Pretend it came back up
+        target.address = self.address
+        self.checker.check(target)
+        self.assertTrue(backend.blacklisted)
+        self.checker.check(target)
+        self.assertFalse(backend.blacklisted)
+
+    def test_bad_settings(self):
+        "Tests that bad probe settings skip the host rather than stopping the checker"
+        self.balancer.hosts = {
+            "kittens.com": ["proxy", {"backends": [Backend(self.address)], "healthcheck_status": "ok"}, True],
+            "lions.net": ["proxy", {"backends": [Backend(("127.0.0.1", 1))], "healthcheck_path": 4}, True],
+            "tigers.org": ["proxy", {"backends": [Backend(("127.0.0.1", 2))]}, True],
+        }
+        self.checker.refresh()
+        self.assertEqual([(("127.0.0.1", 2), None, 200)], self.checker.targets.keys())
+
+    def test_passive_blacklist(self):
+        "Tests that a backend blacklisted by a failed request still needs rise probes"
+        backend = Backend(self.address)
+        self.balancer.hosts = {"kittens.com": ["proxy", {"backends": [backend]}, True]}
+        self.checker.refresh()
+        target = self.checker.targets.values()[0]
+        for i in range(3):
+            self.checker.check(target)
+        self.assertEqual(3, target.successes)
+        backend.blacklisted = True
+        self.checker.check(target)
+        self.assertTrue(backend.blacklisted)
+        self.checker.check(target)
+        self.assertFalse(backend.blacklisted)
+
+    def test_http_probe(self):
+        "Tests that HTTP probes check the response status"
+        backend = Backend(self.address)
+        self.balancer.hosts = {"kittens.com": ["proxy", {
+            "backends": [backend],
+            "healthcheck_path": "/health",
+            "healthcheck_status": 204,
+        }, True]}
+        self.checker.refresh()
+        target = self.checker.targets.values()[0]
+        self.assertFalse(self.checker.probe(target))
+        self.status = "204 No Content"
+        self.assertTrue(self.checker.probe(target))
+        self.assertEqual(["GET /health HTTP/1.0"] * 2, self.requests)
@@ -1,6 +1,8 @@
 from unittest import TestCase
+from ..backend import Backend
 from ..loadbalancer import Balancer
 from ..actions import Empty, Unknown, Redirect, Spin, Proxy
+from ..stats import HostCounters
 
 
 class BalancerTests(TestCase):
@@ -70,3 +72,112 @@ class BalancerTests(TestCase):
             balancer.resolve_host("i-love-bees.com").__class__,
             Unknown,
         )
+
+    def test_resolution_updates(self):
+        "Tests that name resolution follows changes to the hosts dict"
+        balancer = Balancer(None, None, None, None)
+        balancer.hosts = {
+            "ep.io": [
+                "empty",
+                {"code": 402},
+                True,
+            ],
+        }
+        self.assertEqual(
+            balancer.resolve_host("www.ep.io").__class__,
+            Empty,
+        )
+        # Actions are reused until the table changes
+        self.assert_(
+            balancer.resolve_host("www.ep.io") is balancer.resolve_host("www.ep.io")
+        )
+        # A more specific entry takes over
+        balancer.hosts["www.ep.io"] = ["spin", {}, False]
+        self.assertEqual(
+            balancer.resolve_host("www.ep.io").__class__,
+            Spin,
+        )
+        self.assertEqual(
+            balancer.resolve_host("a.www.ep.io").__class__,
+            Empty,
+        )
+        # Protocol-specific entries only apply to that protocol
+        balancer.hosts["https://ep.io"] = ["redirect", {"redirect_to": "http://ep.io"}, True]
+        self.assertEqual(
+            balancer.resolve_host("a.www.ep.io", "https").__class__,
+            Redirect,
+        )
+        self.assertEqual(
+            balancer.resolve_host("a.www.ep.io").__class__,
+            Empty,
+        )
+        # Deleting entries falls back to the parent domain
+        del balancer.hosts["www.ep.io"]
+        del balancer.hosts["https://ep.io"]
+        self.assertEqual(
+            balancer.resolve_host("www.ep.io", "https").__class__,
+            Empty,
+        )
+        self.assertEqual(
+            balancer.resolve_host("www.ep.io").matched_host,
+            "ep.io",
+        )
+
+    def test_action_cache(self):
+        "Tests that changes only drop the cached actions they affect"
+        balancer = Balancer(None, None, None, None)
+        balancer.hosts = {
+            "ep.io": ["proxy", {"backends": [Backend(("127.0.0.1", 8000)), Backend(("127.0.0.1", 8001))], "algorithm": "weighted_round_robin"}, True],
+            "kittens.com": ["alias", {"hostname": "ep.io"}, True],
+            "lions.net": ["empty", {"code": 200}, False],
+        }
+        www = balancer.resolve_host("www.ep.io")
+        api = balancer.resolve_host("api.ep.io")
+        alias = balancer.resolve_host("kittens.com")
+        lions = balancer.resolve_host("lions.net")
+        # Every hostname an entry matches shares its backend selection
+        self.assert_(www.selector is api.selector)
+        self.assert_(www.selector is alias.aliased.selector)
+        # Changing an unrelated entry leaves the others alone
+        balancer.hosts["tigers.org"] = ["empty", {"code": 200}, False]
+        self.assert_(balancer.resolve_host("www.ep.io") is www)
+        self.assert_(balancer.resolve_host("kittens.com") is alias)
+        # A new entry only affects the hostnames it matches
+        balancer.hosts["api.ep.io"] = ["empty", {"code": 200}, False]
+        self.assertEqual(Empty, balancer.resolve_host("api.ep.io").__class__)
+        self.assert_(balancer.resolve_host("www.ep.io") is www)
+        # Changing an entry drops its actions, and those of aliases to it
+        balancer.hosts["ep.io"] = ["empty", {"code": 402}, True]
+        self.assertEqual(Empty, balancer.resolve_host("www.ep.io").__class__)
+        self.assertEqual(Empty, balancer.resolve_host("kittens.com").aliased.__class__)
+        self.assert_(balancer.resolve_host("lions.net") is lions)
+        # A full cache drops the oldest action, not all of them
+        routes = balancer.hosts.routes
+        routes.max_cached_actions = 3
+        balancer.resolve_host("a.ep.io")
+        balancer.resolve_host("b.ep.io")
+        self.assertEqual(["kittens.com", "a.ep.io", "b.ep.io"], list(routes.actions["http"]))
+
+    def test_stats_snapshot(self):
+        "Tests that request counters are folded into the stats when read"
+        balancer = Balancer(None, None, None, None)
+        balancer.stats = {"ep.io": {"completed_requests": 5, "bytes_sent": 100}}
+        counters = balancer.counters["ep.io"] = HostCounters()
+        counters.open_requests = 1
+        counters.completed_requests = 2
+        counters.bytes_sent = 10
+        self.assertEqual(
+            {"ep.io": {"open_requests": 1, "completed_requests": 7, "bytes_sent": 110, "bytes_received": 0}},
+            balancer.collect_stats(),
+        )
+        # Counted requests are only added once
+        counters.open_requests = 0
+        self.assertEqual(
+            {"open_requests": 0, "completed_requests": 7, "bytes_sent": 110, "bytes_received": 0},
+            balancer.collect_stats()["ep.io"],
+        )
+        self.assertEqual({}, balancer.counters)
+        # Setting a host again starts it from nothing
+        balancer.counters["ep.io"] = HostCounters()
+        balancer.reset_stats("ep.io")
+        self.assertEqual({"ep.io": {}}, balancer.collect_stats())
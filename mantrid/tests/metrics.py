@@ -0,0 +1,53 @@
+import unittest
+import mantrid.json
+from ..metrics import Histogram, Metrics
+
+
+class MetricsTests(unittest.TestCase):
+    "Tests the metric histograms and their text exposition"
+
+    def test_histogram(self):
+        "Tests values land in the right buckets"
+        histogram = Histogram((0.1, 1, 10))
+        for value in (0.05, 0.1, 0.5, 5, 50):
+            histogram.observe(value)
+        self.assertEqual([2, 1, 1, 1], histogram.counts)
+        self.assertAlmostEqual(55.65, histogram.sum)
+
+    def test_render(self):
+        "Tests the Prometheus text format"
+        metrics = Metrics()
+        labels = (("host", "ep.io"), ("backend", "127.0.0.1:8000"))
+        metrics.observe("mantrid_backend_connect_seconds", labels, 0.002)
+        metrics.observe("mantrid_backend_connect_seconds", labels, 100)
+        metrics.increment("mantrid_backend_retries_total", (("host", 'say "hi"'), ))
+        text = metrics.render({"ep.io": {"completed_requests": 3}})
+        self.assert_('# TYPE mantrid_backend_connect_seconds histogram\n' in text)
+        self.assert_('mantrid_backend_connect_seconds_bucket{host="ep.io",backend="127.0.0.1:8000",le="0.001"} 0\n' in text)
+        self.assert_('mantrid_backend_connect_seconds_bucket{host="ep.io",backend="127.0.0.1:8000",le="0.0025"} 1\n' in text)
+        self.assert_('mantrid_backend_connect_seconds_bucket{host="ep.io",backend="127.0.0.1:8000",le="30"} 1\n' in text)
+        self.assert_('mantrid_backend_connect_seconds_bucket{host="ep.io",backend="127.0.0.1:8000",le="+Inf"} 2\n' in text)
+        self.assert_('mantrid_backend_connect_seconds_count{host="ep.io",backend="127.0.0.1:8000"} 2\n' in text)
+        self.assert_('mantrid_backend_retries_total{host="say \\"hi\\""} 1\n' in text)
+        self.assert_('mantrid_requests_total{host="ep.io"} 3\n' in text)
+        self.assert_('mantrid_open_requests{host="ep.io"} 0\n' in text)
+        # Buckets stay in order
+        self.assert_(text.index('le="2.5"') < text.index('le="10"') < text.index('le="+Inf"'))
+
+    def test_merge(self):
+        "Tests adding up metrics from several processes"
+        labels = (("host", "ep.io"), )
+        first = Metrics()
+        first.increment("mantrid_backend_retries_total", labels)
+        first.observe("mantrid_backend_request_seconds", labels, 0.5)
+        second = Metrics()
+        second.increment("mantrid_backend_retries_total", labels, 2)
+        second.observe("mantrid_backend_request_seconds", labels, 0.5)
+        total = Metrics()
+        total.merge(first.dump())
+        # Dumps go between processes as JSON, which makes tuples lists
+        total.merge(mantrid.json.loads(mantrid.json.dumps(second.dump())))
+        self.assertEqual(3, total.counters["mantrid_backend_retries_total", labels])
+        histogram = total.histograms["mantrid_backend_request_seconds", labels]
+        self.assertEqual(2, sum(histogram.counts))
+        self.assertEqual(1.0, histogram.sum)
@@ -0,0 +1,79 @@
+import unittest
+from ..framing import BufferedSocket, FramingError
+from ..requesthead import RequestHead, read_request_head
+
+
+class FakeSocket(object):
+    "Hands out data in fixed pieces, like a slow client"
+
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+
+    def recv(self, length):
+        if self.pieces:
+            return self.pieces.pop(0)
+        return ""
+
+
+class RequestHeadTests(unittest.TestCase):
+    "Tests the request head parser"
+
+    def test_parse(self):
+        "Tests reading a head that arrives in several pieces"
+        sock = BufferedSocket(FakeSocket([
+            "POST /submit HTTP/1.1\r\nX-Loadbalance-To: exam",
+            "ple.com\r\nContent-Length: 4\r\nX-Custom:  yes \r\n\r",
+            "\nbody",
+        ]))
+        head = read_request_head(sock)
+        self.assertEqual(head.method, "POST")
+        self.assertEqual(head.path, "/submit")
+        self.assertEqual(head.version, "HTTP/1.1")
+        self.assertEqual(head["x-loadbalance-to"], "example.com")
+        self.assertEqual(head.get("Content-Length"), "4")
+        # Headers that aren't parsed up front can still be read
+        self.assertEqual(head.get("X-Custom"), "yes")
+        self.assertEqual(head.get("X-Missing", "-"), "-")
+        self.assert_("X-Custom" in head)
+        self.assertRaises(KeyError, lambda: head["X-Missing"])
+        # The body is left for whoever reads next
+        self.assertEqual(sock.buffer, "body")
+
+    def test_rewrite(self):
+        "Tests that changed headers replace the originals, and nothing else moves"
+        head = RequestHead(
+            "GET / HTTP/1.0\r\n"
+            "Connection: keep-alive\r\n"
+            "Accept: */*\r\n"
+            "X-Forwarded-For: 10.0.0.1\r\n"
+            "X-Other: a\n"
+            "  b\n"
+        )
+        head.set("Connection", "close")
+        head.set("X-Forwarded-For", "127.0.0.1")
+        head.remove("X-Other")
+        self.assertEqual(
+            str(head),
+            "GET / HTTP/1.0\r\n"
+            "Accept: */*\r\n"
+            "Connection: close\r\n"
+            "X-Forwarded-For: 127.0.0.1\r\n"
+            "\r\n",
+        )
+        self.assertEqual(head.get("connection"), "close")
+        self.assertEqual(head.get("X-Other"), None)
+
+    def test_invalid(self):
+        "Tests that broken heads are refused, and clean closes aren't"
+        self.assertEqual(read_request_head(BufferedSocket(FakeSocket([]))), None)
+        self.assertRaises(FramingError, read_request_head, BufferedSocket(FakeSocket(["GET\r\n\r\n"])))
+        self.assertRaises(FramingError, read_request_head, BufferedSocket(FakeSocket(["GET / HTTP/1.0\r\nbroken\r\n\r\n"])))
+        self.assertRaises(FramingError, read_request_head, BufferedSocket(FakeSocket(["GET / HTTP/1.0\r\nHost: a"])))
+
+    def test_content_length(self):
+        "Tests that differing Content-Lengths are refused, and repeats merged"
+        self.assertRaises(FramingError, RequestHead, "POST / HTTP/1.1\r\nContent-Length: 5\r\nContent-Length: 50\r\n")
+        self.assertRaises(FramingError, RequestHead, "POST / HTTP/1.1\r\nContent-Length: 5, 50\r\n")
+        head = RequestHead("POST / HTTP/1.1\r\nContent-Length: 5\r\nAccept: */*\r\nContent-Length: 5, 5\r\n")
+        self.assertEqual(head.get("Content-Length"), "5")
+        self.assertEqual(str(head), "POST / HTTP/1.1\r\nAccept: */*\r\nContent-Length: 5\r\n\r\n")
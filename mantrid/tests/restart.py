@@ -0,0 +1,73 @@
+import os
+import unittest
+import eventlet
+from eventlet import StopServe
+from eventlet.green import socket
+from .. import restart
+from ..loadbalancer import Balancer
+
+
+class RestartTests(unittest.TestCase):
+    "Tests handing over listening sockets and draining, without exec'ing"
+
+    def test_inherited_listeners(self):
+        "Tests that listening sockets can be picked up from the environment"
+        self.assertEqual(None, restart.inherited_listeners())
+        listener = eventlet.listen(("127.0.0.1", 0))
+        fd = os.dup(listener.fileno())
+        os.environ[restart.LISTEN_FDS_VARIABLE] = "internal:%i:%i" % (fd, socket.AF_INET)
+        try:
+            [(sock, kind)] = restart.inherited_listeners()
+        finally:
+            os.environ.pop(restart.LISTEN_FDS_VARIABLE, None)
+        self.assertEqual("internal", kind)
+        self.assertEqual(listener.getsockname(), sock.getsockname())
+        # It's still the same listening socket
+        client = eventlet.connect(listener.getsockname())
+        accepted, address = sock.accept()
+        accepted.close()
+        client.close()
+        sock.close()
+        listener.close()
+        # The variable is only used once
+        self.assertEqual(None, restart.inherited_listeners())
+
+    def test_ready_pipe(self):
+        "Tests the new process telling the old one it's serving"
+        ready_read, ready_write = os.pipe()
+        os.environ[restart.READY_FD_VARIABLE] = str(ready_write)
+        restart.signal_ready()
+        self.assertTrue(restart.wait_until_ready(ready_read, 1))
+        # A new process that never says so
+        ready_read, ready_write = os.pipe()
+        self.assertFalse(restart.wait_until_ready(ready_read, 0.1))
+        os.close(ready_write)
+
+    def test_drain(self):
+        "Tests that draining stops accepting and waits for open connections"
+        balancer = Balancer(None, None, None, None)
+        listener = eventlet.listen(("127.0.0.1", 0))
+        thread = eventlet.spawn(eventlet.serve, listener, lambda sock, address: None)
+        balancer.listen_threads.append((thread, StopServe))
+        balancer.running = True
+        balancer.open_connections = 1
+        drainer = eventlet.spawn(balancer.drain, 5)
+        eventlet.sleep(0.2)
+        self.assertTrue(thread.dead)
+        self.assertFalse(balancer.running)
+        self.assertFalse(balancer.drained.ready())
+        balancer.open_connections = 0
+        drainer.wait()
+        self.assertTrue(balancer.drained.ready())
+        listener.close()
+
+    def test_drain_timeout(self):
+        "Tests that draining gives up on connections after the timeout"
+        balancer = Balancer(None, None, None, None)
+        balancer.open_connections = 1
+        eventlet.spawn(balancer.drain, 0.2)
+        with eventlet.Timeout(2):
+            balancer.drained = None
+            while balancer.drained is None:
+                eventlet.sleep(0.01)
+            balancer.drained.wait()
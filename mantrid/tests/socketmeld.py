@@ -0,0 +1,143 @@
+import time
+import unittest
+import eventlet
+from eventlet.green import socket
+from ..backend import Backend
+from ..socketmeld import SocketMelder, _splice
+from ..stats_socket import StatsSocket
+
+
+class SocketMelderTests(unittest.TestCase):
+    "Tests relaying data between two sockets"
+
+    def meld(self, splice, **kwargs):
+        "Relays a request and response, returning what each end saw"
+        client, client_end = socket.socketpair()
+        server, server_end = socket.socketpair()
+        client = StatsSocket(client)
+        melder = SocketMelder(client, server, Backend(("127.0.0.1", 0)), "melder.test", splice=splice, **kwargs)
+        thread = eventlet.spawn(melder.run)
+        client_end.sendall("GET / HTTP/1.0\r\n\r\n" + "x" * 100000)
+        client_end.shutdown(socket.SHUT_WR)
+        received = ""
+        while True:
+            data = server_end.recv(65536)
+            if not data:
+                break
+            received += data
+        server_end.sendall("HTTP/1.0 200 OK\r\n\r\n" + "y" * 200000)
+        server_end.close()
+        response = ""
+        while True:
+            data = client_end.recv(65536)
+            if not data:
+                break
+            response += data
+        handled = thread.wait()
+        return received, response, handled, client
+
+    def test_copy(self):
+        "Tests the recv()/sendall() relay"
+        received, response, handled, client = self.meld(splice=False)
+        self.assertEqual(received, "GET / HTTP/1.0\r\n\r\n" + "x" * 100000)
+        self.assertEqual(response, "HTTP/1.0 200 OK\r\n\r\n" + "y" * 200000)
+        self.assertEqual(handled, len(received) + len(response))
+        self.assertEqual(client.bytes_received, len(received))
+        self.assertEqual(client.bytes_sent, len(response))
+
+    def test_splice(self):
+        "Tests the splice() relay reports the same as the copying one"
+        if _splice is None:
+            return
+        self.assertEqual(self.meld(splice=True)[:3], self.meld(splice=False)[:3])
+        received, response, handled, client = self.meld(splice=True)
+        self.assertEqual(client.bytes_received, len(received))
+        self.assertEqual(client.bytes_sent, len(response))
+
+    def test_watermarks(self):
+        "Tests reading ahead of the writer between the watermarks"
+        received, response, handled, client = self.meld(splice=False, buffer_size=4096, high_watermark=16384, low_watermark=4096)
+        self.assertEqual(received, "GET / HTTP/1.0\r\n\r\n" + "x" * 100000)
+        self.assertEqual(response, "HTTP/1.0 200 OK\r\n\r\n" + "y" * 200000)
+        self.assertEqual(handled, len(received) + len(response))
+
+    def test_read_ahead_bounded(self):
+        "Tests that reading stops at the high watermark while the receiver is slow"
+        client, client_end = socket.socketpair()
+        server, server_end = socket.socketpair()
+        sessions = set()
+        melder = SocketMelder(client, server, Backend(("127.0.0.1", 0)), "melder.test", buffer_size=1024, high_watermark=8192, low_watermark=1024, sessions=sessions)
+        thread = eventlet.spawn(melder.run)
+        # Far more than the socket buffers and the watermark can hold
+        writer = eventlet.spawn(server_end.sendall, "y" * 10000000)
+        eventlet.sleep(0.2)
+        self.assertEqual([melder], list(sessions))
+        self.assertTrue(melder.buffered <= 8192)
+        self.assertTrue(melder.stalls > 0)
+        stats = melder.stats()
+        self.assertEqual(melder.bytes_to_client, stats["bytes_to_client"])
+        self.assertEqual("127.0.0.1:0", stats["backend"])
+        writer.kill()
+        thread.kill()
+        for sock in (client_end, server_end):
+            sock.close()
+
+    def test_idle_timeout(self):
+        "Tests that only a relay making no progress times out"
+        client, client_end = socket.socketpair()
+        server, server_end = socket.socketpair()
+        melder = SocketMelder(client, server, Backend(("127.0.0.1", 0)), "melder.test", idle_timeout=0.2)
+        thread = eventlet.spawn(melder.run)
+        # Slow, but never idle for long; the client sends nothing meanwhile
+        for i in range(6):
+            server_end.sendall("y" * 10)
+            eventlet.sleep(0.1)
+        self.assertFalse(melder.timed_out)
+        self.assertEqual("y" * 60, client_end.recv(1024))
+        # Then nothing at all
+        thread.wait()
+        self.assertTrue(melder.timed_out)
+        # Data had been sent, so no timeout response was
+        self.assertFalse(melder.timeout_response_sent)
+        for sock in (client_end, server_end):
+            sock.close()
+
+    def test_splice_write_timeout(self):
+        "Tests that a spliced relay to a client that stops reading ends, rather than skipping data"
+        if _splice is None:
+            return
+        client, client_end = socket.socketpair()
+        server, server_end = socket.socketpair()
+        melder = SocketMelder(client, server, Backend(("127.0.0.1", 0)), "melder.test", splice=True, idle_timeout=0.2)
+        thread = eventlet.spawn(melder.run)
+        # Far more than the socket buffers hold, numbered so gaps show
+        data = "".join("%07i\n" % i for i in range(50000))
+        def send():
+            server_end.sendall(data)
+            server_end.shutdown(socket.SHUT_WR)
+        writer = eventlet.spawn(send)
+        # The client reads a little, then stops for longer than the
+        # idle timeout before reading the rest
+        received = client_end.recv(4096)
+        eventlet.sleep(0.5)
+        while True:
+            chunk = client_end.recv(65536)
+            if not chunk:
+                break
+            received += chunk
+        thread.wait()
+        self.assertTrue(melder.timed_out)
+        writer.kill()
+        # Whatever arrived is an unbroken start of what was sent
+        self.assertTrue(data.startswith(received))
+        self.assertTrue(len(received) < len(data))
+        for sock in (client_end, server_end):
+            sock.close()
+
+    def test_rate_limit(self):
+        "Tests that a rate limit slows the relay down"
+        start = time.time()
+        received, response, handled, client = self.meld(splice=False, rate_limit=1000000)
+        # 200KB to the client at 1MB/s
+        self.assertTrue(time.time() - start >= 0.18)
+        self.assertEqual(response, "HTTP/1.0 200 OK\r\n\r\n" + "y" * 200000)
@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ..backend import Backend
+from ..loadbalancer import Balancer
+
+
+class StateTests(unittest.TestCase):
+    "Tests saving and loading the state file and its journal"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory, "state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def balancer(self, **kwargs):
+        balancer = Balancer(None, None, None, self.state_file, **kwargs)
+        balancer.load()
+        return balancer
+
+    def test_full_saves(self):
+        "Tests that only changes cause saves, and they're complete"
+        balancer = self.balancer()
+        balancer.hosts["kittens.com"] = ["proxy", {"backends": [Backend(("127.0.0.1", 8000), 2)]}, True]
+        balancer.stats["kittens.com"] = {"completed_requests": 3}
+        balancer.save_changes()
+        self.assertEqual(["state.json"], os.listdir(self.directory))
+        modified = os.stat(self.state_file).st_mtime
+        self.assertNotEqual(0, modified)
+        # Nothing has changed, so the backdated file isn't rewritten
+        os.utime(self.state_file, (0, 0))
+        balancer.save_changes()
+        self.assertEqual(0, os.stat(self.state_file).st_mtime)
+        loaded = self.balancer()
+        self.assertEqual(["kittens.com"], loaded.hosts.keys())
+        self.assertEqual(2, loaded.hosts["kittens.com"][1]["backends"][0].weight)
+        self.assertEqual(3, loaded.stats["kittens.com"]["completed_requests"])
+
+    def test_journal(self):
+        "Tests that changes are journalled, replayed and compacted"
+        balancer = self.balancer(state_journal=True, state_journal_compact=3)
+        balancer.hosts = {"kittens.com": ["spin", {}, False], "lions.net": ["spin", {}, False]}
+        balancer.save_changes()
+        with open(self.state_file) as fh:
+            snapshot = fh.read()
+        balancer.hosts["tigers.org"] = ["empty", {"code": 200}, False]
+        del balancer.hosts["lions.net"]
+        balancer.save_changes()
+        # The state file wasn't touched; the changes went to the journal
+        with open(self.state_file) as fh:
+            self.assertEqual(snapshot, fh.read())
+        self.assertEqual(2, balancer.state.journal_entries)
+        # Half-written entries are ignored when loading
+        with open(self.state_file + ".journal", "a") as fh:
+            fh.write('{"host": "bears.com", "sett')
+        loaded = self.balancer(state_journal=True)
+        self.assertEqual(["kittens.com", "tigers.org"], sorted(loaded.hosts.keys()))
+        with open(self.state_file + ".journal") as fh:
+            self.assert_(fh.read().endswith("\n"))
+        # Going over the limit writes everything out again
+        balancer.hosts["bears.com"] = ["spin", {}, False]
+        balancer.hosts["wolves.com"] = ["spin", {}, False]
+        balancer.save_changes()
+        self.assertEqual(["state.json"], os.listdir(self.directory))
+        loaded = self.balancer(state_journal=True)
+        self.assertEqual(["bears.com", "kittens.com", "tigers.org", "wolves.com"], sorted(loaded.hosts.keys()))
+
+    def test_journal_corrupt(self):
+        "Tests that a corrupt journal entry ends the journal there"
+        balancer = self.balancer(state_journal=True)
+        balancer.hosts = {"kittens.com": ["spin", {}, False]}
+        balancer.save_changes()
+        balancer.hosts["tigers.org"] = ["spin", {}, False]
+        balancer.save_changes()
+        with open(self.state_file + ".journal", "a") as fh:
+            fh.write('{"host": "bears.com", "settings": [}\n')
+            fh.write('{"host": "lions.net", "settings": ["spin", {}, false]}\n')
+        loaded = self.balancer(state_journal=True)
+        self.assertEqual(["kittens.com", "tigers.org"], sorted(loaded.hosts.keys()))
+        self.assertEqual(1, loaded.state.journal_entries)
+        # New entries follow the last good one
+        loaded.hosts["wolves.com"] = ["spin", {}, False]
+        loaded.save_changes()
+        loaded = self.balancer(state_journal=True)
+        self.assertEqual(["kittens.com", "tigers.org", "wolves.com"], sorted(loaded.hosts.keys()))
+
+    def test_journal_after_crash(self):
+        "Tests that a journal left by a crash during a full save isn't replayed"
+        balancer = self.balancer(state_journal=True)
+        balancer.hosts = {"kittens.com": ["spin", {}, False], "lions.net": ["spin", {}, False]}
+        balancer.save_changes()
+        balancer.hosts["tigers.org"] = ["spin", {}, False]
+        balancer.save_changes()
+        with open(self.state_file + ".journal") as fh:
+            journal = fh.read()
+        # Replace the table, then "crash" before the journal is removed
+        balancer.hosts = {"bears.com": ["spin", {}, False]}
+        balancer.save_changes()
+        with open(self.state_file + ".journal", "w") as fh:
+            fh.write(journal)
+        loaded = self.balancer(state_journal=True)
+        self.assertEqual(["bears.com"], loaded.hosts.keys())
+        self.assertEqual(0, loaded.state.journal_entries)
+        # The next change starts a journal of its own
+        loaded.hosts["wolves.com"] = ["spin", {}, False]
+        loaded.save_changes()
+        loaded = self.balancer(state_journal=True)
+        self.assertEqual(["bears.com", "wolves.com"], sorted(loaded.hosts.keys()))
+
+    def test_snapshot(self):
+        "Tests that snapshots are used only while they match the state file"
+        balancer = self.balancer(state_snapshot=True)
+        balancer.hosts["kittens.com"] = ["proxy", {"backends": [Backend(("127.0.0.1", 8000), 2)]}, True]
+        balancer.stats["kittens.com"] = {"completed_requests": 3}
+        balancer.save()
+        self.assert_(os.path.exists(self.state_file + ".snapshot"))
+        # Make the snapshot distinguishable from the JSON
+        with open(self.state_file + ".snapshot", "rb") as fh:
+            data = fh.read()
+        with open(self.state_file + ".snapshot", "wb") as fh:
+            fh.write(data.replace("kittens.com", "puppies.com"))
+        loaded = self.balancer(state_snapshot=True)
+        self.assertEqual(["puppies.com"], loaded.hosts.keys())
+        backend = loaded.hosts["puppies.com"][1]["backends"][0]
+        self.assertEqual((("127.0.0.1", 8000), 2), ((backend.host, backend.port), backend.weight))
+        self.assertEqual(3, loaded.stats["puppies.com"]["completed_requests"])
+        # Once the JSON changes, the snapshot is ignored
+        with open(self.state_file, "a") as fh:
+            fh.write(" ")
+        loaded = self.balancer(state_snapshot=True)
+        self.assertEqual(["kittens.com"], loaded.hosts.keys())
+
+    def test_snapshot_mirrors(self):
+        "Tests that mirror addresses are written to and read from snapshots"
+        balancer = self.balancer(state_snapshot=True)
+        balancer.hosts["kittens.com"] = ["mirror", {
+            "backends": [Backend(("127.0.0.1", 8000))],
+            "mirrors": [Backend(("127.0.0.1", 8001))],
+        }, False]
+        balancer.save()
+        snapshot = balancer.state.load_snapshot()
+        self.assertNotEqual(None, snapshot)
+        mirror = snapshot["hosts"]["kittens.com"][1]["mirrors"][0]
+        self.assertEqual(("127.0.0.1", 8001), (mirror.host, mirror.port))
+        # The host entry being saved is left as it was
+        self.assert_(isinstance(balancer.hosts["kittens.com"][1]["mirrors"][0], Backend))
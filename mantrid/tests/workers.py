@@ -0,0 +1,100 @@
+import unittest
+import eventlet
+from eventlet.green import socket
+from ..backend import Backend
+from ..loadbalancer import Balancer
+from ..workers import Worker, WorkerChannel, WorkerManager
+
+
+class WorkerTests(unittest.TestCase):
+    "Tests the master/worker process protocol, without forking"
+
+    def setUp(self):
+        self.master = Balancer(None, None, None, None, workers=1)
+        self.master.stats = {}
+        self.master.worker_manager = WorkerManager(self.master)
+        self.worker = Balancer(None, None, None, None)
+        self.worker.stats = {}
+        master_end, worker_end = socket.socketpair()
+        self.master.worker_manager.add_channel(1, WorkerChannel(master_end))
+        self.master_thread = eventlet.spawn(self.master.worker_manager.run)
+        self.worker_thread = eventlet.spawn(Worker(self.worker, WorkerChannel(worker_end)).run)
+
+    def tearDown(self):
+        self.worker_thread.kill()
+        self.master_thread.kill()
+
+    def test_host_changes(self):
+        "Tests that host table changes reach the worker"
+        self.master.hosts = {
+            "kittens.com": ["spin", {}, False],
+            "ep.io": ["proxy", {"backends": [Backend(("127.0.0.1", 8000))]}, True],
+        }
+        eventlet.sleep(0.1)
+        self.assertEqual(["ep.io", "kittens.com"], sorted(self.worker.hosts.keys()))
+        backend = self.worker.hosts["ep.io"][1]["backends"][0]
+        self.assertEqual(("127.0.0.1", 8000), (backend.host, backend.port))
+        self.assertEqual("ep.io", self.worker.resolve_host("www.ep.io").matched_host)
+        self.master.hosts["lions.net"] = ["empty", {"code": 404}, False]
+        del self.master.hosts["kittens.com"]
+        eventlet.sleep(0.1)
+        self.assertEqual(["ep.io", "lions.net"], sorted(self.worker.hosts.keys()))
+        self.assertEqual({"ep.io": {}, "lions.net": {}}, self.worker.stats)
+
+    def test_batch(self):
+        "Tests that a batch of changes reaches the worker as one message"
+        self.master.hosts = {
+            "kittens.com": ["spin", {}, False],
+            "ep.io": ["proxy", {"backends": [Backend(("127.0.0.1", 8000))]}, True],
+        }
+        eventlet.sleep(0.1)
+        backend = self.worker.hosts["ep.io"][1]["backends"][0]
+        changed = self.master.hosts.update_many(
+            {"lions.net": ["empty", {"code": 404}, False], "ep.io": ["proxy", {"backends": [Backend(("127.0.0.1", 8000))]}, True]},
+            ["kittens.com"],
+        )
+        self.assertEqual(["kittens.com", "lions.net"], sorted(changed))
+        eventlet.sleep(0.1)
+        self.assertEqual(["ep.io", "lions.net"], sorted(self.worker.hosts.keys()))
+        # The unchanged entry was left alone
+        self.assertTrue(self.worker.hosts["ep.io"][1]["backends"][0] is backend)
+        self.assertFalse(backend.retired)
+
+    def test_stats(self):
+        "Tests that stats from workers are added to the master's own"
+        self.master.hosts = {"kittens.com": ["spin", {}, False]}
+        self.master.stats["kittens.com"] = {"completed_requests": 5, "bytes_sent": 10}
+        eventlet.sleep(0.1)
+        self.worker.stats["kittens.com"] = {"completed_requests": 2, "open_requests": 1}
+        self.assertEqual(
+            {"kittens.com": {"completed_requests": 7, "open_requests": 1, "bytes_sent": 10}},
+            self.master.collect_stats(),
+        )
+
+    def test_health(self):
+        "Tests that workers follow the master's health checks"
+        self.master.hosts = {"ep.io": ["proxy", {"backends": [Backend(("127.0.0.1", 8000)), Backend(("127.0.0.1", 8001))]}, True]}
+        self.master.worker_manager.broadcast({"type": "health", "down": [("127.0.0.1", 8001)]})
+        eventlet.sleep(0.1)
+        backends = self.worker.hosts["ep.io"][1]["backends"]
+        self.assertEqual([False, True], [backend.blacklisted for backend in backends])
+
+    def test_draining(self):
+        "Tests that workers drain backends, and report their connections"
+        self.master.hosts = {"ep.io": ["proxy", {"backends": [Backend(("127.0.0.1", 8000)), Backend(("127.0.0.1", 8001))]}, True]}
+        self.master.set_backend_draining(("127.0.0.1", 8001), True)
+        eventlet.sleep(0.1)
+        backends = self.worker.hosts["ep.io"][1]["backends"]
+        self.assertEqual([False, True], [backend.draining for backend in backends])
+        # Backends of later host entries start out draining too
+        self.master.hosts["ep.io"] = ["proxy", {"backends": [Backend(("127.0.0.1", 8001))]}, True]
+        eventlet.sleep(0.1)
+        backend = self.worker.hosts["ep.io"][1]["backends"][0]
+        self.assert_(backend.draining)
+        # The worker and master share a process here, so count both
+        backend.add_connection()
+        try:
+            self.assertEqual(2, self.master.backend_connections()[("127.0.0.1", 8001)])
+        finally:
+            backend.drop_connection()
+        self.assertFalse(("127.0.0.1", 8001) in self.master.backend_connections())
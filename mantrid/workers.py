@@ -0,0 +1,263 @@
+"""
+Support for running the balancer as a master process with several
+forked worker processes sharing the listening sockets.
+
+The master owns the management API and the state file; it pushes every
+host table change to the workers, and asks them for their stats when
+they are needed.
+"""
+
+import errno
+import itertools
+import logging
+import os
+import time
+import socket as _socket
+
+import eventlet
+import eventlet.hubs
+from eventlet.event import Event
+from eventlet.green import socket
+from eventlet.greenio import GreenSocket
+from eventlet.semaphore import Semaphore
+from eventlet.timeout import Timeout
+
+import mantrid.backend
+import mantrid.json
+from mantrid.framing import BufferedSocket
+
+
+def encode_message(message):
+    "Returns a message as sent over a WorkerChannel"
+    return mantrid.json.dumps(message) + "\n"
+
+
+class WorkerChannel(object):
+    "Newline-delimited JSON messages over a socket"
+
+    def __init__(self, sock):
+        self.sock = BufferedSocket(sock)
+
+    def send(self, message):
+        self.send_encoded(encode_message(message))
+
+    def send_encoded(self, line):
+        "Sends a message already encoded by encode_message()"
+        self.sock.sendall(line)
+
+    def receive(self):
+        "Returns the next message, or None if the other end has gone."
+        line = self.sock.readline(limit=1 << 30)
+        if not line:
+            return None
+        return mantrid.json.loads(line)
+
+    def close(self):
+        self.sock.close()
+
+
+class WorkerManager(object):
+    """
+    Master-side end of the worker processes.
+    """
+
+    stats_timeout_seconds = 2
+
+    def __init__(self, balancer):
+        self.balancer = balancer
+        self.channels = {}
+        self.pending = {}
+        self.request_ids = itertools.count()
+        # Keeps broadcasts in order while one is being encoded in a thread
+        self.broadcast_lock = Semaphore()
+
+    def spawn(self, count, listeners):
+        """
+        Forks count worker processes, which serve requests from the given
+        (socket, internal) listeners. Only returns in the master.
+        """
+        for i in range(count):
+            master_end, worker_end = _socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                master_end.close()
+                for channel in self.channels.values():
+                    channel.close()
+                # Don't share the master's event hub
+                eventlet.hubs.use_hub()
+                try:
+                    self.balancer.run_worker(WorkerChannel(GreenSocket(worker_end)), listeners)
+                except:
+                    logging.error("Worker %i failed with exception", os.getpid(), exc_info=True)
+                finally:
+                    os._exit(0)
+            worker_end.close()
+            self.channels[pid] = WorkerChannel(GreenSocket(master_end))
+            logging.info("Started worker process %i", pid)
+
+    def add_channel(self, pid, channel):
+        self.channels[pid] = channel
+
+    def run(self):
+        "Reads replies from all workers until they have all exited"
+        readers = [
+            eventlet.spawn(self._reader, pid, channel)
+            for pid, channel in self.channels.items()
+        ]
+        for reader in readers:
+            reader.wait()
+
+    def _reader(self, pid, channel):
+        while True:
+            try:
+                message = channel.receive()
+            except (socket.error, ValueError):
+                logging.error("Bad message from worker %i", pid, exc_info=True)
+                message = None
+            if message is None:
+                if self.balancer.drained is None:
+                    logging.critical("Worker process %i has exited", pid)
+                else:
+                    logging.info("Worker process %i has finished draining", pid)
+                self.channels.pop(pid, None)
+                channel.close()
+                return
+            if message.get("id") in self.pending:
+                self.pending[message["id"]].send(message)
+
+    def broadcast(self, message, size=0):
+        """
+        Sends a message to every worker, encoding it once for all of them;
+        size is how many host entries it has, to decide if encoding it is
+        worth a thread.
+        """
+        with self.broadcast_lock:
+            line = self.balancer.offload(size, encode_message, message)
+            for pid, channel in self.channels.items():
+                try:
+                    channel.send_encoded(line)
+                except socket.error, e:
+                    if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                        raise
+                    logging.error("Cannot send to worker %i: %s", pid, e)
+
+    def stats(self):
+        "Returns a list of the stats dicts of every worker that replies in time"
+        return [reply["stats"] for reply in self.ask("stats")]
+
+    def backend_connections(self):
+        """
+        Returns a list of the open backend connections of every worker
+        that replies in time, each a list of [host, port, count].
+        """
+        return [reply["connections"] for reply in self.ask("connections")]
+
+    def sessions(self):
+        "Returns a list of the relay session stats of every worker that replies in time"
+        return [reply["sessions"] for reply in self.ask("sessions")]
+
+    def metrics(self):
+        "Returns a list of the dumped Metrics of every worker that replies in time"
+        return [reply["metrics"] for reply in self.ask("metrics")]
+
+    def ask(self, message_type):
+        "Sends a request to every worker; returns the replies that arrive in time"
+        events = []
+        for pid, channel in self.channels.items():
+            request_id = self.request_ids.next()
+            self.pending[request_id] = event = Event()
+            try:
+                channel.send({"type": message_type, "id": request_id})
+            except socket.error:
+                del self.pending[request_id]
+                continue
+            events.append((request_id, event))
+        results = []
+        with Timeout(self.stats_timeout_seconds, False):
+            for request_id, event in events:
+                results.append(event.wait())
+        for request_id, event in events:
+            self.pending.pop(request_id, None)
+        return results
+
+
+class Worker(object):
+    """
+    Worker-process end of the channel: applies host table changes from
+    the master, and answers its requests for stats.
+    """
+
+    def __init__(self, balancer, channel):
+        self.balancer = balancer
+        self.channel = channel
+
+    def run(self):
+        "Handles messages until the master goes away"
+        while True:
+            message = self.channel.receive()
+            if message is None:
+                logging.info("Master process has gone; worker %i exiting", os.getpid())
+                return
+            self.handle(message)
+
+    def handle(self, message):
+        hosts = self.balancer.hosts
+        if message["type"] == "replace":
+            old_hostnames = set(hosts.keys())
+            new_hostnames = set(message["hosts"].keys())
+            self.balancer.hosts = message["hosts"]
+            for hostname in new_hostnames - old_hostnames:
+                self.balancer.reset_stats(hostname)
+            for hostname in old_hostnames - new_hostnames:
+                self.balancer.remove_stats(hostname)
+        elif message["type"] == "set":
+            hosts[message["host"]] = message["settings"]
+            self.balancer.reset_stats(message["host"])
+        elif message["type"] == "batch":
+            hosts.update_many(message["set"], message["delete"])
+            for hostname in message["set"]:
+                self.balancer.reset_stats(hostname)
+            for hostname in message["delete"]:
+                self.balancer.remove_stats(hostname)
+        elif message["type"] == "delete":
+            if message["host"] in hosts:
+                del hosts[message["host"]]
+            self.balancer.remove_stats(message["host"])
+        elif message["type"] == "health":
+            # The master probes the backends; just follow what it says
+            down = set(tuple(address) for address in message["down"])
+            for action, kwargs, allow_subs in hosts.values():
+                for backend in kwargs.get("backends", []):
+                    if hasattr(backend, "blacklisted"):
+                        backend.checker = self
+                        backend.blacklisted = (backend.host, backend.port) in down
+        elif message["type"] == "drain":
+            # The master is being replaced; finish what we're doing and exit
+            eventlet.spawn_n(self.balancer.drain, message["timeout"])
+        elif message["type"] == "draining":
+            self.balancer.draining_backends = set(tuple(address) for address in message["addresses"])
+            self.balancer.apply_draining()
+        elif message["type"] == "stats":
+            self.channel.send({"type": "stats", "id": message["id"], "stats": self.balancer.snapshot_stats()})
+        elif message["type"] == "metrics":
+            self.channel.send({"type": "metrics", "id": message["id"], "metrics": self.balancer.metrics.dump()})
+        elif message["type"] == "sessions":
+            now = time.time()
+            self.channel.send({
+                "type": "sessions",
+                "id": message["id"],
+                "sessions": [melder.stats(now) for melder in self.balancer.sessions],
+            })
+        elif message["type"] == "connections":
+            self.channel.send({
+                "type": "connections",
+                "id": message["id"],
+                "connections": [
+                    [host, port, count]
+                    for (host, port), count in mantrid.backend.address_connections.items()
+                ],
+            })
+        else:
+            logging.error("Unknown message from master: %r", message)
+        # Only the master saves state
+        self.balancer.hosts.dirty.clear()